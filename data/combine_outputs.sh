@@ -13,9 +13,7 @@ TOOLS_DIR=$2
 INPUT_DIR=$3
 OUTPUT_DIR=$4
 DELETE=$5
-OUTNAME=${OUTPUT_DIR}/${OUTNAME_BASE}.csv
-PATTERN=${OUTPUT_DIR}/${OUTNAME_BASE}_*.csv
-PATCNT=$(find ${OUTPUT_DIR} -name ${OUTNAME_BASE}_*.csv -printf '.' | wc -m)
+JOBS=${6:-$(nproc)}
 
 if [[ -z $VIRTUAL_ENV ]];
 then
@@ -23,28 +21,14 @@ then
     exit 1;
 fi
 
-if [[ $DELETE -eq del ]]
+KEEP="-keep"
+if [[ $DELETE == del ]]
 then
     echo "Deleting after complete";
+    KEEP=""
 fi
 
-echo "Found $PATCNT files"
+# transforms every input file in parallel and writes ${OUTPUT_DIR}/${OUTNAME_BASE}.csv
+python ${TOOLS_DIR}/transform.py -c ${TOOLS_DIR}/config.yml -i ${INPUT_DIR} -o ${OUTPUT_DIR} -t ${OUTNAME_BASE} -j ${JOBS} -combine ${KEEP}
 
-if [[ $PATCNT -eq 0 ]]
-then
-    python ${TOOLS_DIR}/transform.py -c ${TOOLS_DIR}/config.yml -i ${INPUT_DIR} -o ${OUTPUT_DIR} -t ${OUTNAME_BASE}
-fi
-
-cat ${PATTERN} | head -n1 > ${OUTNAME};
-
-for f in $PATTERN;
-do
-    echo $f to $OUTNAME;
-    cat "`pwd`/$f" | tail -n +2 >> ${OUTNAME}; 
-    if [[ $DELETE -eq del ]];
-    then
-        rm $f;
-    fi
-done
-
-# echo "Written to ${OUTNAME}"
\ No newline at end of file
+echo "Written to ${OUTPUT_DIR}/${OUTNAME_BASE}.csv"
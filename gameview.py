@@ -0,0 +1,367 @@
+"""
+Per game view service: one compressed json payload per game with its plays,
+shifts and roster joined on absolute game seconds, and its shot map as svg.
+
+GET /games/<gameId>            game, players, shifts (t0, t1), events (t, x, y, ...), strength segments
+GET /games/<gameId>/rink.svg   shots of the game on the rink (render.marker_svg)
+
+Payloads are built on the first request and kept gzip compressed in an LRU
+cache with an ETag per body, so a repeated view is a dictionary lookup and a
+matching If-None-Match gets a 304. Every entry remembers the version it was
+built from (the newest regular file of each dataset directory of its partition
+and the game's own live_ files), so live deltas and re-transformed games are
+rebuilt on their next request while other games' deltas leave it alone.
+Finished games (no live_ files) are also written to
+<cache>/season=.../gameType=.../<gameId>.{json,svg}.gz, all of a partition from
+one scan with --precompute, and read from there after a restart.
+"""
+import sys
+from pathlib import Path
+sys.path.append(str(Path(Path(__file__).parent, 'tools')))
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+import numpy as np
+import polars as pl
+import dataset
+import onice
+import sequences
+import strength
+from schema import load_schema
+from render import SHOT_EVENTS, marker_svg, orient
+
+DATATYPES = ['games', 'plays', 'play_details', 'rosters', 'shifts', 'strength']
+ROLES = [
+    'scoringPlayerId', 'assist1PlayerId', 'assist2PlayerId', 'shootingPlayerId', 'blockingPlayerId',
+    'goalieInNetId', 'hittingPlayerId', 'hitteePlayerId', 'winningPlayerId', 'losingPlayerId',
+    'committedByPlayerId', 'drawnByPlayerId', 'playerId',
+]
+DETAIL_COLUMNS = ['eventOwnerTeamId', 'xCoord', 'yCoord', 'zoneCode', 'shotType', 'descKey', 'duration', *ROLES]
+# stored column types, for the datatypes a partition does not have yet
+SCHEMAS = {**load_schema(Path(Path(__file__).parent, 'tools', 'schema.yml'), stored=True), 'strength': strength.SCHEMA}
+VIEW_RE = re.compile(r"/games/(\d+)(/rink\.svg)?/?")
+
+
+def partition_of(game_id: int) -> tuple[int, int]:
+    # 2024020861 -> (20242025, 2), as dataset.season_of / game_type_of
+    return (game_id // 1_000_000) * 10_001 + 1, (game_id // 10_000) % 100
+
+
+def columns(df: pl.DataFrame) -> dict:
+    # column -> list of values, the compact form of a table in the payload
+    return df.to_dict(as_series=False)
+
+
+def compress(body: bytes) -> bytes:
+    # mtime=0: the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+@dataclass
+class View:
+    version: tuple
+    payload: bytes  # gzip
+    svg: bytes  # gzip
+
+    def etag(self, body: bytes) -> str:
+        return f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+def build_views(root: str, season: int, game_type: int, game_ids: list[int] = None) -> dict[int, tuple[bytes, bytes]]:
+    """
+    gameId -> (json, svg) of the games of one partition (all of them without game_ids)
+    """
+    def scan(datatype: str, cols: list[str]) -> pl.DataFrame:
+        # e.g. no shifts yet while live.py ingests a game: an empty frame, so the view has empty tables
+        if not any(Path(root, datatype, f"season={season}", f"gameType={game_type}").glob('*.parquet')):
+            return pl.DataFrame(schema={c: SCHEMAS[datatype][c] for c in cols})
+        lf = dataset.scan(root, datatype, cols, [season], [game_type])
+        if game_ids is not None:
+            lf = lf.filter(pl.col(dataset.game_key(datatype)).is_in(game_ids))
+        return lf.collect()
+
+    games = scan('games', ['id', 'season', 'gameType', 'startTimeUTC', 'venueTimezone', 'homeTeamId', 'awayTeamId'])
+    if games.is_empty():
+        return {}
+    games = games.unique('id', keep='last').rename({'id': 'gameId'})
+    home = games.select('gameId', 'homeTeamId')
+    plays = scan('plays', ['gameId', 'eventId', 'period', 'timeInPeriod', 'situationCode', 'typeDescKey', 'sortOrder',
+                           'homeTeamDefendingSide'])
+    details = scan('play_details', ['gameId', 'eventId', *DETAIL_COLUMNS])
+    rosters = scan('rosters', ['gameId', 'teamId', 'playerId', 'sweaterNumber', 'positionCode', 'headshot'])
+    # teamId: the shooter's team for shot attempts (eventOwnerTeamId of a blocked shot is the blocking team)
+    oriented = orient(
+        sequences.with_team(plays.join(details, on=['gameId', 'eventId'], how='left').lazy(), rosters.lazy())
+        .join(home.lazy(), on='gameId', how='left')
+        .with_columns(t=onice.game_seconds('timeInPeriod'))
+        .sort('gameId', 'sortOrder')
+    ).collect()
+    events = oriented.drop('homeTeamId', 'xCoord', 'yCoord', 'homeTeamDefendingSide', 'color', 'sortOrder')
+    # fully ordered, so the same data always gives the same bytes and ETag
+    shifts = (
+        onice.shift_intervals(scan('shifts', ['gameId', 'teamId', 'playerId', 'period', 'startTime', 'endTime']))
+        .sort('gameId', 't0', 'teamId', 'playerId')
+    )
+    rosters = rosters.sort('gameId', 'teamId', 'playerId')
+    timeline = scan('strength', strength.SCHEMA.names())
+
+    shots = (
+        oriented.filter(pl.col('typeDescKey').is_in(SHOT_EVENTS) & pl.col('x').is_not_null() & pl.col('y').is_not_null())
+        .select('gameId', 'typeDescKey', 'x', 'y', 'color')
+    )
+    by_game = lambda df: df.partition_by('gameId', as_dict=True, include_key=False)
+    parts = {name: by_game(df) for name, df in
+             [('events', events), ('shifts', shifts), ('rosters', rosters), ('strength', timeline), ('shots', shots)]}
+    part = lambda name, game_id, df: parts[name].get((game_id,), df.clear().drop('gameId'))
+    views = {}
+    for game in games.iter_rows(named=True):
+        game_id = game['gameId']
+        payload = {
+            'game': game,
+            'players': columns(part('rosters', game_id, rosters)),
+            'shifts': columns(part('shifts', game_id, shifts)),
+            'events': columns(part('events', game_id, events)),
+            'strength': columns(part('strength', game_id, timeline)),
+        }
+        svg = marker_svg(part('shots', game_id, shots), str(game_id))
+        views[game_id] = (json.dumps(payload, separators=(',', ':')).encode(), svg.encode())
+    return views
+
+
+class GameViews:
+    """
+    LRU cache of game views over the dataset at root, backed by <cache> for finished games
+    """
+    def __init__(self, root: str, cache: str = None, capacity: int = 256):
+        self.root = root
+        self.cache = cache
+        self.capacity = capacity
+        self.views: OrderedDict[int, View] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def partition_dirs(self, season: int, game_type: int) -> list[Path]:
+        return [Path(self.root, datatype, f"season={season}", f"gameType={game_type}") for datatype in DATATYPES]
+
+    def version(self, game_id: int) -> tuple:
+        """
+        what a view of the game depends on: per dataset directory of its partition,
+        the newest regular file and the game's own live_ files
+        """
+        own_prefix = f"{dataset.LIVE_PREFIX}{game_id}_"
+        version = []
+        for d in self.partition_dirs(*partition_of(game_id)):
+            newest, own = 0, []
+            for entry in (os.scandir(d) if d.exists() else []):
+                if not entry.name.endswith('.parquet'):
+                    continue
+                if entry.name.startswith(own_prefix):
+                    own.append(entry.name)
+                elif not entry.name.startswith(dataset.LIVE_PREFIX):
+                    newest = max(newest, entry.stat().st_mtime_ns)
+            version.append((newest, tuple(sorted(own))))
+        return tuple(version)
+
+    def live(self, season: int, game_type: int) -> set[int]:
+        # games with deltas from live.py, not final in the dataset yet
+        plays = Path(self.root, 'plays', f"season={season}", f"gameType={game_type}")
+        return {int(fp.stem.split('_')[1]) for fp in plays.glob(f"{dataset.LIVE_PREFIX}*.parquet")}
+
+    def stored(self, game_id: int) -> tuple[Path, Path]:
+        outdir = Path(self.cache, *[f"{k}={v}" for k, v in zip(dataset.PARTITIONS, partition_of(game_id))])
+        return Path(outdir, f"{game_id}.json.gz"), Path(outdir, f"{game_id}.svg.gz")
+
+    def store(self, game_id: int, view: View):
+        for fp, body in zip(self.stored(game_id), [view.payload, view.svg]):
+            fp.parent.mkdir(parents=True, exist_ok=True)
+            tmp = Path(fp.parent, f".{fp.name}.tmp")
+            tmp.write_bytes(body)
+            tmp.replace(fp)
+
+    def load(self, game_id: int, version: tuple) -> View:
+        if not self.cache:
+            return None
+        json_fp, svg_fp = self.stored(game_id)
+        # written after the last change of the partition, of a finished game
+        if not json_fp.exists() or any(own for _, own in version):
+            return None
+        if json_fp.stat().st_mtime_ns < max(newest for newest, _ in version):
+            return None
+        return View(version, json_fp.read_bytes(), svg_fp.read_bytes())
+
+    def remember(self, game_id: int, view: View):
+        with self.lock:
+            self.views[game_id] = view
+            self.views.move_to_end(game_id)
+            while len(self.views) > self.capacity:
+                self.views.popitem(last=False)
+
+    def get(self, game_id: int) -> View:
+        """
+        view of one game, KeyError if the dataset does not have it
+        """
+        version = self.version(game_id)
+        with self.lock:
+            view = self.views.get(game_id)
+            if view is not None and view.version == version:
+                self.views.move_to_end(game_id)
+                return view
+        view = self.load(game_id, version)
+        if view is None:
+            built = build_views(self.root, *partition_of(game_id), [game_id])
+            if game_id not in built:
+                raise KeyError(game_id)
+            view = View(version, *map(compress, built[game_id]))
+            if self.cache and not any(own for _, own in version):
+                self.store(game_id, view)
+        self.remember(game_id, view)
+        return view
+
+    def precompute(self, seasons: list[int] = None, game_types: list[int] = None) -> int:
+        """
+        writes the stored views of every finished game that has none or an outdated one
+        """
+        written = 0
+        partitions = dataset.scan(self.root, 'games', ['season', 'gameType'], seasons, game_types).unique()
+        for season, game_type in partitions.sort('season', 'gameType').collect().rows():
+            games = dataset.scan(self.root, 'games', ['id'], [season], [game_type]).unique().collect()['id']
+            live = self.live(season, game_type)
+            todo = [g for g in games.to_list() if g not in live and self.load(g, self.version(g)) is None]
+            if not todo:
+                continue
+            for game_id, bodies in build_views(self.root, season, game_type, todo).items():
+                self.store(game_id, View(self.version(game_id), *map(compress, bodies)))
+                written += 1
+        return written
+
+
+class ViewHandler(BaseHTTPRequestHandler):
+    """
+    Serves GameViews; gzip bodies go out as they are to clients that accept gzip.
+    """
+    views: GameViews = None
+    protocol_version = 'HTTP/1.1'
+
+    def send_body(self, status: int, body: bytes, content_type: str, etag: str = None, gzipped: bool = False):
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if gzipped and 'gzip' not in self.headers.get('Accept-Encoding', ''):
+            body, gzipped = gzip.decompress(body), False
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        if etag:
+            self.send_header('ETag', etag)
+            # always revalidate, a 304 is cheap
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        match = VIEW_RE.fullmatch(urlparse(self.path).path)
+        if not match:
+            self.send_body(404, json.dumps({'error': 'try /games/<gameId> or /games/<gameId>/rink.svg'}).encode(),
+                           'application/json')
+            return
+        try:
+            view = self.views.get(int(match.group(1)))
+        except KeyError:
+            self.send_body(404, json.dumps({'error': f"no game {match.group(1)}"}).encode(), 'application/json')
+            return
+        body, content_type = (view.svg, 'image/svg+xml') if match.group(2) else (view.payload, 'application/json')
+        self.send_body(200, body, content_type, view.etag(body), gzipped=True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(views: GameViews, host: str = 'localhost', port: int = 8080) -> ThreadingHTTPServer:
+    handler = type(ViewHandler.__name__, (ViewHandler,), {'views': views})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def bench(root: str, games: int, capacity: int = 256):
+    """
+    request latency of cold (built), stored (precomputed), cached and 304 views over a local server
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as cache:
+        views = GameViews(root, cache, capacity)
+        server = serve(views, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://localhost:{server.server_address[1]}/games"
+        ids = dataset.scan(root, 'games', ['id']).unique().sort('id').head(games).collect()['id'].to_list()
+
+        def get(game_id: int, etag: str = None) -> tuple[float, str, int]:
+            headers = {'Accept-Encoding': 'gzip', **({'If-None-Match': etag} if etag else {})}
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(urllib.request.Request(f"{url}/{game_id}", headers=headers)) as r:
+                    body = r.read()
+                    return time.perf_counter() - start, r.headers['ETag'], len(body)
+            except HTTPError as e:
+                return time.perf_counter() - start, e.headers['ETag'], 0
+
+        timings = {}
+        timings['built'] = [get(g) for g in ids]
+        etags = {g: etag for g, (_, etag, _) in zip(ids, timings['built'])}
+        timings['cached'] = [get(g) for g in ids]
+        timings['304'] = [get(g, etags[g]) for g in ids]
+        views.views.clear()
+        timings['stored'] = [get(g) for g in ids]
+        server.shutdown()
+        start = time.perf_counter()
+        precomputed = GameViews(root, cache).precompute()
+        print(f"{len(ids)} games, {np.mean([size for _, _, size in timings['built']]) / 1024:.1f}KB gzip payloads; "
+              f"precompute of the rest: {precomputed} games in {time.perf_counter() - start:.1f}s")
+        for name, results in timings.items():
+            ms = np.array([t for t, _, _ in results]) * 1000
+            print(f"{name:7} p50 {np.percentile(ms, 50):7.2f}ms  p95 {np.percentile(ms, 95):7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser("game view service")
+    parser.add_argument('-d', '--dir', help='parquet dataset root', required=True)
+    parser.add_argument('-c', '--cache', help='stored views of finished games', default='./data/views')
+    parser.add_argument('-H', '--host', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('-n', '--capacity', help='views kept in memory', type=int, default=256)
+    parser.add_argument('-S', '--seasons', help='seasons to precompute (comma separated)')
+    parser.add_argument('--precompute', help='store the views of all finished games before serving',
+                        default=False, action='store_true')
+    parser.add_argument('--bench', help='request latency over the first BENCH games, then exit', type=int)
+    args = parser.parse_args()
+    seasons = [int(s) for s in args.seasons.split(',')] if args.seasons else None
+
+    if args.bench:
+        bench(args.dir, args.bench, args.capacity)
+        return
+    views = GameViews(args.dir, args.cache, args.capacity)
+    if args.precompute:
+        start = time.perf_counter()
+        print(f"precomputed {views.precompute(seasons)} games in {time.perf_counter() - start:.1f}s")
+    server = serve(views, args.host, args.port)
+    print(f"serving game views of {args.dir} on http://{args.host}:{args.port}/games/<gameId>")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
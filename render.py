@@ -0,0 +1,290 @@
+"""
+Batch shot maps on top of draw.py.
+
+The rink is drawn with drawsvg once per process and kept as serialized svg text.
+In markers mode a map is that text with a <use> element stamped for each event
+(one <defs> symbol per event type), so no drawing objects are built per map and
+nothing is re-read from disk. In density mode the events of a map are binned
+into a 2D histogram and embedded as one png, so the file size and browser
+render time do not grow with the number of shots. Events come from the indexed
+event store (tools/query.py -build); groups of maps are formatted and written
+by worker processes.
+
+Coordinates are turned so that the team of the event (the shooter's team for
+shot attempts, see tools/query.py) always attacks to the right; its home events
+are black and away events red. On the half rink the
+attacking half is shown with the goal at the top.
+"""
+import sys
+from pathlib import Path
+sys.path.append(str(Path(Path(__file__).parent, 'tools')))
+
+import argparse
+import base64
+import functools
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import polars as pl
+import draw
+import dataset
+from query import EventStore
+
+SHOT_EVENTS = ['shot-on-goal', 'missed-shot', 'blocked-shot', 'goal']
+# symbols referenced by <use href="#..."/>, coloured through currentColor
+SYMBOLS = {
+    'goal': '<circle id="goal" r="2" fill="currentColor" stroke="black" stroke-width="0.5"/>',
+    'shot-on-goal': '<circle id="shot-on-goal" r="1.2" fill="currentColor" fill-opacity="0.7"/>',
+    'missed-shot': '<circle id="missed-shot" r="1.2" fill="none" stroke="currentColor" stroke-width="0.4"/>',
+    'blocked-shot': '<path id="blocked-shot" d="M-1,-1L1,1M-1,1L1,-1" stroke="currentColor" stroke-width="0.5"/>',
+    'other': '<rect id="other" x="-0.8" y="-0.8" width="1.6" height="1.6" fill="currentColor"/>',
+}
+HOME_COLOR = 'black'
+AWAY_COLOR = 'red'
+COLUMNS = ['gameId', 'eventId', 'period', 'typeDescKey', 'teamId', 'eventOwnerTeamId', 'xCoord', 'yCoord', 'homeTeamDefendingSide',
+           'shootingPlayerId', 'scoringPlayerId']
+
+# draw_half_rink shows x <= 0 of the rink through <use x=.. transform="rotate(90)">
+HALF_OFFSET = (draw.RINK[0][1] - draw.RINK[0][0] + draw.PADDING) / 4
+HALF_TRANSFORM = f"rotate(90) translate({HALF_OFFSET}, 0)"
+# blue lines as drawn by draw.py
+BLUE_LINE = draw.RINK[0][1] - draw.GOAL_OFFSET - 60
+# transparent -> yellow -> red -> dark red, by density in [0, 1]
+COLOR_STOPS = np.array([0.0, 0.35, 0.7, 1.0])
+COLORS = np.array([
+    [255, 255, 0, 0],
+    [255, 220, 0, 150],
+    [255, 40, 0, 200],
+    [140, 0, 0, 230],
+])
+
+_TEMPLATES: dict[bool, tuple[str, str, str]] = {}
+
+
+def rink_template(half: bool = False) -> tuple[str, str, str]:
+    """
+    serialized rink svg as (opening tag and defs, rink, closing tag), built once per process
+    """
+    if half not in _TEMPLATES:
+        svg = (draw.draw_half_rink if half else draw.draw_rink)(None).as_svg()
+        split = svg.index('</defs>') + len('</defs>')
+        rink, tail = svg[split:].rsplit('</svg>', 1)
+        _TEMPLATES[half] = (svg[:split] + '\n', rink, '</svg>' + tail)
+    return _TEMPLATES[half]
+
+
+def layer(body: str, half: bool) -> str:
+    # content in rink coordinates, placed like the rink itself
+    return f'<g transform="{HALF_TRANSFORM}">{body}</g>' if half else body
+
+
+def markers() -> pl.Expr:
+    # events with x, y, color -> one <use/> element per event
+    symbol = pl.when(pl.col('typeDescKey').is_in(list(SYMBOLS))).then(pl.col('typeDescKey')).otherwise(pl.lit('other'))
+    return pl.format('<use href="#{}" x="{}" y="{}" color="{}"/>', symbol, pl.col('x'), pl.col('y'), pl.col('color'))
+
+
+def orient(events: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    x, y with teamId attacking to the right (svg y points down), and home/away color;
+    teamId must be the shooter's team for shot attempts, not the owner of a blocked shot
+    """
+    home = pl.col('teamId') == pl.col('homeTeamId')
+    # the team defends the left side when the home side is left and it is home, or right and it is away
+    defends_left = (pl.col('homeTeamDefendingSide') == 'left') == home
+    flip = pl.when(defends_left).then(1).otherwise(-1)
+    return events.with_columns(
+        x=pl.col('xCoord') * flip,
+        y=-pl.col('yCoord') * flip,
+        color=pl.when(home).then(pl.lit(HOME_COLOR)).otherwise(pl.lit(AWAY_COLOR)),
+    )
+
+
+def map_name(by: list[str], key: tuple) -> str:
+    return '_'.join(f"{column}{value}" for column, value in zip(by, key))
+
+
+def extent(half: bool) -> tuple[tuple[float, float], tuple[float, float]]:
+    return ((draw.RINK[0][0], 0) if half else draw.RINK[0]), draw.RINK[1]
+
+
+def density(x: np.ndarray, y: np.ndarray, half: bool = False, resolution: float = 1.0, sigma: float = 2.0,
+            zones: bool = False) -> np.ndarray:
+    """
+    events per cell of resolution feet, smoothed by a gaussian of sigma feet, scaled to [0, 1].
+    zones: each of the defensive, neutral and offensive zones is scaled by its own total
+    """
+    (x0, x1), (y0, y1) = extent(half)
+    xbins = np.arange(x0, x1 + resolution / 2, resolution)
+    ybins = np.arange(y0, y1 + resolution / 2, resolution)
+    grid, _, _ = np.histogram2d(x, y, bins=[xbins, ybins])
+    if sigma > 0:
+        radius = int(3 * sigma / resolution)
+        kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) * resolution / sigma) ** 2)
+        kernel /= kernel.sum()
+        grid = np.apply_along_axis(np.convolve, 0, grid, kernel, mode='same')
+        grid = np.apply_along_axis(np.convolve, 1, grid, kernel, mode='same')
+    if zones:
+        centers = (xbins[:-1] + xbins[1:]) / 2
+        for zone in [centers < -BLUE_LINE, np.abs(centers) <= BLUE_LINE, centers > BLUE_LINE]:
+            total = grid[zone].sum()
+            if total > 0:
+                grid[zone] /= total
+    peak = grid.max()
+    return grid / peak if peak > 0 else grid
+
+
+def png(grid: np.ndarray) -> bytes:
+    """
+    density grid indexed [x, y] -> rgba png with y as rows
+    """
+    rgba = np.stack([np.interp(grid.T, COLOR_STOPS, COLORS[:, c]) for c in range(4)], axis=-1).astype(np.uint8)
+    height, width, _ = rgba.shape
+    # filter type 0 in front of every row
+    raw = np.concatenate([np.zeros((height, 1), np.uint8), rgba.reshape(height, -1)], axis=1).tobytes()
+    chunk = lambda tag, data: (
+        struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    )
+    return (
+        b'\x89PNG\r\n\x1a\n' +
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+        chunk(b'IDAT', zlib.compress(raw, 9)) +
+        chunk(b'IEND', b'')
+    )
+
+
+def density_layer(grid: np.ndarray, half: bool = False) -> str:
+    (x0, x1), (y0, y1) = extent(half)
+    data = base64.b64encode(png(grid)).decode()
+    return layer(
+        f'<image x="{x0}" y="{y0}" width="{x1 - x0}" height="{y1 - y0}" preserveAspectRatio="none" '
+        f'href="data:image/png;base64,{data}"/>', half
+    )
+
+
+def half_rink(events: pl.DataFrame) -> pl.DataFrame:
+    # attacking half turned by 180 degrees onto the x <= 0 half that draw_half_rink shows
+    return events.filter(pl.col('x') >= 0).with_columns(x=-pl.col('x'), y=-pl.col('y'))
+
+
+def render_chunk(events: pl.DataFrame, by: list[str], outdir: str, mode: str = 'markers', half: bool = False,
+                 resolution: float = 1.0, sigma: float = 2.0, zones: bool = False) -> int:
+    """
+    write one svg per group of by in events
+    """
+    opening, rink, closing = rink_template(half)
+    if half:
+        events = half_rink(events)
+    if mode == 'markers':
+        opening += '<defs>' + ''.join(SYMBOLS.values()) + '</defs>\n'
+        maps = [
+            (key, layer(body, half)) for *key, body in
+            events.with_columns(marker=markers()).group_by(by).agg(pl.col('marker').str.join('\n')).iter_rows()
+        ]
+        # markers above the rink lines
+        layout = lambda body: rink + body
+    else:
+        maps = [
+            (key, density_layer(density(part['x'].to_numpy(), part['y'].to_numpy(), half, resolution, sigma, zones),
+                                half))
+            for key, part in events.partition_by(by, as_dict=True).items()
+        ]
+        # rink lines above the density
+        layout = lambda body: body + rink
+    for key, body in maps:
+        name = map_name(by, key)
+        with open(Path(outdir, f"{name}.svg"), 'w') as f:
+            f.write(opening + f"<title>{name}</title>\n" + layout(body) + '\n' + closing)
+    return len(maps)
+
+
+def marker_svg(events: pl.DataFrame, title: str, half: bool = False) -> str:
+    """
+    one map of events (x, y, color) in markers mode as svg text
+    """
+    opening, rink, closing = rink_template(half)
+    if half:
+        events = half_rink(events)
+    body = '\n'.join(events.select(markers()).to_series())
+    return (
+        opening + '<defs>' + ''.join(SYMBOLS.values()) + '</defs>\n' +
+        f"<title>{title}</title>\n" + rink + layer(body, half) + '\n' + closing
+    )
+
+
+def load_events(root: str, seasons: list[int] = None, games: list[int] = None, teams: list[int] = None,
+                events: list[str] = SHOT_EVENTS, periods: list[int] = None) -> pl.DataFrame:
+    """
+    events of the store with x, y, color; teams selects the shooter's team of shot attempts
+    """
+    store = EventStore(root)
+    if 'eventOwnerTeamId' not in store.columns:
+        # built when teamId was the owner, which puts blocked shots on the blocking team
+        raise Exception(f"the event store of {root} predates shooter teams, rebuild it with query.py -build")
+    found = store.query(seasons, games=games, teams=teams, events=events, periods=periods,
+                                   columns=[*COLUMNS, 'season', 'gameType'])
+    home = dataset.scan(root, 'games', ['id', 'homeTeamId'], seasons).rename({'id': 'gameId'})
+    return (
+        orient(found.lazy().join(home, on='gameId', how='left'))
+        .filter(pl.col('x').is_not_null() & pl.col('y').is_not_null())
+        .with_columns(playerId=pl.coalesce('scoringPlayerId', 'shootingPlayerId'))
+        .collect()
+    )
+
+
+def render(events: pl.DataFrame, by: list[str], outdir: str, jobs: int = 4, chunk_groups: int = 64,
+           **style) -> int:
+    """
+    split the groups of by into chunks of chunk_groups maps and render them in jobs processes.
+    style: mode, half, resolution, sigma, zones of render_chunk
+    """
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    keys = events.select(by).unique().sort(by).with_columns(chunk=pl.int_range(pl.len()) // chunk_groups)
+    chunks = events.join(keys, on=by).partition_by('chunk', include_key=False)
+    work = functools.partial(render_chunk, by=by, outdir=outdir, **style)
+    if jobs <= 1:
+        return sum(map(work, chunks))
+    # spawn: forking after polars has started its thread pool can deadlock the workers
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return sum(pool.map(work, chunks))
+
+
+def main():
+    parser = argparse.ArgumentParser("batch shot maps")
+    parser.add_argument('-d', '--dir', help='parquet dataset root with the event store (tools/query.py -build)',
+                        required=True)
+    parser.add_argument('-o', '--outdir', help='output directory for the svg files', required=True)
+    parser.add_argument('-b', '--by', help='one map per group of these columns, e.g. gameId,period or playerId',
+                        default='gameId')
+    parser.add_argument('-S', '--seasons', help='seasons (comma separated)')
+    parser.add_argument('-G', '--games', help='game ids (comma separated)')
+    parser.add_argument('-t', '--teams', help='team ids (comma separated)')
+    parser.add_argument('-p', '--periods', help='periods (comma separated)')
+    parser.add_argument('-e', '--events', help='event types (comma separated)', default=','.join(SHOT_EVENTS))
+    parser.add_argument('-m', '--mode', help='one marker per event, or a binned density layer',
+                        choices=['markers', 'density'], default='markers')
+    parser.add_argument('-half', help='attacking half only, on draw_half_rink', default=False, action='store_true')
+    parser.add_argument('-r', '--resolution', help='density cell size in feet', type=float, default=1.0)
+    parser.add_argument('-sigma', help='density smoothing in feet (0 for raw counts)', type=float, default=2.0)
+    parser.add_argument('-zones', help='scale the density of each zone by its own total', default=False,
+                        action='store_true')
+    parser.add_argument('-j', '--jobs', help='worker processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    split = lambda s, cast=int: [cast(x) for x in s.split(',')] if s else None
+
+    start = time.perf_counter()
+    events = load_events(args.dir, split(args.seasons), split(args.games), split(args.teams),
+                         split(args.events, str), split(args.periods))
+    loaded = time.perf_counter() - start
+    maps = render(events, split(args.by, str), args.outdir, args.jobs, mode=args.mode, half=args.half,
+                  resolution=args.resolution, sigma=args.sigma, zones=args.zones)
+    print(f"{maps} maps of {events.height} events in {time.perf_counter() - start:.1f}s "
+          f"(loading {loaded:.1f}s) to {args.outdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""
+Materialized player aggregates keyed by (playerId, season, gameType, strength),
+kept up to date from the parquet dataset one game at a time.
+
+<store>/ledger.jsonl            append-only log of seen dataset files and applied games
+<store>/games/<gameId>.parquet  contribution of one game
+<store>/totals.parquet          sum of every applied contribution
+
+A refresh fingerprints the dataset files (size, mtime) and only recomputes the
+games found in new or changed files. A game that was already applied has its
+old contribution subtracted before the new one is added, so a run costs the
+number of incoming games rather than the size of the season. strength is the
+skater count of the player's team against the other team, e.g. 5v5, 5v4, 6v5,
+taken from the strength timeline (strength.py) when the partition has one and
+from the play's situationCode otherwise. The two can disagree (the timeline
+does not delay stacked penalties, an event at a change takes the segment
+ending there), so build the timeline before the first refresh; a rebuilt
+timeline counts as changed files and recomputes its games.
+
+gp is kept apart on rows with strength 'all' (one per player on a game's roster,
+every other stat 0), since a game has events at several strengths; the other
+rows carry gp 0, so summing a player's rows counts each game once.
+"""
+import argparse
+import json
+import os
+import time
+import polars as pl
+from pathlib import Path
+from typing import Optional
+import dataset
+import stats
+import strength
+import onice
+from logger import Logger
+
+DATATYPES = ['games', 'plays', 'play_details', 'rosters', 'shifts', 'strength']
+STORE_KEYS = [*stats.KEYS, 'strength']
+STATS = ['gp', *stats.INDIVIDUAL_STATS, *stats.ON_ICE_STATS]
+# strength of the games played rows: gp is counted once per dressed player and game, not per strength
+ALL_STRENGTHS = 'all'
+
+
+def situation_strength(team: pl.Expr) -> pl.Expr:
+    # situationCode: away goalie, away skaters, home skaters, home goalie, e.g. 1451
+    away = pl.col('situationCode').str.slice(1, 1)
+    home = pl.col('situationCode').str.slice(2, 1)
+    is_home = team == pl.col('homeTeamId')
+    return pl.format(
+        '{}v{}',
+        pl.when(is_home).then(home).otherwise(away),
+        pl.when(is_home).then(away).otherwise(home),
+    ).fill_null('unknown')
+
+
+def team_strength(team: pl.Expr) -> pl.Expr:
+    # from the timeline's STATE columns where the event has them, situationCode otherwise
+    return pl.when(pl.col('homeSkaters').is_not_null()).then(strength.label(team)).otherwise(situation_strength(team))
+
+
+def situations(root: str, season: int, game_type: int, game_ids: list[int], events: pl.DataFrame) -> pl.DataFrame:
+    """
+    gameId, eventId, homeTeamId, situationCode and the strength.STATE columns of the events
+    """
+    home = (
+        dataset.scan(root, 'games', ['id', 'homeTeamId'], [season], [game_type])
+        .filter(pl.col('id').is_in(game_ids)).rename({'id': 'gameId'}).collect()
+    )
+    timeline = pl.DataFrame(schema=strength.SCHEMA)
+    if Path(root, 'strength', f"season={season}", f"gameType={game_type}").exists():
+        timeline = (
+            strength.scan(root, [season], [game_type]).filter(pl.col('gameId').is_in(game_ids))
+            .sort('gameId', 't0').collect()
+        )
+    timed = events.select('gameId', 'eventId', 'typeDescKey', 'situationCode', t=onice.game_seconds('timeInPeriod'))
+    return (
+        strength.lookup(timed.sort('gameId', 't'), timeline)
+        .join(home, on='gameId', how='left')
+        .select('gameId', 'eventId', 'homeTeamId', 'situationCode', *strength.STATE)
+    )
+
+
+def contributions(root: str, season: int, game_type: int, game_ids: list[int]) -> pl.DataFrame:
+    """
+    per game stats of one partition -> gameId, STORE_KEYS, STATS
+    """
+    ids = pl.col('gameId').is_in(game_ids)
+    scan = lambda datatype, columns: dataset.scan(root, datatype, columns, [season], [game_type]).filter(ids)
+    events = stats.scan_events(root, [season], [game_type]).filter(ids).collect()
+    rosters = scan('rosters', ['gameId', 'playerId', 'teamId', 'positionCode']).collect()
+    shifts = scan('shifts', ['gameId', 'teamId', 'playerId', 'period', 'startTime', 'endTime']).collect()
+    situation = situations(root, season, game_type, game_ids, events)
+    keys = ['gameId', *STORE_KEYS]
+
+    credited = (
+        stats.credits(events.lazy())
+        .join(rosters.lazy().select('gameId', 'playerId', 'teamId'), on=['gameId', 'playerId'], how='left')
+        .join(situation.lazy(), on=['gameId', 'eventId'], how='left')
+        .with_columns(strength=team_strength(pl.col('teamId')))
+    )
+    counts = stats.count_credits(credited, keys).collect()
+    attributed = (
+        stats.on_ice_attempts(events, shifts, rosters)
+        .join(situation, on=['gameId', 'eventId'], how='left')
+        .with_columns(strength=team_strength(pl.col('teamId')))
+    )
+    on_ice = stats.count_on_ice(attributed, keys)
+    # every player on a game's roster played it, with or without events (as stats.games_played)
+    played = rosters.select('gameId', 'playerId').unique().with_columns(
+        season=pl.lit(season, pl.Int64), gameType=pl.lit(game_type, pl.Int64), strength=pl.lit(ALL_STRENGTHS), gp=pl.lit(1),
+    )
+    by_strength = counts.join(on_ice, on=keys, how='full', coalesce=True)
+    return (
+        pl.concat([by_strength.cast({k: pl.Int64 for k in stats.KEYS}), played], how='diagonal_relaxed')
+        .select(*keys, *[pl.col(s).fill_null(0).cast(pl.Int64) for s in STATS])
+        .sort(keys)
+    )
+
+
+def merge(totals: pl.DataFrame, delta: pl.DataFrame) -> pl.DataFrame:
+    return (
+        pl.concat([totals, delta.select(totals.columns)])
+        .group_by(STORE_KEYS).agg(pl.col(STATS).sum())
+        .filter(pl.any_horizontal(pl.col(STATS) != 0))
+        .sort(STORE_KEYS)
+    )
+
+
+class AggregateStore:
+    """
+    Ledger records between a begin and its commit only count once the commit is
+    written. If a run died in between, totals are rebuilt from the game files and
+    the unfinished records are dropped with an abort.
+
+    {"kind": "begin", "gameIds": [...]}
+    {"kind": "file", "path": "plays/season=20242025/gameType=2/x.parquet", "size": ..., "mtime": ...}
+    {"kind": "game", "gameId": 2024020861, "state": "applied" | "retracted"}
+    {"kind": "commit"} or {"kind": "abort"}
+    """
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.games_dir = Path(self.path, 'games')
+        self.games_dir.mkdir(parents=True, exist_ok=True)
+        self.totals_fp = Path(self.path, 'totals.parquet')
+        self.ledger_fp = Path(self.path, 'ledger.jsonl')
+        self.files: dict[str, list] = {}
+        self.games: dict[int, str] = {}
+        pending = self._load()
+        self.ledger = open(self.ledger_fp, 'a')
+        if self.totals_fp.exists():
+            self.totals = pl.read_parquet(self.totals_fp)
+        else:
+            self.totals = self._empty()
+        if pending is not None:
+            Logger.warning(f"last run stopped before commit ({len(pending)} games), rebuilding totals")
+            self.rebuild()
+            self._append({'kind': 'abort'})
+
+    def _load(self) -> list[int] | None:
+        if not self.ledger_fp.exists():
+            return None
+        buffered = None
+        pending = None
+        with open(self.ledger_fp, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                match record.get('kind'):
+                    case 'begin':
+                        buffered, pending = [], record['gameIds']
+                    case 'commit':
+                        for r in buffered or []:
+                            self._apply(r)
+                        buffered, pending = None, None
+                    case 'abort':
+                        buffered, pending = None, None
+                    case _ if buffered is not None:
+                        buffered.append(record)
+                    case _:
+                        self._apply(record)
+        return pending
+
+    def _apply(self, record: dict):
+        match record.get('kind'):
+            case 'file':
+                self.files[record['path']] = [record['size'], record['mtime']]
+            case 'game':
+                self.games[record['gameId']] = record['state']
+
+    def _append(self, record: dict):
+        record['time'] = time.time()
+        self.ledger.write(json.dumps(record) + '\n')
+        self.ledger.flush()
+        os.fsync(self.ledger.fileno())
+
+    def _empty(self) -> pl.DataFrame:
+        return pl.DataFrame(schema={
+            'playerId': pl.Int64, 'season': pl.Int64, 'gameType': pl.Int64, 'strength': pl.String,
+            **{s: pl.Int64 for s in STATS},
+        })
+
+    def _game_fp(self, game_id: int) -> Path:
+        return Path(self.games_dir, f"{game_id}.parquet")
+
+    def _write_atomic(self, df: pl.DataFrame, fp: Path):
+        tmp = Path(fp.parent, f".{fp.name}.tmp")
+        df.write_parquet(tmp)
+        os.replace(tmp, fp)
+
+    def _commit(self, added: dict[int, pl.DataFrame], removed: list[int], files: Optional[dict[str, list]] = None):
+        """
+        swap the contributions of added and removed games into the totals
+        """
+        files = files or {}
+        game_ids = sorted({*added, *removed})
+        if not game_ids and not files:
+            return
+        old = [pl.read_parquet(self._game_fp(gid)) for gid in game_ids if self._game_fp(gid).exists()]
+        delta = pl.concat(
+            [df.drop('gameId') for df in added.values()] +
+            [df.drop('gameId').with_columns(-pl.col(STATS)) for df in old]
+        ) if added or old else self._empty()
+
+        self._append({'kind': 'begin', 'gameIds': game_ids})
+        for gid, df in added.items():
+            self._write_atomic(df, self._game_fp(gid))
+        for gid in removed:
+            self._game_fp(gid).unlink(missing_ok=True)
+        self.totals = merge(self.totals, delta)
+        self._write_atomic(self.totals, self.totals_fp)
+
+        for path, (size, mtime) in files.items():
+            self._append({'kind': 'file', 'path': path, 'size': size, 'mtime': mtime})
+        for gid in added:
+            self._append({'kind': 'game', 'gameId': gid, 'state': 'applied'})
+        for gid in removed:
+            self._append({'kind': 'game', 'gameId': gid, 'state': 'retracted'})
+        self._append({'kind': 'commit'})
+        self.files.update(files)
+        self.games.update({gid: 'applied' for gid in added} | {gid: 'retracted' for gid in removed})
+
+    def changed_files(self, root: str) -> dict[str, list]:
+        changed = {}
+        for datatype in DATATYPES:
+            for fp in sorted(Path(root, datatype).glob('**/*.parquet')):
+                st = fp.stat()
+                path = fp.relative_to(root).as_posix()
+                if self.files.get(path) != [st.st_size, st.st_mtime_ns]:
+                    changed[path] = [st.st_size, st.st_mtime_ns]
+        return changed
+
+    def apply(self, root: str, game_ids: list[int], files: Optional[dict[str, list]] = None) -> int:
+        """
+        (re)compute and fold in the given games, replacing any earlier contribution
+        """
+        added = {}
+        nothing = pl.DataFrame(schema={'gameId': pl.Int64, **self._empty().schema})
+        by_partition = (
+            pl.DataFrame({'gameId': sorted(set(game_ids))}, schema={'gameId': pl.Int64})
+            .with_columns(season=dataset.season_of(pl.col('gameId')), gameType=dataset.game_type_of(pl.col('gameId')))
+            .partition_by(dataset.PARTITIONS, as_dict=True)
+        )
+        for (season, game_type), part in by_partition.items():
+            ids = part['gameId'].to_list()
+            contributed = contributions(root, season, game_type, ids).partition_by('gameId', as_dict=True)
+            for gid in ids:
+                added[gid] = contributed.get((gid,), nothing)
+            Logger.info(f"aggregates: computed {len(ids)} games of {season}/{game_type}")
+        self._commit(added, [], files)
+        return len(added)
+
+    def refresh(self, root: str) -> int:
+        changed = self.changed_files(root)
+        if not changed:
+            return 0
+        seen = [
+            pl.scan_parquet(Path(root, path)).select(dataset.game_key(path.split('/')[0]))
+            .unique().collect().to_series().to_list()
+            for path in changed
+        ]
+        game_ids = {gid for ids in seen for gid in ids if self.games.get(gid) != 'retracted'}
+        Logger.info(f"aggregates: {len(changed)} new or changed files, {len(game_ids)} games")
+        return self.apply(root, sorted(game_ids), changed)
+
+    def retract(self, game_ids: list[int]) -> int:
+        removed = [gid for gid in game_ids if self.games.get(gid) == 'applied']
+        self._commit({}, removed)
+        return len(removed)
+
+    def rebuild(self):
+        """
+        totals from the game files alone
+        """
+        files = sorted(self.games_dir.glob('*.parquet'))
+        present = {int(fp.stem) for fp in files}
+        lost = [gid for gid, state in self.games.items() if state == 'applied' and gid not in present]
+        if lost:
+            Logger.warning(f"games without a contribution file, use --reapply: {lost}")
+        self.games = {gid: state for gid, state in self.games.items() if gid not in lost}
+        self.games.update({gid: 'applied' for gid in present})
+        delta = pl.concat([pl.read_parquet(fp).drop('gameId') for fp in files]) if files else self._empty()
+        self.totals = merge(self._empty(), delta)
+        self._write_atomic(self.totals, self.totals_fp)
+
+    def read(self, seasons: list[int] = None, game_types: list[int] = None,
+             strengths: list[str] = None) -> pl.DataFrame:
+        df = self.totals
+        if seasons:
+            df = df.filter(pl.col('season').is_in(seasons))
+        if game_types:
+            df = df.filter(pl.col('gameType').is_in(game_types))
+        if strengths:
+            df = df.filter(pl.col('strength').is_in(strengths))
+        return df
+
+    def close(self):
+        self.ledger.close()
+
+
+def main():
+    parser = argparse.ArgumentParser("incremental player aggregates")
+    parser.add_argument('-d', '--dir', help='parquet dataset root', required=True)
+    parser.add_argument('-s', '--store', help='aggregate store directory', default='./data/aggregates')
+    parser.add_argument('--retract', help='game ids to take out of the totals (comma separated)')
+    parser.add_argument('--reapply', help='game ids to recompute from the dataset (comma separated)')
+    parser.add_argument('--rebuild', help='recompute totals from the stored game contributions',
+                        default=False, action='store_true')
+    parser.add_argument('-S', '--seasons', help='seasons to print (comma separated)')
+    parser.add_argument('-x', '--strength', help='strengths to print, e.g. 5v5,5v4 (comma separated)')
+    parser.add_argument('-n', '--top', help='rows to print', type=int, default=20)
+    args = parser.parse_args()
+    split = lambda s, cast=int: [cast(x) for x in s.split(',')] if s else None
+
+    store = AggregateStore(args.store)
+    try:
+        start = time.perf_counter()
+        if args.rebuild:
+            store.rebuild()
+        if args.retract:
+            Logger.info(f"aggregates: retracted {store.retract(split(args.retract))} games")
+        if args.reapply:
+            Logger.info(f"aggregates: reapplied {store.apply(args.dir, split(args.reapply))} games")
+        if not (args.rebuild or args.retract or args.reapply):
+            Logger.info(f"aggregates: refreshed {store.refresh(args.dir)} games")
+        Logger.info(f"aggregates: done in {time.perf_counter() - start:.1f}s")
+        totals = store.read(split(args.seasons), strengths=split(args.strength, str))
+        with pl.Config(tbl_rows=args.top, tbl_cols=-1, tbl_width_chars=240):
+            print(totals.sort('cf', descending=True).head(args.top))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+Raw game archive: one zstd compressed json record per game instead of weekly json
+dumps, with an index so single games can be read without touching the rest.
+
+<name>.nhla            records appended one after another, each
+                       header  b'NHLA' | gameId u64 | compressed size u32 | size u32
+                       payload zstd({"game": {...}, "plays": [...], "rosters": [...], "shifts": [...]})
+<name>.nhla.idx.arrow  gameId -> offset and sizes of the latest record of each game
+
+game is the schedule entry of the game, plays and rosters are the play-by-play
+lists without the gameId that the weekly dumps repeat in every item. A game
+written again (not final yet on an earlier run) supersedes its older record;
+compact() drops the superseded ones. The index is rebuilt from the record
+headers if it is missing or behind the archive, and a torn last record from a
+crash is cut off when the archive is opened for appending.
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import time
+import polars as pl
+import pyarrow as pa
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+from logger import Logger
+
+MAGIC = b'NHLA'
+HEADER = struct.Struct('<4sQII')
+CODEC = 'zstd'
+SUFFIX = '.nhla'
+# raw file kind -> key of the game record holding it
+KINDS = {
+    'games': 'game',
+    'playbyplays': 'plays',
+    'rosters': 'rosters',
+    'shifts': 'shifts',
+}
+# transformed datatype -> raw file kind
+SOURCES = {
+    'games': 'games',
+    'plays': 'playbyplays',
+    'play_details': 'playbyplays',
+    'rosters': 'rosters',
+    'shifts': 'shifts',
+}
+
+
+def index_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.idx.arrow")
+
+
+class Archive:
+    """
+    with Archive('./data_json/raw_2.nhla', 'a') as archive:
+        archive.append(game_id, {'game': game, 'plays': plays, 'rosters': rosters, 'shifts': shifts})
+    with Archive('./data_json/raw_2.nhla') as archive:
+        plays = archive.get(2024020861)['plays']
+    """
+    def __init__(self, path: str, mode: str = 'r', level: int = 9):
+        self.path = Path(path)
+        self.mode = mode
+        self.codec = pa.Codec(CODEC, compression_level=level)
+        # gameId -> (offset, compressed size, size)
+        self.index: dict[int, tuple[int, int, int]] = {}
+        self.file = None
+        self.map = None
+        self.dirty = False
+        if mode == 'a':
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.touch()
+        self.end = self._load_index()
+        if mode == 'a':
+            self.file = open(self.path, 'r+b')
+            self.file.truncate(self.end)
+            self.file.seek(self.end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, game_id: int) -> bool:
+        return game_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _load_index(self) -> int:
+        size = self.path.stat().st_size
+        fp = index_path(self.path)
+        if fp.exists():
+            df = pl.read_ipc(fp)
+            end = int((df['offset'] + HEADER.size + df['length']).max() or 0)
+            # an index behind the archive is reused if a record header starts where it ends
+            if end == size or (end < size and self._header_at(end)):
+                self.index = {gid: (off, length, raw) for gid, off, length, raw in df.iter_rows()}
+                return self._scan(end, size)
+        return self._scan(0, size)
+
+    def _header_at(self, offset: int) -> bool:
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(len(MAGIC)) == MAGIC
+
+    def _scan(self, start: int, size: int) -> int:
+        """
+        index the records from `start` by reading only their headers, returns the
+        offset after the last complete record
+        """
+        pos = start
+        with open(self.path, 'rb') as f:
+            while pos + HEADER.size <= size:
+                f.seek(pos)
+                magic, gid, length, raw = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or pos + HEADER.size + length > size:
+                    break
+                self.index[gid] = (pos, length, raw)
+                pos += HEADER.size + length
+        if pos != size:
+            Logger.warning(f"archive {self.path}: ignoring {size - pos} bytes after the last complete record")
+        if pos != start:
+            self.dirty = True
+        return pos
+
+    def _mapped(self) -> mmap.mmap | bytes:
+        if self.map is None or len(self.map) < self.end:
+            if self.map is not None:
+                self.map.close()
+            if self.file:
+                self.file.flush()
+            if self.end == 0:
+                return b''
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), self.end, access=mmap.ACCESS_READ)
+        return self.map
+
+    def append(self, game_id: int, record: dict):
+        data = json.dumps(record, separators=(',', ':')).encode()
+        payload = self.codec.compress(data, asbytes=True)
+        self.file.write(HEADER.pack(MAGIC, game_id, len(payload), len(data)))
+        self.file.write(payload)
+        self.index[game_id] = (self.end, len(payload), len(data))
+        self.end += HEADER.size + len(payload)
+        self.dirty = True
+
+    def get(self, game_id: int) -> Optional[dict]:
+        if game_id not in self.index:
+            return None
+        offset, length, raw = self.index[game_id]
+        start = offset + HEADER.size
+        data = self.codec.decompress(self._mapped()[start:start + length], decompressed_size=raw, asbytes=True)
+        return json.loads(data)
+
+    def game_ids(self) -> list[int]:
+        # in archive order, so reading them in turn walks the file forwards
+        return sorted(self.index, key=lambda gid: self.index[gid][0])
+
+    def games(self, game_ids: Optional[Iterable[int]] = None) -> Iterator[tuple[int, dict]]:
+        wanted = self.game_ids() if game_ids is None else sorted(
+            (gid for gid in game_ids if gid in self.index), key=lambda gid: self.index[gid][0]
+        )
+        for gid in wanted:
+            yield gid, self.get(gid)
+
+    def records(self, kind: str, game_ids: Optional[Iterable[int]] = None) -> Iterator[dict]:
+        """
+        items of one raw kind in the shape of the weekly json dumps
+        """
+        key = KINDS[kind]
+        for gid, game in self.games(game_ids):
+            match kind:
+                case 'games':
+                    if game[key] is not None:
+                        yield game[key]
+                case 'playbyplays' | 'rosters':
+                    yield from ({**item, 'gameId': gid} for item in game[key])
+                case _:
+                    yield from game[key]
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        if self.dirty and self.mode == 'a':
+            items = sorted(self.index.items(), key=lambda item: item[1][0])
+            df = pl.DataFrame(
+                [(gid, off, length, raw) for gid, (off, length, raw) in items],
+                schema={'gameId': pl.Int64, 'offset': pl.Int64, 'length': pl.Int64, 'size': pl.Int64},
+                orient='row',
+            )
+            fp = index_path(self.path)
+            tmp = fp.with_suffix('.tmp')
+            df.write_ipc(tmp)
+            os.replace(tmp, fp)
+            self.dirty = False
+
+    def compact(self) -> int:
+        """
+        rewrites the archive without superseded records, returns the bytes saved
+        """
+        before = self.end
+        tmp = self.path.with_suffix('.compact.tmp')
+        with open(tmp, 'wb') as out:
+            index, pos = {}, 0
+            for gid in self.game_ids():
+                offset, length, raw = self.index[gid]
+                out.write(self._mapped()[offset:offset + HEADER.size + length])
+                index[gid] = (pos, length, raw)
+                pos += HEADER.size + length
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file:
+            self.file.close()
+        os.replace(tmp, self.path)
+        self.index, self.end, self.dirty = index, pos, True
+        if self.mode == 'a':
+            self.file = open(self.path, 'r+b')
+            self.file.seek(self.end)
+        return before - pos
+
+    def stats(self) -> dict:
+        compressed = sum(length for _, length, _ in self.index.values())
+        raw = sum(size for _, _, size in self.index.values())
+        return {
+            'games': len(self.index),
+            'bytes': self.end,
+            'superseded_bytes': self.end - compressed - HEADER.size * len(self.index),
+            'json_bytes': raw,
+            'ratio': round(raw / compressed, 1) if compressed else None,
+        }
+
+    def close(self):
+        self.flush()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def from_json(indir: str, path: str, level: int = 9) -> int:
+    """
+    packs weekly json dumps (<kind>_<week>*.json, see downloader.py) into an archive
+    """
+    games: dict[int, dict] = {}
+    for kind, key in KINDS.items():
+        for fp in sorted(Path(indir).glob(f"{kind}_*.json")):
+            with open(fp, 'r') as f:
+                items = json.load(f)
+            for item in items:
+                gid = item['id'] if kind == 'games' else item['gameId']
+                game = games.setdefault(gid, {'game': None, 'plays': [], 'rosters': [], 'shifts': []})
+                if kind == 'games':
+                    game[key] = item
+                elif kind == 'shifts':
+                    game[key].append(item)
+                else:
+                    game[key].append({k: v for k, v in item.items() if k != 'gameId'})
+    with Archive(path, 'a', level) as archive:
+        for gid in sorted(games):
+            archive.append(gid, games[gid])
+    return len(games)
+
+
+def bench(indir: str, path: str, reads: int = 200):
+    """
+    size on disk and time to read one game from the json dumps and from the archive
+    """
+    dumps = sorted(Path(indir).glob('*_*.json'))
+    json_bytes = sum(fp.stat().st_size for fp in dumps)
+    with Archive(path) as archive:
+        ids = archive.game_ids()
+        step = max(1, len(ids) // reads)
+        wanted = ids[::step][:reads]
+
+        start = time.perf_counter()
+        for gid in wanted:
+            archive.get(gid)
+        archive_s = (time.perf_counter() - start) / len(wanted)
+
+        # the dumps have no index: one game means parsing every week file of its kinds
+        start = time.perf_counter()
+        for fp in dumps:
+            with open(fp, 'r') as f:
+                json.load(f)
+        dumps_s = time.perf_counter() - start
+        print(f"json dumps  {json_bytes / 1024 ** 2:9.1f}MB  {dumps_s * 1000:9.1f}ms to find a game (parse every file)")
+        print(f"archive     {archive.end / 1024 ** 2:9.1f}MB  {archive_s * 1000:9.2f}ms per game "
+              f"({json_bytes / max(archive.end, 1):.1f}x smaller, {len(ids)} games)")
+
+
+def main():
+    parser = argparse.ArgumentParser("raw game archive")
+    parser.add_argument('-a', '--archive', help=f"archive file (*{SUFFIX})", required=True)
+    parser.add_argument('--from-json', help='pack the weekly json dumps of this directory into the archive')
+    parser.add_argument('-g', '--get', help='print the record of one game', type=int)
+    parser.add_argument('--compact', help='drop superseded records', default=False, action='store_true')
+    parser.add_argument('--bench', help='compare with the json dumps of this directory')
+    args = parser.parse_args()
+    if args.from_json:
+        start = time.perf_counter()
+        n = from_json(args.from_json, args.archive)
+        print(f"packed {n} games in {time.perf_counter() - start:.1f}s")
+    if args.compact:
+        with Archive(args.archive, 'a') as archive:
+            print(f"compacted, {archive.compact()} bytes saved")
+    if args.bench:
+        bench(args.bench, args.archive)
+        return
+    with Archive(args.archive) as archive:
+        if args.get:
+            print(json.dumps(archive.get(args.get), indent=1))
+        else:
+            print(archive.stats())
+
+
+if __name__ == "__main__":
+    main()
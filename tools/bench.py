@@ -0,0 +1,331 @@
+"""
+Benchmarks of the ingest -> transform -> load pipeline on synthetic fixtures
+(fixtures.py) of 1, 10 and 82 games per team.
+
+fetch        FetchEngine against stubserver.py, writes the weekly json dumps     requests/s
+parse        RuleMap.parse, record by record (transform.py default mode)        records/s
+columnar     RuleMap.transform of each weekly dump (transform.py -columnar)     rows/s
+csv          columnar transform + csv files (transform.py -f csv)               rows/s
+parquet      columnar transform + parquet dataset (transform.py -f parquet)     rows/s
+insert_many  PostgreSQLDB.insert_many of plays, 1000 rows per call              rows/s
+copy         LoadFromLocal.load_dataset of every datatype (database.py)          rows/s
+onice        onice.attribute_dataset, the notebook's on-ice attribution          events/s
+
+Every stage runs in a fresh process, so its peak RSS is its own, and reports
+throughput, latency percentiles of its unit of work (a request, 1000 records,
+a weekly file, an insert_many call, a table) and peak RSS. Stages feed each
+other through <workdir>/g<games per team>/, so a stage needs the ones before
+it to have run once at that scale. The postgres stages drop and recreate their
+tables in the benchmark database (created if missing) and are skipped if
+postgres is not reachable.
+
+python bench.py -w ./bench -s 1,10 -o results.json
+python bench.py -w ./bench -s 1,10 --baseline results.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import shutil
+import sys
+import threading
+import time
+import polars as pl
+import psycopg
+from psycopg import sql
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from archive import SOURCES
+import fixtures
+
+STAGES = ['fetch', 'parse', 'columnar', 'csv', 'parquet', 'insert_many', 'copy', 'onice']
+PG_STAGES = {'insert_many', 'copy'}
+DATATYPES = ['games', 'plays', 'play_details', 'rosters', 'shifts']
+PARSE_BATCH = 1000
+INSERT_BATCH = 1000
+
+
+def percentile(latencies: list[float], q: float) -> float:
+    # nearest rank, like nhl_api.Metrics
+    latencies = sorted(latencies) or [0.0]
+    return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 2)
+
+
+def dumps(work: Path, kind: str) -> list[Path]:
+    return sorted(Path(work, 'json').glob(f"{kind}_*.json"))
+
+
+def bench_fetch(ctx: dict) -> dict:
+    import nhl_api
+    import stubserver
+    from fetcher import FetchEngine
+
+    server = stubserver.serve(ctx['fixtures'], 'localhost', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    nhl_api.APIWEB = nhl_api.API = f"http://localhost:{server.server_address[1]}/"
+
+    weeks = {
+        fp.stem: [g for day in json.loads(fp.read_bytes())['gameWeek'] for g in day['games']]
+        for fp in sorted(Path(ctx['fixtures'], 'schedule').glob('*.json'))
+    }
+    weeks = {week: games for week, games in weeks.items() if games}
+    # the weekly dumps of downloader.py, input of the transform stages
+    outdir = Path(ctx['work'], 'json')
+    shutil.rmtree(outdir, ignore_errors=True)
+    outdir.mkdir(parents=True)
+    seconds = 0.0
+    with FetchEngine(workers=ctx['jobs'], rate=1e6, burst=ctx['jobs'], retries=0) as engine:
+        for week, games in weeks.items():
+            start = time.perf_counter()
+            nhl_api.get_schedule(week)
+            fetched = {gid: (pbp, shiftcharts) for gid, pbp, shiftcharts in engine.fetch_games([g['id'] for g in games])}
+            seconds += time.perf_counter() - start
+            data = {
+                'games': games,
+                'playbyplays': [{**p, 'gameId': g['id']} for g in games for p in fetched[g['id']][0]['plays']],
+                'rosters': [{**p, 'gameId': g['id']} for g in games for p in fetched[g['id']][0]['rosterSpots']],
+                'shifts': [s for g in games for s in fetched[g['id']][1]['data']],
+            }
+            for kind, items in data.items():
+                Path(outdir, f"{kind}_{week}.json").write_text(json.dumps(items))
+    server.shutdown()
+
+    latencies = [latency for m in nhl_api.METRICS.endpoints.values() for latency in m['latencies']]
+    return {'items': len(latencies), 'unit': 'requests', 'seconds': seconds, 'latencies': latencies}
+
+
+def bench_parse(ctx: dict) -> dict:
+    from transform import handle_any, worker_rulemap
+
+    rulemap = worker_rulemap(ctx['config'], ctx['schema'])
+    items, latencies = 0, []
+    for datatype in DATATYPES:
+        for fp in dumps(ctx['work'], SOURCES[datatype]):
+            records = json.loads(fp.read_bytes())
+            for i in range(0, len(records), PARSE_BATCH):
+                out = []
+                start = time.perf_counter()
+                handle_any(records[i:i + PARSE_BATCH], out, rulemap, datatype)
+                latencies.append(time.perf_counter() - start)
+            items += len(records)
+    return {'items': items, 'unit': 'records', 'seconds': sum(latencies), 'latencies': latencies}
+
+
+def bench_columnar(ctx: dict) -> dict:
+    from transform import worker_rulemap
+
+    rulemap = worker_rulemap(ctx['config'], ctx['schema'])
+    items, latencies = 0, []
+    for datatype in DATATYPES:
+        for fp in dumps(ctx['work'], SOURCES[datatype]):
+            start = time.perf_counter()
+            items += rulemap.transform(datatype, fp).height
+            latencies.append(time.perf_counter() - start)
+    return {'items': items, 'unit': 'rows', 'seconds': sum(latencies), 'latencies': latencies}
+
+
+def bench_write(ctx: dict, fmt: str) -> dict:
+    from transform import transform_file, worker_rulemap
+
+    worker_rulemap(ctx['config'], ctx['schema'])
+    outdir = Path(ctx['work'], 'dataset' if fmt == 'parquet' else 'csv')
+    shutil.rmtree(outdir, ignore_errors=True)
+    outdir.mkdir(parents=True)
+    latencies = []
+    for datatype in DATATYPES:
+        for fp in dumps(ctx['work'], SOURCES[datatype]):
+            start = time.perf_counter()
+            transform_file(fp, outdir, datatype, ctx['config'], ctx['schema'], mode='columnar', fmt=fmt)
+            latencies.append(time.perf_counter() - start)
+    if fmt == 'parquet':
+        items = sum(pl.scan_parquet(fp).select(pl.len()).collect().item() for fp in outdir.glob('**/*.parquet'))
+    else:
+        items = sum(pl.scan_csv(fp).select(pl.len()).collect().item() for fp in outdir.glob('*.csv'))
+    return {'items': items, 'unit': 'rows', 'seconds': sum(latencies), 'latencies': latencies}
+
+
+def bench_insert_many(ctx: dict) -> dict:
+    import dataset
+    from database import PG_TYPES, PRIMARY_KEYS, PostgreSQLDB
+    from schema import load_schema
+
+    schema = load_schema(ctx['schema'], stored=True)['plays']
+    rows = dataset.scan(Path(ctx['work'], 'dataset'), 'plays').select(schema.names()).cast(schema)
+    rows = rows.head(ctx['insert_rows']).collect().to_dicts()
+    PostgreSQLDB.start(**ctx['pg'])
+    try:
+        PostgreSQLDB.execute("DROP TABLE IF EXISTS bench_plays;")
+        # insert_many writes unquoted column names, so the table is made the same way
+        PostgreSQLDB.create_table('bench_plays', [
+            *[[name, PG_TYPES.get(dtype.base_type(), 'text')] for name, dtype in schema.items()],
+            [f"PRIMARY KEY ({', '.join(PRIMARY_KEYS['plays'])})"],
+        ])
+        PostgreSQLDB.commit()
+        latencies = []
+        for i in range(0, len(rows), INSERT_BATCH):
+            start = time.perf_counter()
+            PostgreSQLDB.insert_many('bench_plays', rows[i:i + INSERT_BATCH], PRIMARY_KEYS['plays'])
+            PostgreSQLDB.commit()
+            latencies.append(time.perf_counter() - start)
+    finally:
+        PostgreSQLDB.end()
+    return {'items': len(rows), 'unit': 'rows', 'seconds': sum(latencies), 'latencies': latencies}
+
+
+def bench_copy(ctx: dict) -> dict:
+    from database import LoadFromLocal, PostgreSQLDB
+    from schema import load_schema
+
+    schemas = load_schema(ctx['schema'], stored=True)
+    PostgreSQLDB.start(**ctx['pg'], pool_size=ctx['jobs'] + 1)
+    try:
+        for datatype in DATATYPES:
+            PostgreSQLDB.execute(f"DROP TABLE IF EXISTS {datatype};")
+        PostgreSQLDB.commit()
+        items, latencies = 0, []
+        for datatype in DATATYPES:
+            start = time.perf_counter()
+            items += LoadFromLocal.load_dataset(Path(ctx['work'], 'dataset'), datatype, schemas[datatype],
+                                                jobs=ctx['jobs'])
+            latencies.append(time.perf_counter() - start)
+    finally:
+        PostgreSQLDB.end()
+    return {'items': items, 'unit': 'rows', 'seconds': sum(latencies), 'latencies': latencies}
+
+
+def bench_onice(ctx: dict) -> dict:
+    import dataset
+    import onice
+
+    root = Path(ctx['work'], 'dataset')
+    latencies, items = [], 0
+    for season in sorted(dataset.scan(root, 'plays', ['season']).unique().collect()['season']):
+        start = time.perf_counter()
+        onice.attribute_dataset(root, [season])
+        latencies.append(time.perf_counter() - start)
+        items += dataset.scan(root, 'plays', ['gameId'], [season]).select(pl.len()).collect().item()
+    return {'items': items, 'unit': 'events', 'seconds': sum(latencies), 'latencies': latencies}
+
+
+def run_stage(stage: str, ctx: dict) -> dict:
+    # child process entry: the stage alone decides the peak RSS
+    logging.disable(logging.INFO)
+    match stage:
+        case 'csv' | 'parquet':
+            result = bench_write(ctx, stage)
+        case _:
+            result = globals()[f"bench_{stage}"](ctx)
+    latencies = result.pop('latencies')
+    return {
+        **result,
+        'rate': round(result['items'] / result['seconds'], 1) if result['seconds'] else None,
+        'samples': len(latencies),
+        'p50_ms': percentile(latencies, 0.5),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        # kilobytes on linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def isolated(stage: str, ctx: dict) -> dict:
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                             max_tasks_per_child=1) as pool:
+        return pool.submit(run_stage, stage, ctx).result()
+
+
+def postgres(args) -> dict | None:
+    """
+    connection options of the benchmark database, created if missing; None if postgres is not reachable
+    """
+    conninfo = {'host': args.host, 'port': args.port, 'user': args.user, 'password': args.login}
+    try:
+        with psycopg.connect(**conninfo, dbname='postgres', autocommit=True, connect_timeout=5) as conn:
+            if not conn.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (args.db,)).fetchone():
+                conn.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(args.db)))
+    except psycopg.Error as e:
+        print(f"postgres not reachable, skipping {', '.join(sorted(PG_STAGES))}: {e}", file=sys.stderr)
+        return None
+    return {**conninfo, 'dbname': args.db}
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    found = []
+    for scale, stages in results.items():
+        for stage, r in stages.items():
+            base = baseline.get(scale, {}).get(stage)
+            if not base or not base.get('rate') or not r.get('rate'):
+                continue
+            if r['rate'] < base['rate'] * (1 - tolerance):
+                found.append(f"g{scale} {stage}: {r['rate']} {r['unit']}/s, baseline {base['rate']}")
+            if r['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+                found.append(f"g{scale} {stage}: peak rss {r['peak_rss_mb']}MB, baseline {base['peak_rss_mb']}MB")
+    return found
+
+
+def print_table(scale: str, stages: dict):
+    print(f"\n{scale} games per team")
+    print(f"{'stage':<12}{'items':>10} {'unit':<9}{'seconds':>9}{'per second':>13}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rss MB':>9}")
+    for stage, r in stages.items():
+        print(f"{stage:<12}{r['items']:>10} {r['unit']:<9}{r['seconds']:>9.2f}{r['rate'] or 0:>13,.0f}"
+              f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['peak_rss_mb']:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser("pipeline benchmarks")
+    parser.add_argument('-w', '--workdir', help='fixtures and stage outputs', default='./bench')
+    parser.add_argument('-s', '--scales', help='games per team (comma separated)', default='1,10,82')
+    parser.add_argument('-t', '--teams', type=int, default=32)
+    parser.add_argument('--stages', help='stages to run (comma separated)', default=','.join(STAGES))
+    parser.add_argument('-j', '--jobs', help='fetch workers and load partitions in parallel', type=int, default=4)
+    parser.add_argument('-c', '--config', help='config file with mapping', default=Path(Path(__file__).parent, 'config.yml'))
+    parser.add_argument('--schema', help='column types of each ruleset', default=Path(Path(__file__).parent, 'schema.yml'))
+    parser.add_argument('--insert-rows', help='rows inserted by insert_many', type=int, default=20_000)
+    parser.add_argument('-o', '--out', help='write the results as json')
+    parser.add_argument('--baseline', help='results json of an earlier run to compare with')
+    parser.add_argument('--tolerance', help='allowed throughput drop / rss growth against the baseline',
+                        type=float, default=0.2)
+    parser.add_argument('-H', '--host', help="postgres host", default='127.0.0.1')
+    parser.add_argument('-P', '--port', help="postgres port", default=5432)
+    parser.add_argument('-D', '--db', help="benchmark database, its tables are dropped", default="nhl_bench")
+    parser.add_argument('-U', '--user', help="login user", default='trxe')
+    parser.add_argument('-L', '--login', help="login password")
+    args = parser.parse_args()
+
+    stages = [s for s in args.stages.split(',') if s]
+    if unknown := set(stages) - set(STAGES):
+        parser.error(f"unknown stages {unknown}, expected some of {STAGES}")
+    pg = postgres(args) if PG_STAGES & set(stages) else None
+    results = {}
+    for scale in args.scales.split(','):
+        work = Path(args.workdir, f"g{scale}")
+        fixture_dir = Path(work, 'fixtures')
+        if not Path(fixture_dir, 'schedule').exists():
+            start = time.perf_counter()
+            n = fixtures.generate(fixture_dir, int(scale), args.teams)
+            print(f"generated {n} games in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        ctx = {
+            'work': str(work), 'fixtures': str(fixture_dir), 'config': str(args.config), 'schema': str(args.schema),
+            'jobs': args.jobs, 'insert_rows': args.insert_rows, 'pg': pg,
+        }
+        results[scale] = {}
+        for stage in stages:
+            if stage in PG_STAGES and pg is None:
+                continue
+            results[scale][stage] = isolated(stage, ctx)
+        print_table(scale, results[scale])
+
+    if args.out:
+        Path(args.out).write_text(json.dumps(results, indent=1))
+    if args.baseline:
+        found = regressions(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+
+class ResponseCache:
+    """
+    Persistent cache of api responses, one file per response named by the hash
+    of url + params. Entries written with ttl=None never expire; the cache is
+    kept under `max_bytes` by evicting the least recently used files.
+    """
+    def __init__(self, root: str, max_bytes: int = 4 * 1024 ** 3):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for fp in self.root.glob('*/*.json'):
+            stat = fp.stat()
+            found.append((stat.st_mtime, fp.stem, stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.size += size
+        self._evict()
+
+    @staticmethod
+    def key(url: str, params: dict = {}) -> str:
+        ident = json.dumps([url, sorted((str(k), str(v)) for k, v in params.items())])
+        return hashlib.sha256(ident.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return Path(self.root, key[:2], f"{key}.json")
+
+    def _drop(self, key: str):
+        size = self.entries.pop(key, 0)
+        self.size -= size
+        self._path(key).unlink(missing_ok=True)
+
+    def get(self, url: str, params: dict = {}) -> Optional[dict]:
+        key = self.key(url, params)
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            fp = self._path(key)
+            try:
+                with open(fp, 'r') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                self._drop(key)
+                self.misses += 1
+                return None
+            if entry['expires'] is not None and entry['expires'] < time.time():
+                self._drop(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            os.utime(fp)
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['data']
+
+    def put(self, url: str, params: dict, data: any, ttl: Optional[float]):
+        key = self.key(url, params)
+        fp = self._path(key)
+        entry = {
+            'url': url,
+            'params': params,
+            'stored': time.time(),
+            'expires': None if ttl is None else time.time() + ttl,
+            'data': data,
+        }
+        with self.lock:
+            fp.parent.mkdir(exist_ok=True)
+            tmp = fp.with_suffix(f'.{threading.get_ident()}.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, fp)
+            self.size -= self.entries.pop(key, 0)
+            self.entries[key] = fp.stat().st_size
+            self.size += self.entries[key]
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            self._drop(key)
+            self.evicted += 1
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'entries': len(self.entries),
+            'bytes': self.size,
+        }
@@ -4,28 +4,182 @@ from fnmatch import fnmatch
 import csv
 import os
 import psycopg
+from psycopg import sql
 from pathlib import Path
 from argparse import ArgumentParser
-from typing import Mapping
+from typing import Iterable, Mapping
 import logging
+import queue
+import threading
+import time
+import dataset
+import gametime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from schema import load_schema
 
 logger = logging.getLogger(__name__)
 
+PRIMARY_KEYS = {
+    'games': ['id'],
+    'plays': ['gameId', 'eventId'],
+    'play_details': ['gameId', 'eventId'],
+    'rosters': ['gameId', 'playerId'],
+    'shifts': ['id'],
+}
+
+PG_TYPES = {
+    pl.Boolean: 'boolean',
+    pl.Int8: 'smallint',
+    pl.Int16: 'smallint',
+    pl.Int32: 'integer',
+    pl.Int64: 'bigint',
+    pl.UInt8: 'smallint',
+    pl.UInt16: 'integer',
+    pl.UInt32: 'bigint',
+    pl.Float32: 'real',
+    pl.Float64: 'double precision',
+    pl.String: 'text',
+    pl.Date: 'date',
+    pl.Time: 'time',
+}
+
+class ConnectionPool:
+    """
+    Fixed size pool of psycopg connections. Connections idle for longer than
+    `check_after` seconds are pinged before being handed out and replaced if dead.
+    """
+    def __init__(self, size: int, check_after: float = 30, **conninfo):
+        self.size = size
+        self.check_after = check_after
+        self.conninfo = conninfo
+        self.idle: queue.LifoQueue[tuple[psycopg.Connection, float]] = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _healthy(self, conn: psycopg.Connection, idle_since: float) -> bool:
+        if conn.closed or conn.broken:
+            return False
+        if time.monotonic() - idle_since < self.check_after:
+            return True
+        try:
+            conn.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg.Error:
+            return False
+
+    def _discard(self, conn: psycopg.Connection):
+        with self.lock:
+            self.created -= 1
+        if not conn.closed:
+            conn.close()
+
+    def get(self, timeout: float = None) -> psycopg.Connection:
+        while True:
+            try:
+                conn, idle_since = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    grow = self.created < self.size
+                    if grow:
+                        self.created += 1
+                if grow:
+                    try:
+                        return psycopg.connect(**self.conninfo)
+                    except Exception:
+                        with self.lock:
+                            self.created -= 1
+                        raise
+                conn, idle_since = self.idle.get(timeout=timeout)
+            if self._healthy(conn, idle_since):
+                return conn
+            logger.warning("dropping dead connection")
+            self._discard(conn)
+
+    def put(self, conn: psycopg.Connection):
+        if conn.closed or conn.broken:
+            self._discard(conn)
+            return
+        if conn.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            try:
+                conn.rollback()
+            except psycopg.Error:
+                self._discard(conn)
+                return
+        self.idle.put((conn, time.monotonic()))
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+
 class PostgreSQLDB:
     """
     Basic script to handle basic use of postgresql db
     """
+    pool: ConnectionPool = None
+    local = threading.local()
+
     @classmethod
     def create_table(cls, table_name: str, varlist: list[list[str]]):
         fields = ',\n'.join([' '.join(x) for x in varlist])
         cmd = f"CREATE TABLE IF NOT EXISTS {table_name} ({fields});"
         # print(cmd)
-        return cls.conn.execute(cmd)
+        return cls.connection().execute(cmd)
 
     @classmethod
-    def create_table_from_df(cls, table_name: str, df: pl.DataFrame):
-        print(table_name)
-        print(df)
+    def create_table_from_schema(cls, table_name: str, schema: pl.Schema, primary_keys: list[str]):
+        fields = [
+            sql.SQL("{} {}").format(sql.Identifier(name), sql.SQL(PG_TYPES.get(dtype.base_type(), 'text')))
+            for name, dtype in schema.items()
+        ]
+        fields.append(sql.SQL("PRIMARY KEY ({})").format(sql.SQL(', ').join(map(sql.Identifier, primary_keys))))
+        cmd = sql.SQL("CREATE TABLE IF NOT EXISTS {} ({});").format(sql.Identifier(table_name), sql.SQL(', ').join(fields))
+        return cls.connection().execute(cmd)
+
+    @classmethod
+    def create_table_from_df(cls, table_name: str, df: pl.DataFrame, primary_keys: list[str]):
+        return cls.create_table_from_schema(table_name, df.schema, primary_keys)
+
+    @classmethod
+    def copy_batches(cls, table_name: str, batches: Iterable[pl.DataFrame], conflict_keys: list[str],
+                     update: bool = False) -> int:
+        """
+        COPY each batch into a temp staging table, then merge it into `table_name`
+        with one INSERT .. SELECT .. ON CONFLICT; one transaction per batch
+        """
+        stage = sql.Identifier(f"stage_{table_name}")
+        table = sql.Identifier(table_name)
+        cls.connection().execute(sql.SQL(
+            "CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;"
+        ).format(stage, table))
+        cls.connection().commit()
+        total = 0
+        for df in batches:
+            if df.is_empty():
+                continue
+            cols = sql.SQL(', ').join(map(sql.Identifier, df.columns))
+            if update:
+                updates = sql.SQL(', ').join(
+                    sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(c))
+                    for c in df.columns if c not in conflict_keys
+                )
+                conflict = sql.SQL("DO UPDATE SET {}").format(updates)
+            else:
+                conflict = sql.SQL("DO NOTHING")
+            with cls.connection().transaction(), cls.connection().cursor() as cur:
+                with cur.copy(sql.SQL("COPY {} ({}) FROM STDIN (FORMAT CSV)").format(stage, cols)) as copy:
+                    copy.write(df.write_csv(include_header=False))
+                cur.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT ({}) {};").format(
+                    table, cols, cols, stage, sql.SQL(', ').join(map(sql.Identifier, conflict_keys)), conflict,
+                ), prepare=True)
+                total += cur.rowcount
+        return total
     
     @classmethod
     def _insert_cmd(cls, table_name: str, datamap: Mapping[str, any], conflict_keys: list[str]):
@@ -48,19 +202,19 @@ class PostgreSQLDB:
         # print(cmd)
         # print(values[0])
         # print(values)
-        with cls.conn.cursor() as cur:
+        with cls.connection().cursor() as cur:
             cur.executemany(cmd, values)
 
     @classmethod
     def insert(cls, table_name: str, datamap: Mapping[str, any], conflict_keys: list[str]):
-        cmd = cls._insert_cmd(cls, table_name, datamap, conflict_keys)
+        cmd = cls._insert_cmd(table_name, datamap, conflict_keys)
         values = tuple(datamap.values())
-        return cls.conn.execute(cmd, values)
+        return cls.connection().execute(cmd, values, prepare=True)
 
     @classmethod
     def select(cls, table_name: str, keylist: list[str], additional: str):
         cmd = f"SELECT {', '.join(keylist)} FROM {table_name} {additional};"
-        return cls.conn.execute(cmd)
+        return cls.connection().execute(cmd, prepare=True)
 
     @classmethod
     def create_enum(cls, typename, enum_values):
@@ -72,41 +226,79 @@ EXCEPTION
     WHEN duplicate_object THEN null;
 END $$;
         """
-        return cls.conn.execute(cmd)
+        return cls.connection().execute(cmd)
     
     @classmethod
     def execute(cls, cmd):
-        return cls.conn.execute(cmd)
+        return cls.connection().execute(cmd)
     
     @classmethod
     def commit(cls):
-        cls.conn.commit()
+        cls.connection().commit()
 
     @classmethod
-    def start(cls, host, port, dbname, user=None, password=None):
+    def start(cls, host, port, dbname, user=None, password=None, pool_size: int = 1):
         # Service name is required for most backends
-        cls.conn = psycopg.connect( 
+        cls.pool = ConnectionPool(pool_size, 
             user=user,
             password=password,
             host=host,
             port=port,
             dbname=dbname
         )
-        cursor = cls.conn.cursor()
+        # the starting thread keeps a session for the plain classmethod calls
+        cls.local.conn = cls.pool.get()
+        cursor = cls.connection().cursor()
         logger.info("Connection successful.")
 
         # Example query
         cursor.execute("SELECT NOW();")
         result = cursor.fetchone()
-        logger.info("Current Time:", result)
+        logger.info(f"Current Time: {result}")
 
         
     @classmethod
     def end(cls):
-        if cls.conn:
-            cls.conn.close()
+        if cls.pool:
+            conn = getattr(cls.local, 'conn', None)
+            if conn:
+                cls.pool.put(conn)
+                cls.local.conn = None
+            cls.pool.close()
+            cls.pool = None
             logger.info('Connection closed.')
 
+    @classmethod
+    def connection(cls) -> psycopg.Connection:
+        conn = getattr(cls.local, 'conn', None)
+        if conn is None:
+            raise Exception("no connection in this thread, use PostgreSQLDB.session()")
+        return conn
+
+    @classmethod
+    @contextmanager
+    def session(cls):
+        """
+        binds a pooled connection to the calling thread for its duration, so
+        worker threads can use the classmethods concurrently
+        """
+        if getattr(cls.local, 'conn', None) is not None:
+            yield cls.local.conn
+            return
+        conn = cls.pool.get()
+        cls.local.conn = conn
+        try:
+            yield conn
+        finally:
+            cls.local.conn = None
+            cls.pool.put(conn)
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        with cls.session() as conn, conn.transaction():
+            yield conn
+
 class LoadFromLocal:
     @classmethod
     def grab_all_files(cls, indir: str, pattern: str):
@@ -132,25 +324,67 @@ class LoadFromLocal:
         return keys
 
     @classmethod
-    def process_time_fields(cls, df: pl.DataFrame, regex: str = r".*[tT]ime"):
+    def scan_dataset(cls, root: str, datatype: str, columns: list[str] = None,
+                     seasons: list[int] = None, game_types: list[int] = None) -> pl.LazyFrame:
+        # parquet dataset from transform.py -f parquet: typed, times already in seconds
+        return dataset.scan(root, datatype, columns, seasons, game_types)
+
+    @classmethod
+    def load_partition(cls, root: str, datatype: str, schema: pl.Schema, season: int, game_type: int,
+                       batch_size: int = 100_000, update: bool = False) -> int:
+        start = time.perf_counter()
+        keys = PRIMARY_KEYS[datatype]
+        df = (
+            dataset.scan(root, datatype, seasons=[season], game_types=[game_type])
+            .select(schema.names()).cast(schema).unique(keys, keep='last').collect()
+        )
+        with PostgreSQLDB.session():
+            loaded = PostgreSQLDB.copy_batches(datatype, df.iter_slices(batch_size), keys, update)
+        logger.info(f"{datatype} {season}/{game_type}: {loaded} of {df.height} rows in {time.perf_counter() - start:.1f}s")
+        return loaded
+
+    @classmethod
+    def load_dataset(cls, root: str, datatype: str, schema: pl.Schema, seasons: list[int] = None,
+                     game_types: list[int] = None, batch_size: int = 100_000, update: bool = False,
+                     jobs: int = 1) -> int:
+        """
+        bulk loads one datatype of the parquet dataset into the table of the same name,
+        one season/game type partition per worker, each on its own pooled connection
+        """
+        with PostgreSQLDB.session():
+            PostgreSQLDB.create_table_from_schema(datatype, schema, PRIMARY_KEYS[datatype])
+            PostgreSQLDB.commit()
+        partitions = (
+            dataset.scan(root, datatype, ['season', 'gameType'], seasons, game_types)
+            .unique().sort(['season', 'gameType']).collect().rows()
+        )
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [
+                pool.submit(cls.load_partition, root, datatype, schema, season, game_type, batch_size, update)
+                for season, game_type in partitions
+            ]
+            return sum(f.result() for f in futures)
+
+    @classmethod
+    def process_time_fields(cls, df: pl.DataFrame, regex: str = r".*[tT]ime") -> pl.LazyFrame:
+        # "MM:SS" -> integer seconds into the period, every field in one pass
         df = df.lazy()
-        fields = [f for f in df.collect_schema().names() if re.match(regex, f)]
-        for field in fields:
-            column = df.select([field]).with_columns(
-                minute=pl.col(field).str.split(':').first().str.to_integer(),
-                second=pl.col(field).str.split(':').last().str.to_integer()
-            ).select(
-                field=pl.time(hour=pl.lit(0), minute=pl.col('minute'), second=pl.col('second'))
-            )
-            df = df.with_columns(**{field: column})
-        return df
-            
+        schema = df.collect_schema()
+        fields = [f for f in schema.names() if re.match(regex, f) and schema[f] == pl.String]
+        return df.with_columns(gametime.mmss_seconds(pl.col(f)).alias(f) for f in fields)
+
 
 def main():
     parser = ArgumentParser("upload csv")
     parser.add_argument('-t', '--time_fields', help="time fields (comma separated)")
     parser.add_argument('-p', '--pattern', help="filepattern")
-    parser.add_argument('-d', '--dir', help="input directory")
+    parser.add_argument('-d', '--dir', help="input directory (parquet dataset root from transform.py -f parquet)")
+    parser.add_argument('-T', '--tables', help="data types to load (comma separated)", default="games,rosters,plays,play_details,shifts")
+    parser.add_argument('-S', '--seasons', help="only these seasons, e.g. 20242025 (comma separated)")
+    parser.add_argument('-s', '--schema', help="column types", default=Path(Path(__file__).parent, 'schema.yml'))
+    parser.add_argument('-b', '--batch_size', help="rows per COPY batch", type=int, default=100_000)
+    parser.add_argument('-u', '--update', help="overwrite existing rows instead of skipping them", action="store_true")
+    parser.add_argument('-j', '--jobs', help="tables and partitions loaded in parallel", type=int, default=4)
     parser.add_argument('-H', '--host', help="postgres host", default='127.0.0.1')
     parser.add_argument('-P', '--port',  help="postgres port", default=5432)
     parser.add_argument('-D', '--db', help="database name", default="nhlxg")
@@ -163,7 +397,21 @@ def main():
     # df_gen = pl.scan_csv(args.dir, args.pattern, infer_schema_length=None, try_parse_dates=True).lazy()
     
     # df_gen = pl.read_csv(files[0], infer_schema_length=None, try_parse_dates=True).lazy()
-    # PostgreSQLDB.start(args.host, args.port, args.db, args.user, args.login)
+    logging.basicConfig(level=logging.INFO)
+    schemas = load_schema(args.schema, stored=True)
+    seasons = [int(s) for s in args.seasons.split(',')] if args.seasons else None
+    PostgreSQLDB.start(args.host, args.port, args.db, args.user, args.login, pool_size=args.jobs + 1)
+    try:
+        def load(datatype: str):
+            loaded = LoadFromLocal.load_dataset(args.dir, datatype, schemas[datatype], seasons,
+                                                batch_size=args.batch_size, update=args.update, jobs=args.jobs)
+            logger.info(f"{datatype}: {loaded} rows loaded")
+        # tables load side by side; the pool caps the number of connections in use
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            for future in [pool.submit(load, datatype) for datatype in args.tables.split(',')]:
+                future.result()
+    finally:
+        PostgreSQLDB.end()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,136 @@
+"""
+Parquet dataset written by transform.py -f parquet:
+
+<root>/<datatype>/season=20242025/gameType=2/<input file>.parquet
+
+datatype is one of games, plays, play_details, rosters, shifts (and strength,
+the timeline derived by strength.py). <root>/dimensions holds the keys and
+enum domains of dimensions.py. Column types come from schema.yml, "MM:SS"
+fields are stored as integer seconds and rows are sorted by game so row group
+statistics can skip whole games.
+
+Files named live_<gameId>_<ms>.parquet hold deltas appended by live.py while a
+game is in progress; they are removed once any other file of the partition
+has been written with that game.
+"""
+
+import os
+import polars as pl
+import pyarrow.parquet as pq
+from pathlib import Path
+from typing import Optional
+from schema import arrow_schema
+from gametime import mmss_seconds
+
+PARTITIONS = ['season', 'gameType']
+LIVE_PREFIX = 'live_'
+SORT_KEYS = {
+    'games': ['id'],
+    'plays': ['gameId', 'eventId'],
+    'play_details': ['gameId', 'eventId'],
+    'rosters': ['gameId', 'teamId', 'playerId'],
+    'shifts': ['gameId', 'teamId', 'playerId', 'startTime'],
+    'strength': ['gameId', 't0'],
+}
+
+
+def game_key(datatype: str) -> str:
+    return 'id' if datatype == 'games' else 'gameId'
+
+
+def season_of(game_id: pl.Expr) -> pl.Expr:
+    # 2024020861 -> 20242025
+    return ((game_id // 1_000_000) * 10_001 + 1).cast(pl.Int32)
+
+
+def game_type_of(game_id: pl.Expr) -> pl.Expr:
+    # 2024020861 -> 2
+    return ((game_id // 10_000) % 100).cast(pl.Int8)
+
+
+def stored_schema(schema: pl.Schema, time_fields: list[str]) -> pl.Schema:
+    # partition columns live in the directory names, not in the files
+    return pl.Schema({
+        field: pl.Int32 if field in time_fields else dtype
+        for field, dtype in schema.items()
+        if field not in PARTITIONS
+    })
+
+
+class DatasetWriter:
+    """
+    Writes frames of one datatype into the partitioned dataset, one parquet
+    file per partition named after `name`. Files are written under a temporary
+    name and only renamed into place by close().
+    """
+    def __init__(self, root: str, datatype: str, name: str, schema: pl.Schema, time_fields: list[str],
+                 compression: str = 'zstd'):
+        self.root = Path(root, datatype)
+        self.datatype = datatype
+        self.name = name
+        self.schema = schema
+        self.time_fields = time_fields
+        self.stored = stored_schema(schema, time_fields)
+        self.arrow = arrow_schema(self.stored)
+        self.compression = compression
+        self.writers: dict[tuple, tuple[Path, pq.ParquetWriter]] = {}
+        self.games: dict[tuple, set[int]] = {}
+
+    def to_stored(self, df: pl.DataFrame) -> pl.DataFrame:
+        key = pl.col(game_key(self.datatype))
+        return df.cast(self.schema, strict=False).with_columns(
+            *[mmss_seconds(pl.col(f)).alias(f) for f in self.time_fields],
+            season=season_of(key),
+            gameType=game_type_of(key),
+        )
+
+    def write(self, df: pl.DataFrame):
+        if df.is_empty():
+            return
+        keys = SORT_KEYS.get(self.datatype, [game_key(self.datatype)])
+        parts = self.to_stored(df).partition_by(PARTITIONS, as_dict=True, include_key=False)
+        for (season, game_type), part in parts.items():
+            if (season, game_type) not in self.writers:
+                outdir = Path(self.root, f"season={season}", f"gameType={game_type}")
+                outdir.mkdir(parents=True, exist_ok=True)
+                tmp = Path(outdir, f".{self.name}.parquet.tmp")
+                self.writers[(season, game_type)] = (tmp, pq.ParquetWriter(tmp, self.arrow, compression=self.compression))
+            _, writer = self.writers[(season, game_type)]
+            self.games.setdefault((season, game_type), set()).update(part[game_key(self.datatype)].to_list())
+            writer.write_table(part.select(self.stored.names()).sort(keys).to_arrow().cast(self.arrow))
+
+    def close(self) -> list[Path]:
+        written = []
+        for key, (tmp, writer) in self.writers.items():
+            writer.close()
+            outfile = Path(tmp.parent, f"{self.name}.parquet")
+            os.replace(tmp, outfile)
+            written.append(outfile)
+            if not self.name.startswith(LIVE_PREFIX):
+                self.drop_live(tmp.parent, self.games[key])
+        self.writers = {}
+        self.games = {}
+        return written
+
+    @staticmethod
+    def drop_live(outdir: Path, game_ids: set[int]):
+        # the complete game replaces the deltas polled while it was live
+        for fp in outdir.glob(f"{LIVE_PREFIX}*.parquet"):
+            if int(fp.stem.split('_')[1]) in game_ids:
+                fp.unlink(missing_ok=True)
+
+
+def scan(root: str, datatype: str, columns: Optional[list[str]] = None,
+         seasons: Optional[list[int]] = None, game_types: Optional[list[int]] = None) -> pl.LazyFrame:
+    """
+    lazy frame over one datatype; season/gameType filters prune whole directories
+    and other filters are pushed down to parquet row groups by polars
+    """
+    lf = pl.scan_parquet(Path(root, datatype, '**', '*.parquet'), hive_partitioning=True)
+    if seasons:
+        lf = lf.filter(pl.col('season').is_in(seasons))
+    if game_types:
+        lf = lf.filter(pl.col('gameType').is_in(game_types))
+    if columns:
+        lf = lf.select(columns)
+    return lf
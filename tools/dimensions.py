@@ -0,0 +1,246 @@
+"""
+Dimension tables of the parquet dataset: stable integer surrogate keys for
+games, teams and players, and ordered domains for the string columns with few
+values (event types, zones, shot types, positions, ...).
+
+<root>/dimensions/games.parquet     gameKey, gameId, season, gameType, homeTeamKey, awayTeamKey
+<root>/dimensions/teams.parquet     teamKey, teamId, firstSeason, lastSeason
+<root>/dimensions/players.parquet   playerKey, playerId, positionCode, teamKey, sweaterNumber, headshot
+                                    (from the latest roster spot, null for players without one)
+<root>/dimensions/enums.parquet     datatype, column, code, value
+
+Dimensions only grow: a build keeps every key and code it already has and
+appends new ids (sorted) and values after them, so frames encoded against an
+earlier build mean the same after the next one. Keys are row numbers, which
+makes decoding a gather.
+
+dimensions.scan reads a datatype with its ids replaced by keys (gameId ->
+gameKey UInt32, teamId/eventOwnerTeamId/homeTeamId/awayTeamId -> ...Key UInt8,
+playerId/xPlayerId/goalieInNetId -> ...Key UInt16) and its domain columns cast
+to pl.Enum, whose physical codes are the stored codes, so season-scale plays
+and shifts hold and join on small integers only. Run a build after each
+transform; encoding an id the dimensions have not seen fails.
+"""
+import argparse
+import time
+import polars as pl
+from pathlib import Path
+from typing import Optional
+import dataset
+
+DIMENSIONS = 'dimensions'
+KEY_DTYPES = {'game': pl.UInt32, 'team': pl.UInt8, 'player': pl.UInt16}
+TEAM_COLUMNS = ['teamId', 'eventOwnerTeamId', 'homeTeamId', 'awayTeamId']
+# string columns stored as domains, per datatype
+ENUMS = {
+    'plays': ['periodType', 'situationCode', 'typeDescKey', 'homeTeamDefendingSide'],
+    'play_details': ['descKey', 'reason', 'secondaryReason', 'shotType', 'typeCode', 'zoneCode'],
+    'rosters': ['positionCode'],
+    'shifts': ['hexValue'],
+}
+ENUM_SCHEMA = {'datatype': pl.String, 'column': pl.String, 'code': pl.UInt32, 'value': pl.String}
+
+
+def key_column(column: str) -> str:
+    # shootingPlayerId -> shootingPlayerKey, id (games) -> gameKey
+    return 'gameKey' if column == 'id' else column.removesuffix('Id') + 'Key'
+
+
+def dimension_of(datatype: str, column: str) -> Optional[str]:
+    """
+    game, team or player for id columns, None otherwise
+    """
+    if column == dataset.game_key(datatype):
+        return 'game'
+    if column in TEAM_COLUMNS:
+        return 'team'
+    if column == 'playerId' or column.endswith('PlayerId') or column == 'goalieInNetId':
+        return 'player'
+    return None
+
+
+def extend(keys: pl.DataFrame, ids: pl.Series, name: str) -> pl.DataFrame:
+    """
+    key table (<name>Key, <name>Id) with the ids it does not have yet appended, in id order
+    """
+    key, id_col = f"{name}Key", f"{name}Id"
+    new = ids.drop_nulls().unique().sort()
+    new = new.filter(~new.is_in(keys[id_col].implode()))
+    dtype = KEY_DTYPES[name]
+    if keys.height + new.len() - 1 > pl.select(dtype.max()).item():
+        raise Exception(f"{keys.height + new.len()} {name}s do not fit {name}Key ({dtype})")
+    added = pl.DataFrame({key: pl.int_range(keys.height, keys.height + new.len(), eager=True), id_col: new})
+    return pl.concat([keys, added.cast({key: dtype, id_col: pl.Int64})])
+
+
+class Dimensions:
+    def __init__(self, games: pl.DataFrame, teams: pl.DataFrame, players: pl.DataFrame, enums: pl.DataFrame):
+        self.tables = {'game': games, 'team': teams, 'player': players}
+        self.enums = enums
+
+    @classmethod
+    def empty(cls) -> 'Dimensions':
+        keys = lambda name: pl.DataFrame(schema={f"{name}Key": KEY_DTYPES[name], f"{name}Id": pl.Int64})
+        return cls(keys('game'), keys('team'), keys('player'), pl.DataFrame(schema=ENUM_SCHEMA))
+
+    def keys(self, name: str) -> pl.DataFrame:
+        return self.tables[name].select(f"{name}Key", f"{name}Id")
+
+    def enum(self, datatype: str, column: str) -> pl.Enum:
+        values = self.enums.filter((pl.col('datatype') == datatype) & (pl.col('column') == column)).sort('code')
+        return pl.Enum(values['value'])
+
+    def encode_column(self, datatype: str, column: str) -> Optional[pl.Expr]:
+        if column in ENUMS.get(datatype, []):
+            return pl.col(column).cast(self.enum(datatype, column))
+        name = dimension_of(datatype, column)
+        if name is None:
+            return None
+        keys = self.keys(name)
+        return pl.col(column).replace_strict(keys[f"{name}Id"], keys[f"{name}Key"], return_dtype=KEY_DTYPES[name]) \
+            .alias(key_column(column))
+
+    def encode(self, lf: pl.LazyFrame, datatype: str) -> pl.LazyFrame:
+        """
+        ids -> keys (renamed ...Key) and domain columns -> pl.Enum
+        """
+        exprs = [self.encode_column(datatype, c) for c in lf.collect_schema().names()]
+        return lf.select(expr if expr is not None else pl.col(c) for c, expr in zip(lf.collect_schema().names(), exprs))
+
+    def decode(self, lf: pl.LazyFrame, datatype: str) -> pl.LazyFrame:
+        """
+        keys back to ids (columns named as in the dataset) and enums back to strings
+        """
+        exprs = []
+        for column, dtype in lf.collect_schema().items():
+            original = dataset.game_key(datatype) if column == 'gameKey' else column.removesuffix('Key') + 'Id'
+            name = dimension_of(datatype, original) if column.endswith('Key') else None
+            if isinstance(dtype, pl.Enum):
+                exprs.append(pl.col(column).cast(pl.String))
+            elif name is not None:
+                exprs.append(pl.lit(self.tables[name][f"{name}Id"]).gather(pl.col(column)).alias(original))
+            else:
+                exprs.append(pl.col(column))
+        return lf.select(exprs)
+
+    def write(self, root: str):
+        outdir = Path(root, DIMENSIONS)
+        outdir.mkdir(parents=True, exist_ok=True)
+        for fname, df in [*[(f"{name}s", df) for name, df in self.tables.items()], ('enums', self.enums)]:
+            tmp = Path(outdir, f".{fname}.parquet.tmp")
+            df.write_parquet(tmp)
+            tmp.replace(Path(outdir, f"{fname}.parquet"))
+
+
+def load(root: str) -> Dimensions:
+    outdir = Path(root, DIMENSIONS)
+    if not Path(outdir, 'enums.parquet').exists():
+        return Dimensions.empty()
+    read = lambda fname: pl.read_parquet(Path(outdir, f"{fname}.parquet"))
+    return Dimensions(read('games'), read('teams'), read('players'), read('enums'))
+
+
+def ids_of(root: str, datatype: str, name: str) -> pl.Series:
+    columns = [c for c in dataset.scan(root, datatype).collect_schema().names() if dimension_of(datatype, c) == name]
+    if not columns:
+        return pl.Series(dtype=pl.Int64)
+    return (
+        dataset.scan(root, datatype, columns)
+        .select(pl.concat_list(columns).explode().alias('id')).unique().collect()['id'].cast(pl.Int64)
+    )
+
+
+def build(root: str) -> Dimensions:
+    """
+    dimensions of every game, team, player and domain value in the dataset, extending the stored ones
+    """
+    current = load(root)
+    datatypes = [d for d in dataset.SORT_KEYS if any(Path(root, d).glob('**/*.parquet'))]
+    keys = {
+        name: extend(current.keys(name), pl.concat([ids_of(root, d, name) for d in datatypes]), name)
+        for name in current.tables
+    }
+    team_key = lambda c: pl.col(c).replace_strict(keys['team']['teamId'], keys['team']['teamKey'])
+
+    games = dataset.scan(root, 'games', ['id', 'season', 'gameType', 'homeTeamId', 'awayTeamId']).unique('id').collect()
+    games = keys['game'].join(
+        games.select(gameId='id', season='season', gameType='gameType',
+                     homeTeamKey=team_key('homeTeamId'), awayTeamKey=team_key('awayTeamId')),
+        on='gameId', how='left',
+    )
+    seasons = (
+        games.unpivot(['homeTeamKey', 'awayTeamKey'], index='season', value_name='teamKey')
+        .group_by('teamKey').agg(firstSeason=pl.col('season').min(), lastSeason=pl.col('season').max())
+    )
+    teams = keys['team'].join(seasons, on='teamKey', how='left')
+    latest = (
+        dataset.scan(root, 'rosters', ['gameId', 'teamId', 'playerId', 'positionCode', 'sweaterNumber', 'headshot'])
+        .sort('gameId').group_by('playerId').last().collect()
+        .select('playerId', 'positionCode', 'sweaterNumber', 'headshot', teamKey=team_key('teamId'))
+    )
+    players = keys['player'].join(latest, on='playerId', how='left')
+
+    enums = [current.enums]
+    for datatype, columns in ENUMS.items():
+        if datatype not in datatypes:
+            continue
+        values = dataset.scan(root, datatype, columns).select(pl.col(columns).unique().implode()).collect()
+        for column in columns:
+            known = current.enums.filter((pl.col('datatype') == datatype) & (pl.col('column') == column))
+            new = values[column].explode().drop_nulls().sort()
+            new = new.filter(~new.is_in(known['value'].implode()))
+            enums.append(pl.DataFrame({
+                'datatype': datatype, 'column': column,
+                'code': pl.int_range(known.height, known.height + new.len(), eager=True), 'value': new,
+            }, schema=ENUM_SCHEMA))
+    dims = Dimensions(games, teams, players, pl.concat(enums))
+    dims.write(root)
+    return dims
+
+
+def scan(root: str, datatype: str, columns: Optional[list[str]] = None,
+         seasons: Optional[list[int]] = None, game_types: Optional[list[int]] = None,
+         dims: Optional[Dimensions] = None) -> pl.LazyFrame:
+    """
+    dataset.scan with ids as keys and domain columns as enums
+    """
+    return (dims or load(root)).encode(dataset.scan(root, datatype, columns, seasons, game_types), datatype)
+
+
+def report(root: str, dims: Dimensions, seasons: list[int] = None):
+    for datatype in ['plays', 'play_details', 'rosters', 'shifts']:
+        plain = dataset.scan(root, datatype, seasons=seasons).collect()
+        encoded = dims.encode(plain.lazy(), datatype).collect()
+        print(f"{datatype:14} {plain.height:9} rows {plain.estimated_size('mb'):8.1f}MB -> {encoded.estimated_size('mb'):6.1f}MB")
+
+    # the attribution join of onice/stats: every shift with its roster spot
+    for label, keys, read in [
+        ('ids', ['gameId', 'teamId', 'playerId'], lambda d, c: dataset.scan(root, d, c, seasons)),
+        ('keys', ['gameKey', 'teamKey', 'playerKey'], lambda d, c: scan(root, d, c, seasons, dims=dims)),
+    ]:
+        shifts = read('shifts', ['gameId', 'teamId', 'playerId', 'startTime', 'endTime']).collect()
+        rosters = read('rosters', ['gameId', 'teamId', 'playerId', 'positionCode']).collect()
+        start = time.perf_counter()
+        for _ in range(5):
+            shifts.join(rosters, on=keys, how='left')
+        print(f"shifts x rosters on {label:4} {(time.perf_counter() - start) / 5 * 1000:8.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser("dimension tables")
+    parser.add_argument('-d', '--dir', help='parquet dataset root', required=True)
+    parser.add_argument('-S', '--seasons', help='seasons for --report (comma separated)')
+    parser.add_argument('--report', help='memory and join time of encoded facts', default=False, action='store_true')
+    args = parser.parse_args()
+    seasons = [int(s) for s in args.seasons.split(',')] if args.seasons else None
+
+    start = time.perf_counter()
+    dims = build(args.dir)
+    sizes = ', '.join(f"{df.height} {name}s" for name, df in dims.tables.items())
+    print(f"{sizes}, {dims.enums.height} enum values in {time.perf_counter() - start:.2f}s")
+    if args.report:
+        report(args.dir, dims, seasons)
+
+
+if __name__ == "__main__":
+    main()
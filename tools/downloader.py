@@ -5,13 +5,17 @@ import time
 import logging
 import datetime as dt
 import json
+import os
 import requests
 import traceback
+from archive import Archive, SUFFIX
+from fetcher import FetchEngine
 from logger import Logger
+from manifest import Manifest
 from pathlib import Path
 
 APP_NAME = "nhlgamedata"
-RETRY_THRESHOLD = 100
+WEEK_RETRIES = 5
 
 def parse_date(val: str, default_mm_dd) -> tuple[str, dt.date, bool]:
     def strptime(dstr: str):
@@ -30,6 +34,14 @@ def tui():
     parser.add_argument("-post", help="include postseason", action="store_true")
     parser.add_argument("-noreg", help="exclude regular season", default=False, action="store_false")
     parser.add_argument("-out", help="output directory", default="./data_json")
+    parser.add_argument("-jobs", help="concurrent requests", type=int, default=4)
+    parser.add_argument("-rate", help="max requests per second", type=float, default=2.0)
+    parser.add_argument("-retries", help="retries of a failed request, with exponential backoff", type=int, default=5)
+    parser.add_argument("-cache", help="response cache directory", default="./.nhl_cache")
+    parser.add_argument("-cachesize", help="response cache size limit in MB", type=int, default=4096)
+    parser.add_argument("-nocache", help="always hit the api", action="store_true")
+    parser.add_argument("-archive", help=f"append games to a compressed raw*{SUFFIX} archive instead of weekly json files",
+                        action="store_true")
     _args = parser.parse_args()
     print(APP_NAME)
     args = { 'gametype_filter': [ ] }
@@ -40,6 +52,12 @@ def tui():
     if not _args.noreg:
         args['gametype_filter'].append(2)
     args['outdir'] = _args.out
+    args['jobs'] = _args.jobs
+    args['rate'] = _args.rate
+    args['retries'] = _args.retries
+    args['cache_dir'] = None if _args.nocache else _args.cache
+    args['cache_mb'] = _args.cachesize
+    args['archive'] = _args.archive
 
     args['from_date'] = input("from year OR date (YYYY-MM-DD) [default: 2024]: ", ) or "2024"
     args['to_date'] = input("from year OR date (YYYY-MM-DD) [default: 2025]: ", ) or "2025"
@@ -67,8 +85,12 @@ def get_games(schedule: dict, upto: dt.datetime, team_filter: set[str], gametype
         if get_game_if(day, game)
     ] , fmt_date(min(upto, end_week))
 
-def main(gametype_filter: list[int], from_date: str, to_date: str, team_filter: list[str], outdir: str):
-    RETRY = 0
+def main(gametype_filter: list[int], from_date: str, to_date: str, team_filter: list[str], outdir: str,
+         jobs: int = 4, rate: float = 2.0, cache_dir: str | None = None, cache_mb: int = 4096, retries: int = 5,
+         archive: bool = False):
+    engine = FetchEngine(workers=jobs, rate=rate, burst=jobs, retries=retries)
+    if cache_dir:
+        nhl_api.use_cache(cache_dir, cache_mb * 1024 ** 2)
     team_filter_comb = '' if not team_filter else f"_{'_'.join(team_filter)}"
     type_filter_comb = f"_{'t'.join([str(s) for s in gametype_filter])}"
     gametype_filter = set(gametype_filter)
@@ -82,53 +104,122 @@ def main(gametype_filter: list[int], from_date: str, to_date: str, team_filter:
     if end_whole_year:
         end_str, end = postend, parse_date(postend, 'invalid')[1]
     logging.info(f"From {start_str} to {end_str}")
-    while start < end and RETRY < RETRY_THRESHOLD:
-        playbyplays = []
-        rosters = []
-        shifts = []
-        games = []
+    manifest = Manifest(Path(outdir, f"manifest{type_filter_comb}{team_filter_comb}.jsonl"))
+    staging = Path(outdir, '.staging')
+    staging.mkdir(parents=True, exist_ok=True)
+    # one record per game, written as soon as it is fetched; no staging or weekly files needed
+    store = Archive(Path(outdir, f"raw{type_filter_comb}{team_filter_comb}{SUFFIX}"), 'a') if archive else None
+
+    def write_to(fp: Path, data: any):
+        tmp = fp.with_suffix('.tmp')
+        with open(tmp, '+w') as file:
+            json.dump(data, file)
+        os.replace(tmp, fp)
+
+    def read_from(fp: Path):
+        with open(fp, 'r') as file:
+            return json.load(file)
+
+    attempts = 0
+    while start < end:
         date = fmt_date(start)
-        RETRY += 1
+        if manifest.week_done(date):
+            Logger.info(f"DATE {date} already complete")
+            start += dt.timedelta(days=7)
+            continue
         try:
             sched = nhl_api.get_schedule(date)
             games, enddate = get_games(sched, end, team_filter, gametype_filter)
             Logger.info(f"DATE {date}")
-        
+
             game_ids = [g.get('id') for g in games]
-            for idx, gid in enumerate(game_ids):
-                Logger.info(f"Requesting for game details {gid} [{idx}/{len(game_ids)}]")
-                pbp = nhl_api.get_play_by_play(gid)
-                Logger.info(f"Requesting for game shifts {gid} [{idx}/{len(game_ids)}]")
-                shiftcharts = nhl_api.get_shiftcharts(gid)
-                plays = [
-                    {**p, 'gameId': gid}
-                    for p in pbp.get('plays')
-                ]
-                playbyplays.extend(plays)
-                ros = [
-                    {**p, 'gameId': gid}
-                    for p in pbp.get('rosterSpots')
-                ]
-                rosters.extend(ros)
-                shifts.extend(shiftcharts.get('data'))
+            # finished games from an earlier (possibly interrupted) run are already staged or archived
+            todo = [
+                gid for gid in game_ids
+                if not (manifest.is_final(gid) and (
+                    gid in store if store is not None else Path(staging, f"{gid}.json").exists()
+                ))
+            ]
+            Logger.info(f"Requesting details and shifts for {len(todo)} of {len(game_ids)} games")
+            fetched = {}
+            scheduled = {g.get('id'): g for g in games}
+            for gid, pbp, shiftcharts in engine.fetch_games(todo):
+                state = pbp.get('gameState')
+                if store is not None:
+                    store.append(gid, {
+                        'game': scheduled[gid],
+                        'plays': pbp.get('plays'),
+                        'rosters': pbp.get('rosterSpots'),
+                        'shifts': shiftcharts.get('data'),
+                    })
+                    store.flush()
+                    manifest.record_game(gid, state, date)
+                    continue
+                fetched[gid] = {
+                    'plays': [
+                        {**p, 'gameId': gid}
+                        for p in pbp.get('plays')
+                    ],
+                    'rosters': [
+                        {**p, 'gameId': gid}
+                        for p in pbp.get('rosterSpots')
+                    ],
+                    'shifts': shiftcharts.get('data'),
+                }
+                if state in nhl_api.FINAL_STATES:
+                    write_to(Path(staging, f"{gid}.json"), fetched[gid])
+                manifest.record_game(gid, state, date)
+            dead = [gid for gid in todo if gid in engine.dead_letter]
+            for gid in dead:
+                manifest.record_dead(gid, date, engine.dead_letter[gid])
+
+            if store is None:
+                Logger.info("saving results")
+                playbyplays, rosters, shifts = [], [], []
+                for gid in game_ids:
+                    if gid in dead:
+                        continue
+                    game = fetched.get(gid) or read_from(Path(staging, f"{gid}.json"))
+                    playbyplays.extend(game['plays'])
+                    rosters.extend(game['rosters'])
+                    shifts.extend(game['shifts'])
+                for datatype, data in [('rosters', rosters), ('games', games), ('playbyplays', playbyplays), ('shifts', shifts)]:
+                    if data:
+                        write_to(Path(outdir, f"{datatype}_{date}_{enddate}{type_filter_comb}{team_filter_comb}.json"), data)
+                    else:
+                        Logger.info(f"no data in {datatype}")
 
+            # a week with dead letters stays incomplete, so the next run fetches those games again
+            complete = not dead and all(manifest.is_final(gid) for gid in game_ids)
+            manifest.record_week(date, enddate, game_ids, complete)
+            if complete:
+                for gid in game_ids:
+                    Path(staging, f"{gid}.json").unlink(missing_ok=True)
             start += dt.timedelta(days=7)
+            attempts = 0
         except Exception as e:
+            # nothing partial is written; the week is retried and resumes from staging
             Logger.error(f"{e}\n{traceback.format_exc()}")
-        finally:
-            Logger.info("saving results")
-            def write_to(datatype: str, data: any):
-                if data:
-                    with open(Path(outdir, f"{datatype}_{date}_{enddate}{type_filter_comb}{team_filter_comb}.json"), '+w') as file:
-                        json.dump(data, file)
-                else:
-                    Logger.info(f"no data in {datatype}")
-
-            write_to('rosters', rosters)
-            write_to('games', games)
-            write_to('playbyplays', playbyplays)
-            write_to('shifts', shifts)
-    
+            attempts += 1
+            if attempts >= WEEK_RETRIES:
+                Logger.error(f"DATE {date} failed {attempts} times, skipped until the next run")
+                start += dt.timedelta(days=7)
+                attempts = 0
+            else:
+                time.sleep(max(nhl_api.RETRY.delay(attempts), nhl_api.open_for()))
+    dead_letters = manifest.dead_letters()
+    if dead_letters:
+        Logger.warning(f"{len(dead_letters)} games in the dead letter list, rerun to fetch them: {sorted(dead_letters)}")
+    manifest.close()
+    engine.shutdown()
+    if store is not None:
+        Logger.info(f"archive {store.path} {store.stats()}")
+        store.close()
+    for endpoint, metrics in nhl_api.METRICS.summary().items():
+        Logger.info(f"{endpoint} {metrics}")
+    if nhl_api.CACHE:
+        Logger.info(f"cache {nhl_api.CACHE.stats()}")
+
 
 if __name__ == '__main__':
     args = tui()
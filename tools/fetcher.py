@@ -0,0 +1,54 @@
+import nhl_api
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+from logger import Logger
+
+
+class FetchEngine:
+    """
+    Downloads play-by-play and shift charts for many games at once.
+    All requests go through nhl_api's shared session and token bucket,
+    so `workers` bounds concurrency while `rate` bounds requests per second.
+    Games whose requests fail for good are skipped and collected in `dead_letter`.
+    """
+    def __init__(self, workers: int = 4, rate: float = 2.0, burst: int = 2, retries: int = 5):
+        self.workers = workers
+        nhl_api.configure(rate=rate, burst=burst, pool_size=workers, retries=retries)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch")
+        self.dead_letter: dict[int, str] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def fetch_game(game_id: int) -> tuple[dict, dict]:
+        # shift charts of a finished game can be cached for good
+        pbp = nhl_api.get_play_by_play(game_id)
+        final = pbp.get('gameState') in nhl_api.FINAL_STATES
+        return pbp, nhl_api.get_shiftcharts(game_id, final=final)
+
+    def fetch_games(self, game_ids: Iterable[int]) -> Iterator[tuple[int, dict, dict]]:
+        """
+        yields (game_id, play_by_play, shiftcharts) in the order of `game_ids`,
+        leaving out the games that went to `dead_letter`
+        """
+        pending = [
+            (gid, self.pool.submit(self.fetch_game, gid))
+            for gid in game_ids
+        ]
+        for idx, (gid, future) in enumerate(pending):
+            try:
+                result = gid, *future.result()
+            except nhl_api.FetchError as e:
+                Logger.error(f"Dead letter game {gid} [{idx}/{len(pending)}]: {e}")
+                self.dead_letter[gid] = str(e)
+                continue
+            self.dead_letter.pop(gid, None)
+            Logger.info(f"Received game {gid} [{idx}/{len(pending)}]")
+            yield result
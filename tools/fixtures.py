@@ -0,0 +1,207 @@
+"""
+Synthetic api fixtures for the stub server (stubserver.py) and the benchmarks
+(bench.py): a season of `games_per_team` games for each of `teams` teams, laid
+out like the recorded responses
+
+<root>/schedule/<week start>.json      every week from START to the end of the season
+<root>/gamecenter/<gameId>/play-by-play.json
+<root>/shiftcharts/<gameId>.json
+
+Games are final, have about 300 plays and 830 shifts like a regular season
+game, and are generated from `seed` so every run sees the same data.
+"""
+import argparse
+import datetime as dt
+import json
+import random
+from pathlib import Path
+
+SEASON = 2024
+START = dt.date(2024, 10, 8)
+PERIOD = 20 * 60
+EVENTS = [
+    # typeDescKey, typeCode, weight per game
+    ('faceoff', 502, 60), ('hit', 503, 45), ('giveaway', 504, 15), ('goal', 505, 6),
+    ('shot-on-goal', 506, 58), ('missed-shot', 507, 25), ('blocked-shot', 508, 30),
+    ('penalty', 509, 8), ('stoppage', 516, 40), ('takeaway', 525, 12),
+]
+SITUATIONS = ['1551'] * 16 + ['1451', '1541', '0651', '1560']
+SHOT_TYPES = ['wrist', 'snap', 'slap', 'backhand', 'tip-in', 'deflected']
+
+
+def roster(team: int) -> list[dict]:
+    # 12 forwards, 6 defence, 2 goalies; player ids are stable per team
+    positions = ['C'] * 4 + ['L'] * 4 + ['R'] * 4 + ['D'] * 6 + ['G'] * 2
+    return [
+        {'teamId': team, 'playerId': 8_470_000 + team * 100 + i, 'sweaterNumber': i + 2, 'positionCode': pos,
+         'headshot': f"https://assets.nhle.com/mugs/nhl/{SEASON}{SEASON + 1}/{team}/{8_470_000 + team * 100 + i}.png",
+         'firstName': {'default': f"First{i}"}, 'lastName': {'default': f"Team{team}"}}
+        for i, pos in enumerate(positions)
+    ]
+
+
+def clock(seconds: int) -> str:
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+
+def shifts(rng: random.Random, game_id: int, team: int, players: list[dict], next_id: int) -> list[dict]:
+    forwards = [p['playerId'] for p in players if p['positionCode'] in 'CLR']
+    defence = [p['playerId'] for p in players if p['positionCode'] == 'D']
+    goalie = next(p['playerId'] for p in players if p['positionCode'] == 'G')
+    rows = []
+
+    def shift(player: int, period: int, t0: int, t1: int, number: int):
+        rows.append({
+            'id': next_id + len(rows), 'gameId': game_id, 'teamId': team, 'playerId': player, 'period': period,
+            'startTime': clock(t0), 'endTime': clock(t1), 'duration': clock(t1 - t0), 'shiftNumber': number,
+            'typeCode': 517, 'detailCode': 0, 'eventNumber': None, 'eventDetails': None, 'hexValue': '#000000',
+            'firstName': 'First', 'lastName': f"Team{team}", 'teamAbbrev': f"T{team:02d}",
+        })
+
+    numbers = {}
+    for period in (1, 2, 3):
+        shift(goalie, period, 0, PERIOD, period)
+        # forward lines and defence pairs change independently
+        for units, size in [(forwards, 3), (defence, 2)]:
+            t, line = 0, 0
+            while t < PERIOD:
+                t1 = min(PERIOD, t + rng.randint(35, 55))
+                start = (line % (len(units) // size)) * size
+                for player in units[start:start + size]:
+                    numbers[player] = numbers.get(player, 0) + 1
+                    shift(player, period, t, t1, numbers[player])
+                t, line = t1, line + 1
+    return rows
+
+
+def plays(rng: random.Random, home: int, away: int, players: dict[int, list[dict]]) -> list[dict]:
+    kinds = [(key, code) for key, code, weight in EVENTS for _ in range(weight)]
+    times = sorted((rng.randint(1, 3), rng.randint(0, PERIOD - 1)) for _ in range(len(kinds)))
+    rng.shuffle(kinds)
+    skaters = {team: [p['playerId'] for p in spots if p['positionCode'] != 'G'] for team, spots in players.items()}
+    goalies = {team: next(p['playerId'] for p in spots if p['positionCode'] == 'G') for team, spots in players.items()}
+    score = {home: 0, away: 0}
+    result = []
+    for event_id, ((period, t), (key, code)) in enumerate(zip(times, kinds), start=1):
+        team = rng.choice((home, away))
+        opp = away if team == home else home
+        actor, other = rng.choice(skaters[team]), rng.choice(skaters[opp])
+        x, y = rng.randint(-99, 99), rng.randint(-42, 42)
+        details = {'eventOwnerTeamId': team, 'xCoord': x, 'yCoord': y, 'zoneCode': rng.choice('ODN')}
+        match key:
+            case 'faceoff':
+                details.update(winningPlayerId=actor, losingPlayerId=other)
+            case 'hit':
+                details.update(hittingPlayerId=actor, hitteePlayerId=other)
+            case 'giveaway' | 'takeaway':
+                details.update(playerId=actor)
+            case 'shot-on-goal':
+                details.update(shootingPlayerId=actor, goalieInNetId=goalies[opp], shotType=rng.choice(SHOT_TYPES),
+                               awaySOG=rng.randint(0, 40), homeSOG=rng.randint(0, 40))
+            case 'missed-shot':
+                details.update(shootingPlayerId=actor, goalieInNetId=goalies[opp], shotType=rng.choice(SHOT_TYPES),
+                               reason=rng.choice(['wide-of-net', 'high-and-wide', 'hit-crossbar']))
+            case 'blocked-shot':
+                details.update(shootingPlayerId=other, blockingPlayerId=actor, reason='blocked')
+            case 'goal':
+                score[team] += 1
+                details.update(scoringPlayerId=actor, scoringPlayerTotal=rng.randint(1, 30),
+                               assist1PlayerId=rng.choice(skaters[team]), assist1PlayerTotal=rng.randint(1, 40),
+                               goalieInNetId=goalies[opp], shotType=rng.choice(SHOT_TYPES),
+                               awayScore=score[away], homeScore=score[home],
+                               highlightClip=rng.randint(6_000_000_000_000, 6_400_000_000_000),
+                               highlightClipSharingUrl=f"https://nhl.com/video/goal-{event_id}")
+            case 'penalty':
+                details.update(committedByPlayerId=actor, drawnByPlayerId=other, duration=2,
+                               typeCode='MIN', descKey=rng.choice(['tripping', 'hooking', 'slashing', 'holding']))
+            case 'stoppage':
+                details = {'reason': rng.choice(['icing', 'offside', 'puck-in-netting', 'goalie-stopped-after-sog'])}
+        result.append({
+            'eventId': event_id,
+            'periodDescriptor': {'number': period, 'periodType': 'REG', 'maxRegulationPeriods': 3},
+            'timeInPeriod': clock(t), 'timeRemaining': clock(PERIOD - t),
+            'situationCode': rng.choice(SITUATIONS), 'homeTeamDefendingSide': 'left' if period % 2 else 'right',
+            'typeCode': code, 'typeDescKey': key, 'sortOrder': event_id * 10, 'details': details,
+        })
+    return result
+
+
+def schedule(games_per_team: int, teams: int, seed: int) -> list[tuple[int, int, int, dt.date]]:
+    """
+    (gameId, home, away, date) for a season where every team plays games_per_team games
+    """
+    rng = random.Random(seed)
+    slots = [team for team in range(1, teams + 1) for _ in range(games_per_team)]
+    rng.shuffle(slots)
+    total = len(slots) // 2
+    games = []
+    for n, i in enumerate(range(0, len(slots) - 1, 2), start=1):
+        home, away = slots[i], slots[i + 1]
+        if home == away:
+            away = home % teams + 1
+        # spread over a 26 week season
+        date = START + dt.timedelta(days=n * 26 * 7 // (total + 1))
+        games.append((SEASON * 1_000_000 + 20_000 + n, home, away, date))
+    return games
+
+
+def generate(root: str, games_per_team: int = 1, teams: int = 32, seed: int = 0) -> int:
+    root = Path(root)
+    games = schedule(games_per_team, teams, seed)
+    rosters = {team: roster(team) for team in range(1, teams + 1)}
+    shift_id = 1
+    weeks: dict[dt.date, list[dict]] = {}
+    for game_id, home, away, date in games:
+        rng = random.Random(seed * 1_000_003 + game_id)
+        entry = {
+            'id': game_id, 'season': SEASON * 10_001 + 1, 'gameType': 2, 'gameDate': date.isoformat(),
+            'startTimeUTC': f"{date.isoformat()}T23:00:00Z", 'venueTimezone': 'America/Toronto', 'gameState': 'OFF',
+            'awayTeam': {'id': away, 'abbrev': f"T{away:02d}"}, 'homeTeam': {'id': home, 'abbrev': f"T{home:02d}"},
+        }
+        # weeks as downloader.py walks them: START, START + 7 days, ...
+        week = START + dt.timedelta(days=(date - START).days // 7 * 7)
+        weeks.setdefault(week, []).append(entry)
+
+        pbp = {
+            **entry,
+            'plays': plays(rng, home, away, {home: rosters[home], away: rosters[away]}),
+            'rosterSpots': rosters[home] + rosters[away],
+        }
+        charts = []
+        for team in (home, away):
+            charts += shifts(rng, game_id, team, rosters[team], shift_id + len(charts))
+        shift_id += len(charts)
+        Path(root, 'gamecenter', str(game_id)).mkdir(parents=True, exist_ok=True)
+        Path(root, 'gamecenter', str(game_id), 'play-by-play.json').write_text(json.dumps(pbp))
+        Path(root, 'shiftcharts').mkdir(parents=True, exist_ok=True)
+        Path(root, 'shiftcharts', f"{game_id}.json").write_text(json.dumps({'data': charts, 'total': len(charts)}))
+
+    last = max(weeks) + dt.timedelta(days=7)
+    Path(root, 'schedule').mkdir(parents=True, exist_ok=True)
+    # weeks without games too (and the one after the last), so a download of the whole range finds every week
+    for k in range((last - START).days // 7 + 1):
+        week = START + dt.timedelta(days=7 * k)
+        days = {(week + dt.timedelta(days=d)).isoformat(): [] for d in range(7)}
+        for entry in weeks.get(week, []):
+            days[entry['gameDate']].append(entry)
+        Path(root, 'schedule', f"{week.isoformat()}.json").write_text(json.dumps({
+            'nextStartDate': (week + dt.timedelta(days=7)).isoformat(),
+            'preSeasonStartDate': START.isoformat(), 'regularSeasonStartDate': START.isoformat(),
+            'regularSeasonEndDate': last.isoformat(), 'playoffEndDate': last.isoformat(),
+            'gameWeek': [{'date': day, 'games': games} for day, games in sorted(days.items())],
+        }))
+    return len(games)
+
+
+def main():
+    parser = argparse.ArgumentParser("synthetic api fixtures")
+    parser.add_argument('-o', '--out', help='fixture directory', required=True)
+    parser.add_argument('-g', '--games', help='games per team', type=int, default=1)
+    parser.add_argument('-t', '--teams', help='teams', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(f"{generate(args.out, args.games, args.teams, args.seed)} games written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Game clock kernel: "MM:SS" period clocks and period numbers to integer game seconds
+as polars expressions, so whole columns are converted in one pass.
+
+Periods up to the regulation count last REG_DURATION; overtime periods last
+OT_DURATIONS[gameType]. Period p starts at
+
+    min(p - 1, REG_PERIODS) * REG_DURATION + max(p - 1 - REG_PERIODS, 0) * OT_DURATIONS[gameType]
+
+The per-row version in match_shifts (get_time_s) also added REG_PERIODS * REG_DURATION
+on top of (p - 1) overtime periods after the first overtime, so its times from the second
+overtime on are too late. `python gametime.py --bench` compares both paths.
+"""
+import argparse
+import datetime
+import random
+import time
+import polars as pl
+
+REG_DURATION = 20 * 60
+REG_PERIODS = 3
+# overtime length by game type: 2 regular season, 3 playoffs, 19/20 all-star
+OT_DURATIONS = {
+    2: 5 * 60,
+    3: 20 * 60,
+    19: 10 * 60,
+    20: 20 * 60,
+}
+DEFAULT_OT = OT_DURATIONS[2]
+
+
+def mmss_seconds(clock: pl.Expr) -> pl.Expr:
+    # "MM:SS" -> seconds; minutes may have any number of digits
+    return clock.str.head(-3).cast(pl.Int32) * 60 + clock.str.tail(2).cast(pl.Int32)
+
+
+def ot_duration(game_type: pl.Expr) -> pl.Expr:
+    return game_type.replace_strict(OT_DURATIONS, default=DEFAULT_OT, return_dtype=pl.Int32)
+
+
+def period_start(period: pl.Expr, game_type: pl.Expr, reg_periods: int = REG_PERIODS) -> pl.Expr:
+    elapsed = period.cast(pl.Int32) - 1
+    return (
+        pl.min_horizontal(elapsed, pl.lit(reg_periods, pl.Int32)) * REG_DURATION +
+        (elapsed - reg_periods).clip(lower_bound=0) * ot_duration(game_type)
+    )
+
+
+def game_seconds(period: pl.Expr, clock: pl.Expr, game_type: pl.Expr) -> pl.Expr:
+    # clock: integer seconds into the period
+    return period_start(period, game_type) + clock
+
+
+def absolute_times(frame: pl.DataFrame | pl.LazyFrame, fields: list[str], period: str = 'period',
+                   game_type: pl.Expr = pl.col('gameType')) -> pl.DataFrame | pl.LazyFrame:
+    """
+    replace each of fields (integer seconds or "MM:SS" into the period) by absolute game seconds
+    """
+    schema = frame.collect_schema()
+    clock = lambda f: mmss_seconds(pl.col(f)) if schema[f] == pl.String else pl.col(f)
+    return frame.with_columns(game_seconds(pl.col(period), clock(f), game_type).alias(f) for f in fields)
+
+
+def _per_row_time_s(period: int, max_regulation_periods: int, time_in_period: str, game_type: int) -> int:
+    # match_shifts get_time_s, kept as the reference for --bench
+    parts = [int(t) for t in time_in_period.split(':')]
+    t = datetime.time(hour=0, minute=parts[0], second=parts[1])
+    seconds = t.second + t.minute * 60
+    if period <= max_regulation_periods + 1:
+        return (period - 1) * REG_DURATION + seconds
+    return max_regulation_periods * REG_DURATION + (period - 1) * OT_DURATIONS[game_type] + seconds
+
+
+def _split_twice(df: pl.DataFrame, field: str) -> pl.DataFrame:
+    # LoadFromLocal.process_time_fields before this module, kept as the reference for --bench
+    return df.with_columns(
+        minute=pl.col(field).str.split(':').list.first().str.to_integer(),
+        second=pl.col(field).str.split(':').list.last().str.to_integer(),
+    ).select(pl.time(hour=pl.lit(0), minute=pl.col('minute'), second=pl.col('second')).alias(field))
+
+
+def bench(rows: int, seed: int = 0):
+    rng = random.Random(seed)
+    df = pl.DataFrame({
+        'period': [rng.choice([1, 1, 2, 2, 3, 3, 4]) for _ in range(rows)],
+        'gameType': [rng.choice([2, 2, 2, 3]) for _ in range(rows)],
+        'timeInPeriod': [f"{s // 60:02d}:{s % 60:02d}" for s in (rng.randrange(REG_DURATION) for _ in range(rows))],
+    })
+
+    start = time.perf_counter()
+    per_row = [
+        _per_row_time_s(p, REG_PERIODS, t, gt)
+        for p, gt, t in zip(df['period'].to_list(), df['gameType'].to_list(), df['timeInPeriod'].to_list())
+    ]
+    per_row_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _split_twice(df, 'timeInPeriod')
+    split_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    kernel = absolute_times(df, ['timeInPeriod'])['timeInPeriod']
+    kernel_s = time.perf_counter() - start
+
+    # up to the first overtime both paths must agree
+    same = kernel.to_list() == per_row
+    print(f"{rows} rows")
+    print(f"per row (datetime.time)      {per_row_s:8.3f}s")
+    print(f"split twice + pl.time        {split_s:8.3f}s  (period clock only)")
+    print(f"kernel                       {kernel_s:8.3f}s  {per_row_s / kernel_s:6.1f}x per row")
+    print(f"same result as per row: {same}")
+
+
+def main():
+    parser = argparse.ArgumentParser("game clock kernel")
+    parser.add_argument('--bench', help='compare the kernel with the per-row path', default=False, action='store_true')
+    parser.add_argument('-n', '--rows', help='rows to benchmark', type=int, default=1_000_000)
+    args = parser.parse_args()
+    if args.bench:
+        bench(args.rows)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Live game poller: follows the games in progress and appends what is new since
+the last poll to the parquet dataset (and the aggregate store, if any).
+
+Every tick reads score/now, then for each live game fetches play-by-play and
+shifts with conditional requests (a 304 costs nothing), keeps the plays whose
+eventId, the shifts whose id and the roster spots whose playerId were not
+ingested yet, and transforms only those into
+
+<root>/<datatype>/season=.../gameType=.../live_<gameId>_<ms>.parquet
+
+A game is polled until its gameState is final. When the weekly download of a
+game is transformed later, its live_ files are dropped by DatasetWriter.
+"""
+import argparse
+import json
+import os
+import time
+import traceback
+import polars as pl
+from pathlib import Path
+import dataset
+import nhl_api
+from aggregates import AggregateStore
+from logger import Logger
+from transform import transform_file
+
+# raw file kind -> datatypes transformed from it
+DATATYPES = {
+    'games': ['games'],
+    'playbyplays': ['plays', 'play_details'],
+    'rosters': ['rosters'],
+    'shifts': ['shifts'],
+}
+GAME_FIELDS = ['id', 'season', 'gameType', 'startTimeUTC', 'venueTimezone', 'awayTeam', 'homeTeam']
+
+
+def known(root: str, datatype: str, column: str, game_id: int) -> set:
+    """
+    values of `column` already stored for one game
+    """
+    if not any(Path(root, datatype).glob('**/*.parquet')):
+        return set()
+    key = pl.lit(game_id)
+    season, game_type = pl.select(dataset.season_of(key).alias('season'), dataset.game_type_of(key).alias('gameType')).row(0)
+    return set(
+        dataset.scan(root, datatype, list({dataset.game_key(datatype), column}), [season], [game_type])
+        .filter(pl.col(dataset.game_key(datatype)) == game_id)
+        .select(column).collect().to_series().to_list()
+    )
+
+
+class LiveGame:
+    def __init__(self, root: str, game_id: int):
+        self.id = game_id
+        self.stored = bool(known(root, 'games', 'id', game_id))
+        self.events = known(root, 'plays', 'eventId', game_id)
+        self.shifts = known(root, 'shifts', 'id', game_id)
+        self.players = known(root, 'rosters', 'playerId', game_id)
+        self.state = None
+
+    def new_plays(self, pbp: dict) -> tuple[list[dict], list[dict]]:
+        plays = [{**p, 'gameId': self.id} for p in pbp.get('plays', []) if p['eventId'] not in self.events]
+        rosters = [{**p, 'gameId': self.id} for p in pbp.get('rosterSpots', []) if p['playerId'] not in self.players]
+        return plays, rosters
+
+    def new_shifts(self, shiftcharts: dict) -> list[dict]:
+        # a shift is only listed once it has ended, so its row does not change afterwards
+        return [s for s in shiftcharts.get('data', []) if s['id'] not in self.shifts and s.get('endTime')]
+
+
+class LivePoller:
+    """
+    poller = LivePoller('./data/dataset', config_fp, schema_fp, store='./data/aggregates')
+    poller.run(interval=30)
+    """
+    def __init__(self, root: str, config_fp: str, schema_fp: str, spool: str = None, store: str = None):
+        self.root = root
+        self.config_fp = config_fp
+        self.schema_fp = schema_fp
+        self.spool = Path(spool or Path(root, '.live'))
+        self.store = AggregateStore(store) if store else None
+        self.games: dict[int, LiveGame] = {}
+
+    def ingest(self, kind: str, game_id: int, records: list[dict]) -> list[Path]:
+        if not records:
+            return []
+        infile = Path(self.spool, kind, f"{dataset.LIVE_PREFIX}{game_id}_{time.time_ns() // 1_000_000}.json")
+        infile.parent.mkdir(parents=True, exist_ok=True)
+        tmp = infile.with_suffix('.tmp')
+        with open(tmp, 'w') as file:
+            json.dump(records, file)
+        os.replace(tmp, infile)
+        written = [
+            fp
+            for datatype in DATATYPES[kind]
+            for fp in transform_file(infile, self.root, datatype, self.config_fp, self.schema_fp,
+                                     mode='columnar', fmt='parquet')
+        ]
+        infile.unlink()
+        return written
+
+    def poll_game(self, game: LiveGame, score: dict) -> int:
+        """
+        fetches one game and ingests what is new, returns the number of new rows
+        """
+        if not game.stored:
+            self.ingest('games', game.id, [{key: score.get(key) for key in GAME_FIELDS}])
+            game.stored = True
+
+        rows = 0
+        pbp, changed = nhl_api.get_live_play_by_play(game.id)
+        if changed:
+            plays, rosters = game.new_plays(pbp)
+            self.ingest('rosters', game.id, rosters)
+            self.ingest('playbyplays', game.id, plays)
+            game.players.update(p['playerId'] for p in rosters)
+            game.events.update(p['eventId'] for p in plays)
+            rows += len(plays) + len(rosters)
+
+        shiftcharts, changed = nhl_api.get_live_shiftcharts(game.id)
+        if changed:
+            shifts = game.new_shifts(shiftcharts)
+            self.ingest('shifts', game.id, shifts)
+            game.shifts.update(s['id'] for s in shifts)
+            rows += len(shifts)
+        game.state = pbp.get('gameState')
+        return rows
+
+    def tick(self) -> int:
+        scores, _ = nhl_api.get_live_scores()
+        listed = {g['id']: g for g in scores.get('games', [])}
+        for gid, score in listed.items():
+            if score.get('gameState') in nhl_api.LIVE_STATES and gid not in self.games:
+                Logger.info(f"live: following {gid}")
+                self.games[gid] = LiveGame(self.root, gid)
+
+        rows = 0
+        # followed games are polled until final, so the last events are picked up after they leave LIVE
+        for gid, game in list(self.games.items()):
+            try:
+                new = self.poll_game(game, listed.get(gid, {'id': gid}))
+            except Exception as e:
+                Logger.warning(f"live: {gid} poll failed, retrying next tick: {e}")
+                continue
+            rows += new
+            if new:
+                Logger.info(f"live: {gid} {game.state} +{new} rows")
+            if game.state in nhl_api.FINAL_STATES:
+                Logger.info(f"live: {gid} is final")
+                del self.games[gid]
+        if rows and self.store:
+            self.store.refresh(self.root)
+        return rows
+
+    def run(self, interval: float = 30, iterations: int = None):
+        n = 0
+        failures = 0
+        while iterations is None or n < iterations:
+            start = time.monotonic()
+            try:
+                self.tick()
+                failures = 0
+            except Exception as e:
+                # e.g. score/now unreachable; the followed games are polled again next tick
+                failures += 1
+                Logger.error(f"live: tick failed ({failures} in a row): {e}\n{traceback.format_exc()}")
+            n += 1
+            if iterations is None or n < iterations:
+                wait = interval - (time.monotonic() - start)
+                if failures:
+                    wait = max(wait, nhl_api.RETRY.delay(failures), nhl_api.open_for())
+                time.sleep(max(0.0, wait))
+        if self.store:
+            self.store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser("live game poller")
+    parser.add_argument('-d', '--dir', help='parquet dataset root', required=True)
+    parser.add_argument('-c', '--config', help='config file with mapping', default=Path(Path(__file__).parent, 'config.yml'))
+    parser.add_argument('-s', '--schema', help='column types of each ruleset', default=Path(Path(__file__).parent, 'schema.yml'))
+    parser.add_argument('-a', '--aggregates', help='aggregate store to keep up to date')
+    parser.add_argument('--spool', help='directory for the raw deltas while they are transformed')
+    parser.add_argument('-i', '--interval', help='seconds between polls', type=float, default=30)
+    parser.add_argument('-n', '--iterations', help='stop after this many polls', type=int)
+    args = parser.parse_args()
+    nhl_api.configure()
+    poller = LivePoller(args.dir, args.config, args.schema, args.spool, args.aggregates)
+    poller.run(args.interval, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
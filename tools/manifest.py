@@ -0,0 +1,70 @@
+import json
+import os
+import time
+from pathlib import Path
+from nhl_api import FINAL_STATES
+
+
+class Manifest:
+    """
+    Append-only record of what the downloader has ingested, one json object per line.
+    Later lines win, and a torn last line from a crash is ignored on load.
+
+    {"kind": "game", "gameId": 2024020861, "gameState": "OFF", "week": "2025-01-27", ...}
+    {"kind": "week", "week": "2025-01-27", "enddate": "2025-02-03", "gameIds": [...], "complete": true, ...}
+    {"kind": "dead", "gameId": 2024020861, "week": "2025-01-27", "error": "...", ...}
+    """
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.games: dict[int, dict] = {}
+        self.weeks: dict[str, dict] = {}
+        self.dead: dict[int, dict] = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._apply(record)
+        self.file = open(self.path, 'a')
+
+    def _apply(self, record: dict):
+        match record.get('kind'):
+            case 'game':
+                self.games[record['gameId']] = record
+                self.dead.pop(record['gameId'], None)
+            case 'dead':
+                self.dead[record['gameId']] = record
+            case 'week':
+                self.weeks[record['week']] = record
+
+    def _append(self, record: dict):
+        record['time'] = time.time()
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._apply(record)
+
+    def record_game(self, game_id: int, state: str, week: str):
+        self._append({'kind': 'game', 'gameId': game_id, 'gameState': state, 'week': week})
+
+    def record_week(self, week: str, enddate: str, game_ids: list[int], complete: bool):
+        self._append({'kind': 'week', 'week': week, 'enddate': enddate, 'gameIds': game_ids, 'complete': complete})
+
+    def record_dead(self, game_id: int, week: str, error: str):
+        # a game whose fetch failed for good; it leaves the list once it is recorded again
+        self._append({'kind': 'dead', 'gameId': game_id, 'week': week, 'error': error})
+
+    def dead_letters(self) -> dict[int, dict]:
+        return dict(self.dead)
+
+    def is_final(self, game_id: int) -> bool:
+        return self.games.get(game_id, {}).get('gameState') in FINAL_STATES
+
+    def week_done(self, week: str) -> bool:
+        record = self.weeks.get(week)
+        return bool(record and record['complete'] and all(self.is_final(gid) for gid in record['gameIds']))
+
+    def close(self):
+        self.file.close()
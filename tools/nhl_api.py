@@ -1,37 +1,344 @@
+import email.utils
 import logging
+import os
+import random
+import re
+import threading
 import time
 import requests
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from typing import Callable, Optional
+from urllib.parse import urlencode, urlparse
+from cache import ResponseCache
 
-ENV = "PROD"
+ENV = os.environ.get("NHL_ENV", "PROD")
+LOCAL = os.environ.get("NHL_LOCAL_URL", "http://localhost:8000/")
 
-APIWEB = "https://api-web.nhle.com/v1/" if ENV == 'PROD' else "localhost:8000/"
-API = "https://api.nhle.com/stats/rest/en/" if ENV == 'PROD' else "localhost:8000/"
+APIWEB = "https://api-web.nhle.com/v1/" if ENV == 'PROD' else LOCAL
+API = "https://api.nhle.com/stats/rest/en/" if ENV == 'PROD' else LOCAL
 
-def fetch_data(url: str, params: map = {}, auto_retry: bool = True, retry_buffer: int=5):
+FINAL_STATES = {'OFF', 'FINAL'}
+LIVE_TTL = 60
+SCHEDULE_TTL = 6 * 3600
+# statuses worth another attempt; anything else in 4xx is the request's fault
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:135.0) Gecko/20100101 Firefox/135.0",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    'Referer': 'https://www.nhl.com/',
+}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` tokens per second, up to `capacity` banked
+    """
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int = 1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class FetchError(Exception):
+    def __init__(self, url: str, reason: str, status: Optional[int] = None):
+        super().__init__(f"Error GET[{url}]: {reason}")
+        self.url = url
+        self.status = status
+
+
+class CircuitOpenError(FetchError):
+    def __init__(self, url: str, retry_in: float):
+        super().__init__(url, f"circuit open for {retry_in:.0f}s more")
+        self.retry_in = retry_in
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: the n-th retry waits a random time in
+    [0, min(cap, base * 2^n)], or what the server asked for in Retry-After.
+    """
+    def __init__(self, attempts: int = 5, base: float = 1.0, cap: float = 60.0):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, retry: int, retry_after: Optional[str] = None) -> float:
+        asked = parse_retry_after(retry_after)
+        if asked is not None:
+            return min(asked, self.cap)
+        return random.uniform(0, min(self.cap, self.base * 2 ** retry))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Retry-After is either delta-seconds or an HTTP date
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
     try:
-        data = requests.get(url, params=params, headers={
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:135.0) Gecko/20100101 Firefox/135.0",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            'Referer': 'https://www.nhl.com/',
-        }, timeout=10).json()
-        time.sleep(1)
-        return data
-    except Exception as e:
-        if auto_retry:
-            time.sleep(retry_buffer)
-            fetch_data(url, params, auto_retry)
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures against a host and rejects
+    requests for `cooldown` seconds, then lets a single probe through: success
+    closes it again, failure reopens it.
+    """
+    def __init__(self, threshold: int = 10, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def retry_in(self) -> float:
+        with self.lock:
+            if self.opened is None:
+                return 0.0
+            return max(0.0, self.opened + self.cooldown - time.monotonic())
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.probing or time.monotonic() < self.opened + self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened is None or self.probing:
+                    logging.warning(f"circuit open after {self.failures} failures")
+                self.opened = time.monotonic()
+                self.probing = False
+
+
+class Metrics:
+    """
+    per endpoint (url path with ids and dates replaced by *): requests, retries,
+    failures and response latencies
+    """
+    def __init__(self):
+        self.endpoints: dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        return re.sub(r"\d[\d-]*", "*", urlparse(url).path)
+
+    def record(self, url: str, latency: Optional[float] = None, retried: bool = False, failed: bool = False):
+        with self.lock:
+            m = self.endpoints.setdefault(self.endpoint(url), {'requests': 0, 'retries': 0, 'failures': 0, 'latencies': []})
+            if latency is not None:
+                m['requests'] += 1
+                m['latencies'].append(latency)
+            m['retries'] += retried
+            m['failures'] += failed
+
+    def summary(self) -> dict[str, dict]:
+        with self.lock:
+            summary = {}
+            for endpoint, m in sorted(self.endpoints.items()):
+                latencies = sorted(m['latencies']) or [0.0]
+                pct = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1)
+                summary[endpoint] = {
+                    'requests': m['requests'], 'retries': m['retries'], 'failures': m['failures'],
+                    'p50_ms': pct(0.5), 'p95_ms': pct(0.95), 'max_ms': pct(1.0),
+                }
+            return summary
+
+
+RATE_LIMIT = TokenBucket(rate=1.0, capacity=1)
+RETRY = RetryPolicy()
+METRICS = Metrics()
+BREAKERS: dict[str, CircuitBreaker] = {}
+BREAKERS_LOCK = threading.Lock()
+SESSION = requests.Session()
+CACHE: Optional[ResponseCache] = None
+# request -> (conditional headers, body) of the last response that carried an ETag or Last-Modified,
+# least recently used first; a few entries per followed game
+VALIDATORS: OrderedDict[str, tuple[dict, dict]] = OrderedDict()
+VALIDATORS_LOCK = threading.Lock()
+MAX_VALIDATORS = 256
+LIVE_STATES = {'LIVE', 'CRIT'}
+
+def configure(rate: float = 1.0, burst: int = 1, pool_size: int = 10, retries: int = 5, backoff: float = 1.0):
+    # one keep-alive session shared by every worker, sized to the worker pool
+    global RATE_LIMIT, RETRY
+    RATE_LIMIT = TokenBucket(rate=rate, capacity=burst)
+    RETRY = RetryPolicy(attempts=retries + 1, base=backoff)
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    SESSION.mount("http://", adapter)
+    SESSION.mount("https://", adapter)
+
+def use_cache(root: str, max_bytes: int = 4 * 1024 ** 3) -> ResponseCache:
+    global CACHE
+    CACHE = ResponseCache(root, max_bytes)
+    return CACHE
+
+def game_ttl(data: dict) -> Optional[float]:
+    return None if data.get('gameState') in FINAL_STATES else LIVE_TTL
+
+def week_ttl(data: dict) -> Optional[float]:
+    # a schedule/score page stops changing once every game on it is final
+    games = data.get('games')
+    if games is None:
+        games = [g for day in data.get('gameWeek', []) for g in day.get('games', [])]
+    if games and all(g.get('gameState') in FINAL_STATES for g in games):
+        return None
+    return SCHEDULE_TTL
+
+def breaker(url: str) -> CircuitBreaker:
+    host = urlparse(url).netloc
+    with BREAKERS_LOCK:
+        if host not in BREAKERS:
+            BREAKERS[host] = CircuitBreaker()
+        return BREAKERS[host]
+
+def open_for() -> float:
+    # seconds until every open circuit lets a probe through
+    with BREAKERS_LOCK:
+        breakers = list(BREAKERS.values())
+    return max([b.retry_in() for b in breakers], default=0.0)
+
+def request(url: str, params: map = {}, headers: dict = HEADERS, auto_retry: bool = True) -> requests.Response:
+    """
+    GET through the rate limit and the host's circuit breaker. Connection errors,
+    timeouts, 429 and 5xx are retried under RETRY; other statuses are returned.
+    Raises FetchError once the attempts are used up.
+    """
+    circuit = breaker(url)
+    attempts = RETRY.attempts if auto_retry else 1
+    for attempt in range(attempts):
+        if not circuit.allow():
+            METRICS.record(url, failed=True)
+            raise CircuitOpenError(url, circuit.retry_in())
+        RATE_LIMIT.acquire()
+        start = time.monotonic()
+        retry_after = None
+        try:
+            resp = SESSION.get(url, params=params, headers=headers, timeout=10)
+            METRICS.record(url, time.monotonic() - start)
+            if resp.status_code not in RETRY_STATUSES:
+                circuit.success()
+                return resp
+            reason, status, retry_after = f"status {resp.status_code}", resp.status_code, resp.headers.get('Retry-After')
+        except requests.RequestException as e:
+            METRICS.record(url, time.monotonic() - start)
+            reason, status = repr(e), None
+        circuit.failure()
+        if attempt == attempts - 1:
+            METRICS.record(url, failed=True)
+            raise FetchError(url, f"{reason} after {attempts} attempts", status)
+        METRICS.record(url, retried=True)
+        wait = RETRY.delay(attempt, retry_after)
+        logging.warning(f"GET[{url}] {reason}, retry {attempt + 1} in {wait:.1f}s")
+        time.sleep(wait)
+
+def fetch_data(url: str, params: map = {}, auto_retry: bool = True,
+               ttl: Optional[float | Callable[[dict], Optional[float]]] = 0):
+    """
+    ttl: seconds to keep the response in CACHE, None to keep forever, 0 to skip
+    the cache, or a function of the response returning one of those
+    """
+    if CACHE and ttl != 0:
+        cached = CACHE.get(url, params)
+        if cached is not None:
+            return cached
+    resp = request(url, params, auto_retry=auto_retry)
+    if not resp.ok:
+        METRICS.record(url, failed=True)
+        raise FetchError(url, f"status {resp.status_code}", resp.status_code)
+    try:
+        data = resp.json()
+    except ValueError as e:
+        METRICS.record(url, failed=True)
+        raise FetchError(url, f"invalid json: {e}", resp.status_code)
+    expiry = ttl(data) if callable(ttl) else ttl
+    if CACHE and expiry != 0:
+        CACHE.put(url, params, data, expiry)
+    return data
+
+
+def fetch_if_changed(url: str, params: map = {}) -> tuple[dict, bool]:
+    """
+    conditional GET for polling: repeats the ETag / Last-Modified of the previous
+    response as If-None-Match / If-Modified-Since and returns (data, changed).
+    A 304 returns the previous body with changed False. Bypasses CACHE.
+    """
+    key = f"{url}?{urlencode(sorted(params.items()))}"
+    with VALIDATORS_LOCK:
+        previous = VALIDATORS.get(key)
+        if previous:
+            VALIDATORS.move_to_end(key)
+    headers = {**HEADERS, **previous[0]} if previous else HEADERS
+    resp = request(url, params, headers)
+    if resp.status_code == 304:
+        if previous:
+            return previous[1], False
+        # nothing to return for a 304 we did not ask for (e.g. the entry was evicted meanwhile)
+        resp = request(url, params)
+    if not resp.ok:
+        METRICS.record(url, failed=True)
+        raise FetchError(url, f"status {resp.status_code}", resp.status_code)
+    try:
+        data = resp.json()
+    except ValueError as e:
+        METRICS.record(url, failed=True)
+        raise FetchError(url, f"invalid json: {e}", resp.status_code)
+    validators = {}
+    if resp.headers.get('ETag'):
+        validators['If-None-Match'] = resp.headers['ETag']
+    if resp.headers.get('Last-Modified'):
+        validators['If-Modified-Since'] = resp.headers['Last-Modified']
+    with VALIDATORS_LOCK:
+        if validators:
+            VALIDATORS[key] = (validators, data)
+            VALIDATORS.move_to_end(key)
+            while len(VALIDATORS) > MAX_VALIDATORS:
+                VALIDATORS.popitem(last=False)
         else:
-            raise Exception(f"Error GET[{url}]: {e}")
+            VALIDATORS.pop(key, None)
+    return data, True
 
 
 def get_schedule(date):
     sched_url = f"{APIWEB}schedule/{date}"
-    return fetch_data(sched_url)
+    return fetch_data(sched_url, ttl=week_ttl)
 
 
 def get_season_windows(date):
     sched_url = f"{APIWEB}schedule/{date}"
-    sched = fetch_data(sched_url)
+    sched = fetch_data(sched_url, ttl=week_ttl)
     return (
         sched.get('preSeasonStartDate'),
         sched.get('regularSeasonStartDate'),
@@ -42,27 +349,38 @@ def get_season_windows(date):
 
 def get_landing(game_id):
     landing_url = f"{APIWEB}gamecenter/{game_id}/landing"
-    return fetch_data(landing_url)
+    return fetch_data(landing_url, ttl=game_ttl)
 
 
 def get_play_by_play(game_id):
     pbp_url = f"{APIWEB}gamecenter/{game_id}/play-by-play"
-    return fetch_data(pbp_url)
+    return fetch_data(pbp_url, ttl=game_ttl)
+
+def get_live_play_by_play(game_id) -> tuple[dict, bool]:
+    return fetch_if_changed(f"{APIWEB}gamecenter/{game_id}/play-by-play")
 
 def get_play_by_play_link(game_id):
     pbp_url = f"{APIWEB}gamecenter/{game_id}/play-by-play"
     return pbp_url
 
 
-def get_shiftcharts(game_id, start_from="00:00"):
+def get_shiftcharts(game_id, start_from="00:00", final: bool = False):
     shifts_url = f"{API}shiftcharts"
     shifts_params = {
         "cayenneExp": f'gameId={game_id} and startTime >= "{start_from}"',
         # "sort": str([{"property":"period", "direction": "ASC"},{"property":"startTime","direction":"ASC"}])
     }
-    return fetch_data(shifts_url, shifts_params)
+    return fetch_data(shifts_url, shifts_params, ttl=None if final else LIVE_TTL)
+
+
+def get_live_shiftcharts(game_id) -> tuple[dict, bool]:
+    return fetch_if_changed(f"{API}shiftcharts", {"cayenneExp": f'gameId={game_id} and startTime >= "00:00"'})
+
+
+def get_live_scores() -> tuple[dict, bool]:
+    return fetch_if_changed(f"{APIWEB}score/now")
 
 
 def get_scores_on_date(date: str = "now"):
     score_url = f"{APIWEB}score/{date}"
-    return fetch_data(score_url)
\ No newline at end of file
+    return fetch_data(score_url, ttl=LIVE_TTL if date == "now" else week_ttl)
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""
+On-ice attribution: joins every event to the players on the ice for both teams.
+
+Shifts become intervals of absolute game seconds. All shift boundaries of all
+games are merged into one sorted array of change points keyed by
+gameId * KEY_SCALE + t, so the on-ice set is constant between neighbouring
+change points. Each shift is expanded to the segments it covers and each event
+is placed in its segment with one np.searchsorted, which replaces the per
+player, per event binary search over shift lists.
+"""
+import argparse
+import numpy as np
+import polars as pl
+import dataset
+import gametime
+
+# larger than the number of seconds in any game
+KEY_SCALE = 100_000
+# players coming on for a faceoff are on the ice for it, those going off are not
+FACEOFF_EVENTS = {'faceoff'}
+
+
+def game_seconds(clock: str) -> pl.Expr:
+    return gametime.game_seconds(pl.col('period'), pl.col(clock), dataset.game_type_of(pl.col('gameId')))
+
+
+def shift_intervals(shifts: pl.DataFrame) -> pl.DataFrame:
+    """
+    shifts (gameId, teamId, playerId, period, startTime, endTime in seconds)
+    -> gameId, teamId, playerId, t0, t1 in absolute game seconds
+    """
+    return (
+        shifts.lazy()
+        .select(
+            'gameId', 'teamId', 'playerId',
+            t0=game_seconds('startTime'),
+            t1=game_seconds('endTime'),
+        )
+        # goal rows in the shift charts have no duration
+        .filter(pl.col('t1') > pl.col('t0'))
+        .sort('gameId', 't0')
+        .collect()
+    )
+
+
+def event_times(plays: pl.DataFrame) -> pl.DataFrame:
+    """
+    plays (gameId, eventId, period, timeInPeriod in seconds, typeDescKey) -> gameId, eventId, typeDescKey, t
+    """
+    return plays.select(
+        'gameId', 'eventId', 'typeDescKey',
+        t=game_seconds('timeInPeriod'),
+    )
+
+
+def on_ice(events: pl.DataFrame, intervals: pl.DataFrame, rosters: pl.DataFrame | None = None,
+           skaters_only: bool = False) -> pl.DataFrame:
+    """
+    events (gameId, eventId, typeDescKey, t), intervals from shift_intervals
+    -> one row per (gameId, eventId, teamId, playerId) on the ice.
+
+    A player is on for an event at t when t0 < t <= t1, or t0 <= t < t1 for faceoffs.
+    rosters (gameId, playerId, positionCode) adds positionCode, and skaters_only drops goalies.
+    """
+    k0 = intervals['gameId'].to_numpy() * KEY_SCALE + intervals['t0'].to_numpy()
+    k1 = intervals['gameId'].to_numpy() * KEY_SCALE + intervals['t1'].to_numpy()
+    changes = np.unique(np.concatenate([k0, k1]))
+    # segment k is (changes[k-1], changes[k]]; a shift covers segments i0+1..i1
+    i0 = np.searchsorted(changes, k0)
+    i1 = np.searchsorted(changes, k1)
+    covered = (
+        intervals.select('teamId', 'playerId')
+        .with_columns(first=pl.Series(i0 + 1), last=pl.Series(i1))
+        .select('teamId', 'playerId', segment=pl.int_ranges('first', pl.col('last') + 1))
+        .explode('segment')
+    )
+
+    ek = events['gameId'].to_numpy() * KEY_SCALE + events['t'].to_numpy()
+    faceoff = events['typeDescKey'].is_in(list(FACEOFF_EVENTS)).to_numpy()
+    segment = np.where(
+        faceoff,
+        np.searchsorted(changes, ek, side='right'),
+        np.searchsorted(changes, ek, side='left'),
+    )
+    located = events.select('gameId', 'eventId').with_columns(segment=pl.Series(segment, dtype=pl.Int64))
+
+    attributed = located.join(covered, on='segment', how='inner').drop('segment')
+    if rosters is not None:
+        attributed = attributed.join(
+            rosters.select('gameId', 'playerId', 'positionCode'), on=['gameId', 'playerId'], how='left'
+        )
+        if skaters_only:
+            attributed = attributed.filter(pl.col('positionCode') != 'G')
+    return attributed.sort('gameId', 'eventId', 'teamId', 'playerId')
+
+
+def on_ice_lists(attributed: pl.DataFrame) -> pl.DataFrame:
+    """
+    long attribution -> one row per (gameId, eventId, teamId) with the list of playerIds
+    """
+    return attributed.group_by('gameId', 'eventId', 'teamId', maintain_order=True).agg(pl.col('playerId'))
+
+
+def attribute_dataset(root: str, seasons: list[int] = None, game_types: list[int] = None,
+                      skaters_only: bool = True) -> pl.DataFrame:
+    plays = dataset.scan(root, 'plays', ['gameId', 'eventId', 'period', 'timeInPeriod', 'typeDescKey'], seasons, game_types)
+    shifts = dataset.scan(root, 'shifts', ['gameId', 'teamId', 'playerId', 'period', 'startTime', 'endTime'], seasons, game_types)
+    rosters = dataset.scan(root, 'rosters', ['gameId', 'playerId', 'positionCode'], seasons, game_types)
+    return on_ice(
+        event_times(plays.collect()),
+        shift_intervals(shifts.collect()),
+        rosters.collect(),
+        skaters_only=skaters_only,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("on-ice attribution")
+    parser.add_argument('-d', '--dir', help='parquet dataset root', required=True)
+    parser.add_argument('-o', '--out', help='output parquet file', required=True)
+    parser.add_argument('-S', '--seasons', help='seasons, e.g. 20242025 (comma separated)')
+    parser.add_argument('-g', '--goalies', help='include goalies', default=False, action='store_true')
+    args = parser.parse_args()
+    seasons = [int(s) for s in args.seasons.split(',')] if args.seasons else None
+    attribute_dataset(args.dir, seasons, skaters_only=not args.goalies).write_parquet(args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Indexed event store over the parquet dataset, for queries like "all shots by
+team X in period 2 from the defensive zone" without rebuilding and filtering
+the whole play list.
+
+build() joins plays with play_details once per partition and writes
+
+<root>/events/season=20242025/gameType=2/events.parquet   sorted by INDEX_KEYS, gameId, eventId
+<root>/events/season=20242025/gameType=2/events.idx.arrow one row per (key, row group) with its gameId range
+
+teamId is the shooter's team for shot attempts (sequences.with_team; the owner
+of a blocked shot is the blocking team) and the event owner otherwise, and
+zoneCode is from teamId's point of view (turned around for blocked shots).
+eventOwnerTeamId is kept as it is in play_details.
+EventStore.query() looks the filters up in the index, reads only the row groups
+that can match and filters those rows exactly.
+"""
+import argparse
+import random
+import time
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+from pathlib import Path
+import dataset
+import sequences
+
+DATATYPE = 'events'
+INDEX_KEYS = ['teamId', 'typeDescKey', 'period', 'zoneCode']
+ROW_GROUP_SIZE = 2048
+PLAY_COLUMNS = ['gameId', 'eventId', 'period', 'periodType', 'timeInPeriod', 'timeRemaining', 'situationCode',
+                'typeDescKey', 'sortOrder', 'homeTeamDefendingSide']
+# zoneCode of play_details is from the event owner's side
+OWN_ZONE = (
+    pl.when(pl.col('teamId') == pl.col('eventOwnerTeamId')).then(pl.col('zoneCode'))
+    .otherwise(pl.col('zoneCode').replace({'O': 'D', 'D': 'O'}))
+)
+DETAIL_COLUMNS = ['eventOwnerTeamId', 'zoneCode', 'xCoord', 'yCoord', 'shotType', 'reason', 'descKey', 'duration',
+                  'shootingPlayerId', 'scoringPlayerId', 'assist1PlayerId', 'assist2PlayerId', 'goalieInNetId',
+                  'blockingPlayerId', 'hittingPlayerId', 'hitteePlayerId', 'winningPlayerId', 'losingPlayerId',
+                  'committedByPlayerId', 'drawnByPlayerId', 'playerId', 'awayScore', 'homeScore']
+
+
+def build_partition(root: str, season: int, game_type: int) -> tuple[Path, int]:
+    outdir = Path(root, DATATYPE, f"season={season}", f"gameType={game_type}")
+    outdir.mkdir(parents=True, exist_ok=True)
+    plays = dataset.scan(root, 'plays', PLAY_COLUMNS, [season], [game_type])
+    details = dataset.scan(root, 'play_details', ['gameId', 'eventId', *DETAIL_COLUMNS], [season], [game_type])
+    rosters = dataset.scan(root, 'rosters', ['gameId', 'playerId', 'teamId'], [season], [game_type])
+    events = (
+        sequences.with_team(plays.join(details, on=['gameId', 'eventId'], how='left'), rosters)
+        .with_columns(zoneCode=OWN_ZONE)
+        .sort([*INDEX_KEYS, 'gameId', 'eventId'], nulls_last=True)
+        .collect()
+    )
+    tmp = Path(outdir, '.events.parquet.tmp')
+    pq.write_table(events.to_arrow(), tmp, row_group_size=ROW_GROUP_SIZE, compression='zstd')
+
+    # row group of every row from the written metadata rather than from ROW_GROUP_SIZE
+    metadata = pq.ParquetFile(tmp).metadata
+    ends = np.cumsum([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])
+    row_group = np.searchsorted(ends, np.arange(events.height), side='right')
+    index = (
+        events.select(*INDEX_KEYS, 'gameId')
+        .with_columns(rowGroup=pl.Series(row_group, dtype=pl.Int32))
+        .group_by([*INDEX_KEYS, 'rowGroup'], maintain_order=True)
+        .agg(gameMin=pl.col('gameId').min(), gameMax=pl.col('gameId').max(), rows=pl.len())
+    )
+    index.write_ipc(Path(outdir, 'events.idx.arrow'))
+    tmp.replace(Path(outdir, 'events.parquet'))
+    return outdir, events.height
+
+
+def build(root: str, seasons: list[int] = None, game_types: list[int] = None) -> int:
+    partitions = (
+        dataset.scan(root, 'plays', ['season', 'gameType'], seasons, game_types)
+        .unique().sort('season', 'gameType').collect().rows()
+    )
+    return sum(build_partition(root, season, game_type)[1] for season, game_type in partitions)
+
+
+class EventStore:
+    """
+    store = EventStore('./data/dataset')
+    # shot attempts by team 10 in period 2 from the defensive zone
+    store.query(seasons=[20242025], teams=[10], events=sequences.ATTEMPT_EVENTS, periods=[2], zones=['D'])
+    """
+    def __init__(self, root: str):
+        self.root = Path(root, DATATYPE)
+        indexes = sorted(self.root.glob('season=*/gameType=*/events.idx.arrow'))
+        if not indexes:
+            raise FileNotFoundError(f"no event index under {self.root}, build it with query.py -build")
+        self.index = pl.concat([
+            pl.read_ipc(fp).with_columns(
+                season=pl.lit(int(fp.parent.parent.name.split('=')[1])),
+                gameType=pl.lit(int(fp.parent.name.split('=')[1])),
+            )
+            for fp in indexes
+        ], how='vertical_relaxed')
+        self.files: dict[tuple[int, int], pq.ParquetFile] = {}
+        self.columns = pq.read_schema(Path(indexes[0].parent, 'events.parquet')).names
+
+    def _file(self, season: int, game_type: int) -> pq.ParquetFile:
+        if (season, game_type) not in self.files:
+            self.files[(season, game_type)] = pq.ParquetFile(
+                Path(self.root, f"season={season}", f"gameType={game_type}", 'events.parquet')
+            )
+        return self.files[(season, game_type)]
+
+    @staticmethod
+    def _filters(seasons=None, game_types=None, games=None, teams=None, events=None, periods=None,
+                 zones=None) -> list[pl.Expr]:
+        wanted = {'season': seasons, 'gameType': game_types, 'teamId': teams, 'typeDescKey': events,
+                  'period': periods, 'zoneCode': zones, 'gameId': games}
+        return [pl.col(column).is_in(list(values)) for column, values in wanted.items() if values]
+
+    def row_groups(self, seasons: list[int] = None, game_types: list[int] = None, games: list[int] = None,
+                   teams: list[int] = None, events: list[str] = None, periods: list[int] = None,
+                   zones: list[str] = None) -> dict[tuple[int, int], list[int]]:
+        """
+        row groups of each partition that can hold matching events
+        """
+        candidates = self.index.filter(
+            *self._filters(seasons, game_types, None, teams, events, periods, zones) or [pl.lit(True)]
+        )
+        if games:
+            ids = np.sort(np.asarray(list(games)))
+            # any wanted game inside [gameMin, gameMax]
+            first = np.searchsorted(ids, candidates['gameMin'].to_numpy(), side='left')
+            candidates = candidates.filter(pl.Series(
+                (first < len(ids)) & (ids[np.minimum(first, len(ids) - 1)] <= candidates['gameMax'].to_numpy())
+            ))
+        groups = candidates.group_by('season', 'gameType').agg(pl.col('rowGroup').unique().sort())
+        return {(season, game_type): rgs for season, game_type, rgs in groups.rows()}
+
+    def query(self, seasons: list[int] = None, game_types: list[int] = None, games: list[int] = None,
+              teams: list[int] = None, events: list[str] = None, periods: list[int] = None,
+              zones: list[str] = None, columns: list[str] = None) -> pl.DataFrame:
+        filters = self._filters(None, None, games, teams, events, periods, zones)
+        needed = None
+        if columns:
+            needed = [c for c in dict.fromkeys([*columns, 'gameId', *INDEX_KEYS]) if c not in dataset.PARTITIONS]
+        frames = []
+        for (season, game_type), rgs in sorted(self.row_groups(seasons, game_types, games, teams, events,
+                                                               periods, zones).items()):
+            part = pl.from_arrow(self._file(season, game_type).read_row_groups(rgs, columns=needed))
+            if filters:
+                part = part.filter(*filters)
+            frames.append(part.with_columns(season=pl.lit(season), gameType=pl.lit(game_type)))
+        if not frames:
+            return pl.DataFrame()
+        result = pl.concat(frames, how='vertical_relaxed')
+        return result.select(columns) if columns else result
+
+
+def bench(root: str, store: EventStore, queries: int, seed: int = 0):
+    """
+    random team / event / period / zone queries against the index and against a full scan
+    """
+    rng = random.Random(seed)
+    keys = store.index.select('season', *INDEX_KEYS).drop_nulls().unique().rows()
+    scan = sequences.with_team(
+        dataset.scan(root, 'plays', [*PLAY_COLUMNS, 'season', 'gameType'])
+        .join(dataset.scan(root, 'play_details', ['gameId', 'eventId', *DETAIL_COLUMNS]), on=['gameId', 'eventId']),
+        dataset.scan(root, 'rosters', ['gameId', 'playerId', 'teamId']),
+    ).with_columns(zoneCode=OWN_ZONE)
+    indexed, scanned = [], []
+    for _ in range(queries):
+        season, team, event, period, zone = rng.choice(keys)
+        start = time.perf_counter()
+        found = store.query([season], teams=[team], events=[event], periods=[period], zones=[zone])
+        indexed.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        expected = scan.filter(
+            pl.col('season') == season, pl.col('teamId') == team, pl.col('typeDescKey') == event,
+            pl.col('period') == period, pl.col('zoneCode') == zone,
+        ).collect()
+        scanned.append(time.perf_counter() - start)
+        assert found.height == expected.height, (season, team, event, period, zone)
+
+    for name, latencies in [('index', indexed), ('scan', scanned)]:
+        ms = np.array(latencies) * 1000
+        print(f"{name:6} p50 {np.percentile(ms, 50):7.2f}ms  p95 {np.percentile(ms, 95):7.2f}ms  max {ms.max():7.2f}ms")
+    print(f"{queries} queries, {store.index['rows'].sum()} events, "
+          f"{store.index.select('season', 'gameType', 'rowGroup').n_unique()} row groups")
+
+
+def main():
+    parser = argparse.ArgumentParser("event queries")
+    parser.add_argument('-d', '--dir', help='parquet dataset root', required=True)
+    parser.add_argument('-build', help='(re)build the event store and its index', default=False, action='store_true')
+    parser.add_argument('-S', '--seasons', help='seasons (comma separated)')
+    parser.add_argument('-G', '--games', help='game ids (comma separated)')
+    parser.add_argument('-t', '--teams', help='team ids: the shooter\'s team for shot attempts, the event owner otherwise (comma separated)')
+    parser.add_argument('-e', '--events', help='event types, e.g. shot-on-goal,goal (comma separated)')
+    parser.add_argument('-p', '--periods', help='periods (comma separated)')
+    parser.add_argument('-z', '--zones', help='zone codes O,D,N from the side of teamId (comma separated)')
+    parser.add_argument('-c', '--columns', help='columns to return (comma separated)')
+    parser.add_argument('-o', '--out', help='write the result to a csv file')
+    parser.add_argument('--bench', help='time this many random queries against a full scan', type=int)
+    args = parser.parse_args()
+    split = lambda s, cast=int: [cast(x) for x in s.split(',')] if s else None
+
+    if args.build:
+        start = time.perf_counter()
+        rows = build(args.dir, split(args.seasons))
+        print(f"indexed {rows} events in {time.perf_counter() - start:.1f}s")
+    store = EventStore(args.dir)
+    if args.bench:
+        bench(args.dir, store, args.bench)
+        return
+    start = time.perf_counter()
+    result = store.query(split(args.seasons), games=split(args.games), teams=split(args.teams),
+                         events=split(args.events, str), periods=split(args.periods), zones=split(args.zones, str),
+                         columns=split(args.columns, str))
+    print(f"{result.height} events in {(time.perf_counter() - start) * 1000:.1f}ms")
+    if args.out:
+        result.write_csv(args.out)
+    else:
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import polars as pl
+import pyarrow as pa
+import yaml
+
+# "MM:SS" in the api and csv output, integer seconds in the parquet dataset
+SECONDS = 'Seconds'
+
+
+def _read(schema_fp: str) -> dict[str, dict[str, str]]:
+    with open(schema_fp, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def _dtype(name: str, stored: bool) -> pl.DataType:
+    if name == SECONDS:
+        return pl.Int32 if stored else pl.String
+    return getattr(pl, name)
+
+
+def load_schema(schema_fp: str, stored: bool = False) -> dict[str, pl.Schema]:
+    """
+    stored: types as kept in the parquet dataset rather than as parsed from the api
+    """
+    return {
+        rulename: pl.Schema({field: _dtype(dtype, stored) for field, dtype in fields.items()})
+        for rulename, fields in _read(schema_fp).items()
+    }
+
+
+def seconds_fields(schema_fp: str) -> dict[str, list[str]]:
+    return {
+        rulename: [field for field, dtype in fields.items() if dtype == SECONDS]
+        for rulename, fields in _read(schema_fp).items()
+    }
+
+
+def arrow_schema(schema: pl.Schema) -> pa.Schema:
+    return pl.DataFrame(schema=schema).to_arrow().schema
@@ -0,0 +1,210 @@
+"""
+Shot sequences: rebound and rush flags for every shot attempt of whole seasons.
+
+get_rebounds/get_rushes in match_shifts walk the plays of one game in python,
+find the shooter's team through the lookup dict and keep the last attempt of
+each team in mutable state. Here a Rule is a backward as-of join of every event
+onto the latest earlier event of the same game and period that the rule accepts
+(by event type and team), over the whole season at once:
+
+rebound  an attempt by the same team at most 3 seconds before
+rush     the event just before, at most 4 seconds before, in the neutral or
+         defensive zone of the shooting team (zoneCode is from the event owner's side)
+
+The team of an attempt is the shooter's (from the rosters, like stats.on_ice_attempts):
+eventOwnerTeamId of a blocked shot is the blocking team. Unlike the notebook, the
+window is inclusive (<= 3 where it has < 3) and nothing carries over from one
+period to the next, where the notebook compares across periods in absolute time.
+
+`python sequences.py -d <dataset> --bench` compares with the per-game loop.
+"""
+import argparse
+import time
+import polars as pl
+from dataclasses import dataclass, replace
+from typing import Optional
+import dataset
+import onice
+
+ATTEMPT_EVENTS = ['blocked-shot', 'missed-shot', 'shot-on-goal', 'goal']
+EVENT_COLUMNS = ['gameId', 'eventId', 'period', 'timeInPeriod', 'typeDescKey', 'sortOrder']
+DETAIL_COLUMNS = ['eventOwnerTeamId', 'zoneCode', 'shootingPlayerId', 'scoringPlayerId']
+
+
+@dataclass(frozen=True)
+class Rule:
+    # seconds from the preceding event to the shot, at most
+    window: float
+    # event types that can precede the shot, None for any event
+    events: Optional[tuple[str, ...]] = None
+    # team of the preceding event: 'same', 'other' or 'any' (the event just before)
+    team: str = 'any'
+    # zones of the preceding event from the shooting team's side, None for any zone
+    zones: Optional[tuple[str, ...]] = None
+
+
+RULES = {
+    'rebound': Rule(window=3, events=tuple(ATTEMPT_EVENTS), team='same'),
+    'rush': Rule(window=4, zones=('N', 'D')),
+}
+
+
+def with_team(events: pl.LazyFrame, rosters: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    events (gameId, typeDescKey, eventOwnerTeamId, shootingPlayerId, scoringPlayerId) with teamId:
+    the shooter's team (rosters: gameId, playerId, teamId) for attempts, the event owner otherwise
+    """
+    attempt = pl.col('typeDescKey').is_in(ATTEMPT_EVENTS)
+    shooters = rosters.select('gameId', shooterId='playerId', shooterTeamId='teamId')
+    return (
+        events.with_columns(shooterId=pl.when(attempt).then(pl.coalesce('scoringPlayerId', 'shootingPlayerId')))
+        .join(shooters, on=['gameId', 'shooterId'], how='left')
+        .with_columns(
+            teamId=pl.when(attempt).then(pl.coalesce('shooterTeamId', 'eventOwnerTeamId'))
+            .otherwise(pl.col('eventOwnerTeamId')),
+        )
+        .drop('shooterId', 'shooterTeamId')
+    )
+
+
+def scan_events(root: str, seasons: list[int] = None, game_types: list[int] = None,
+                plays: list[str] = [], details: list[str] = []) -> pl.LazyFrame:
+    """
+    plays with their details, the home and away team, t in absolute game seconds and
+    teamId (the shooter's team for attempts, the event owner otherwise); plays/details: extra columns
+    """
+    games = (
+        dataset.scan(root, 'games', ['id', 'homeTeamId', 'awayTeamId'], seasons, game_types)
+        .rename({'id': 'gameId'})
+    )
+    rosters = dataset.scan(root, 'rosters', ['gameId', 'playerId', 'teamId'], seasons, game_types)
+    events = (
+        dataset.scan(root, 'plays', list(dict.fromkeys([*EVENT_COLUMNS, *plays])), seasons, game_types)
+        .join(
+            dataset.scan(root, 'play_details', list(dict.fromkeys(['gameId', 'eventId', *DETAIL_COLUMNS, *details])),
+                         seasons, game_types),
+            on=['gameId', 'eventId'], how='left',
+        )
+        .join(games, on='gameId', how='left')
+    )
+    return with_team(events, rosters).with_columns(t=onice.game_seconds('timeInPeriod'))
+
+
+def flags(events: pl.DataFrame, rules: dict[str, Rule] = RULES, shots: list[str] = ATTEMPT_EVENTS) -> pl.DataFrame:
+    """
+    events of whole games (see scan_events) -> the events sorted by gameId, sortOrder with
+    one boolean column per rule, true for the events of `shots` that the rule matches
+    """
+    ordered = events.sort('gameId', 'sortOrder').with_columns(seq=pl.int_range(pl.len()))
+    home = pl.col('teamId') == pl.col('homeTeamId')
+    keys = ordered.select(
+        'gameId', 'period', 'seq', 't', 'teamId',
+        opponentId=pl.when(home).then(pl.col('awayTeamId')).otherwise(pl.col('homeTeamId')),
+    )
+    flagged = []
+    for name, rule in rules.items():
+        candidates = ordered if rule.events is None else ordered.filter(pl.col('typeDescKey').is_in(rule.events))
+        candidates = candidates.select('gameId', 'period', 'seq', prevT='t', prevTeam='teamId',
+                                       prevOwner='eventOwnerTeamId', prevZone='zoneCode')
+        by_left = {'same': ['teamId'], 'other': ['opponentId'], 'any': []}[rule.team]
+        by_right = ['prevTeam'] if by_left else []
+        matched = keys.join_asof(
+            candidates, on='seq', by_left=['gameId', 'period', *by_left], by_right=['gameId', 'period', *by_right],
+            strategy='backward', allow_exact_matches=False, check_sortedness=False,
+        )
+        # zoneCode is from the side of the event owner, not of the shooter of a blocked shot
+        own_zone = (
+            pl.when(pl.col('prevOwner') == pl.col('teamId')).then(pl.col('prevZone'))
+            .otherwise(pl.col('prevZone').replace({'O': 'D', 'D': 'O'}))
+        )
+        matches = pl.col('t') - pl.col('prevT') <= rule.window
+        if rule.zones is not None:
+            matches = matches & own_zone.is_in(rule.zones)
+        flagged.append(matched.sort('seq').select(matches.fill_null(False).alias(name)))
+    is_shot = pl.col('typeDescKey').is_in(shots)
+    return ordered.drop('seq').with_columns(
+        *[(is_shot & df.to_series()).alias(name) for name, df in zip(rules, flagged)]
+    )
+
+
+def shot_flags(root: str, season: int, game_type: int, rules: dict[str, Rule] = RULES) -> pl.DataFrame:
+    """
+    gameId, eventId, teamId, shooterId and a column per rule for the shot attempts of one partition
+    """
+    events = scan_events(root, [season], [game_type]).collect()
+    return (
+        flags(events, rules)
+        .filter(pl.col('typeDescKey').is_in(ATTEMPT_EVENTS))
+        .select('gameId', 'eventId', 'teamId', shooterId=pl.coalesce('scoringPlayerId', 'shootingPlayerId'), *rules)
+    )
+
+
+def _per_game_rebounds(plays: list[dict], lookup: dict[int, dict], window: float) -> set[int]:
+    # get_rebounds of match_shifts for one game, kept as the reference for --bench,
+    # with the inclusive window and per period reset of the Rule
+    last: dict[int, tuple[int, int]] = {}
+    found = set()
+    for play in plays:
+        if play['typeDescKey'] not in ATTEMPT_EVENTS:
+            continue
+        key = 'scoringPlayerId' if play['typeDescKey'] == 'goal' else 'shootingPlayerId'
+        team = lookup[play[key]]['teamId']
+        if team in last and last[team][0] == play['period'] and play['t'] - last[team][1] <= window:
+            found.add(play['eventId'])
+        last[team] = (play['period'], play['t'])
+    return found
+
+
+def bench(root: str, seasons: list[int] = None, game_types: list[int] = None):
+    events = scan_events(root, seasons, game_types).collect()
+    rosters = dataset.scan(root, 'rosters', ['gameId', 'playerId', 'teamId'], seasons, game_types).collect()
+    lookups = {
+        game_id: {p['playerId']: p for p in spots.to_dicts()}
+        for (game_id,), spots in rosters.group_by('gameId')
+    }
+    start = time.perf_counter()
+    reference = set()
+    for (game_id,), game in events.sort('gameId', 'sortOrder').group_by('gameId', maintain_order=True):
+        reference |= {(game_id, e) for e in _per_game_rebounds(game.to_dicts(), lookups[game_id], RULES['rebound'].window)}
+    per_game_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    flagged = flags(events)
+    columnar_s = time.perf_counter() - start
+    found = set(flagged.filter('rebound').select('gameId', 'eventId').iter_rows())
+    print(f"{events.height} events of {events['gameId'].n_unique()} games")
+    print(f"per game loop   {per_game_s:8.3f}s  (rebounds only)")
+    print(f"columnar        {columnar_s:8.3f}s  {per_game_s / columnar_s:6.1f}x, rebounds and rushes")
+    print(f"same rebounds as the loop: {found == reference} ({len(found)})")
+
+
+def main():
+    parser = argparse.ArgumentParser("shot sequences")
+    parser.add_argument('-d', '--dir', help='parquet dataset root', required=True)
+    parser.add_argument('-S', '--seasons', help='seasons, e.g. 20242025 (comma separated)')
+    parser.add_argument('-g', '--game_types', help='game types, e.g. 2,3 (comma separated)')
+    parser.add_argument('-o', '--out', help='write the flags of every shot attempt (.parquet)')
+    parser.add_argument('--rebound', help='rebound window in seconds', type=float, default=RULES['rebound'].window)
+    parser.add_argument('--rush', help='rush window in seconds', type=float, default=RULES['rush'].window)
+    parser.add_argument('--bench', help='compare with the per-game loop', default=False, action='store_true')
+    args = parser.parse_args()
+    split = lambda s: [int(x) for x in s.split(',')] if s else None
+    seasons, game_types = split(args.seasons), split(args.game_types)
+    if args.bench:
+        bench(args.dir, seasons, game_types)
+        return
+    rules = {'rebound': replace(RULES['rebound'], window=args.rebound), 'rush': replace(RULES['rush'], window=args.rush)}
+    start = time.perf_counter()
+    found = pl.concat([
+        shot_flags(args.dir, season, game_type, rules)
+        for season, game_type in dataset.scan(args.dir, 'plays', ['season', 'gameType'], seasons, game_types)
+        .unique().sort('season', 'gameType').collect().rows()
+    ])
+    elapsed = time.perf_counter() - start
+    if args.out:
+        found.write_parquet(args.out)
+    print(f"{found.height} shot attempts: {found['rebound'].sum()} rebounds, {found['rush'].sum()} rushes in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
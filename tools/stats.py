@@ -0,0 +1,185 @@
+"""
+Player counting stats (icf, iff, takeaways, giveaways, blocks, penalties, faceoffs),
+rebounds and rush attempts, and on-ice CF/CA/FF/FA over any set of games of the
+parquet dataset.
+
+Individual counts are one lazy group_by over every selected partition, run on
+the streaming engine. On-ice counts need the shift attribution, which is done
+one season/game type partition at a time so memory is bounded by the largest
+partition rather than by the number of seasons; rebound and rush flags
+(sequences.py) come from the same per-partition pass.
+"""
+import argparse
+import polars as pl
+import dataset
+import onice
+import sequences
+
+CF_EVENTS = ['blocked-shot', 'missed-shot', 'shot-on-goal', 'goal']
+FF_EVENTS = ['missed-shot', 'shot-on-goal', 'goal']
+KEYS = ['playerId', 'season', 'gameType']
+
+# stat: (event types, player id column of play_details)
+INDIVIDUAL_STATS = {
+    'goals': (['goal'], 'scoringPlayerId'),
+    'icf': (CF_EVENTS, 'shooterId'),
+    'iff': (FF_EVENTS, 'shooterId'),
+    'takeaways': (['takeaway'], 'playerId'),
+    'giveaways': (['giveaway'], 'playerId'),
+    'blocked': (['blocked-shot'], 'blockingPlayerId'),
+    'hits': (['hit'], 'hittingPlayerId'),
+    'penalties': (['penalty'], 'committedByPlayerId'),
+    'penalties_drawn': (['penalty'], 'drawnByPlayerId'),
+    'faceoff_win': (['faceoff'], 'winningPlayerId'),
+    'faceoff_lose': (['faceoff'], 'losingPlayerId'),
+}
+ON_ICE_STATS = ['cf', 'ca', 'ff', 'fa']
+# stat: sequences rule flagging the shooter's attempt
+SEQUENCE_STATS = {'rebounds': 'rebound', 'rush_attempts': 'rush'}
+
+
+def scan_events(root: str, seasons: list[int] = None, game_types: list[int] = None) -> pl.LazyFrame:
+    """
+    plays joined with their details; shooterId is the shooter or scorer of a shot attempt
+    """
+    roles = sorted({role for _, role in INDIVIDUAL_STATS.values() if role != 'shooterId'} | {'shootingPlayerId'})
+    plays = dataset.scan(root, 'plays', ['gameId', 'eventId', 'period', 'timeInPeriod', 'situationCode', 'typeDescKey',
+                                         'season', 'gameType'], seasons, game_types)
+    details = dataset.scan(root, 'play_details', ['gameId', 'eventId', *roles], seasons, game_types)
+    return plays.join(details, on=['gameId', 'eventId'], how='left').with_columns(
+        shooterId=pl.coalesce('scoringPlayerId', 'shootingPlayerId'),
+    )
+
+
+def credits(events: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    one row per (event, credited player, stat)
+    """
+    return pl.concat([
+        events.filter(pl.col('typeDescKey').is_in(types) & pl.col(role).is_not_null())
+        .select('gameId', 'eventId', pl.col(role).alias('playerId'), 'season', 'gameType', stat=pl.lit(stat))
+        for stat, (types, role) in INDIVIDUAL_STATS.items()
+    ])
+
+
+def count_credits(credited: pl.LazyFrame, keys: list[str] = KEYS) -> pl.LazyFrame:
+    return credited.group_by(keys).agg(
+        (pl.col('stat') == stat).sum().cast(pl.UInt32).alias(stat)
+        for stat in INDIVIDUAL_STATS
+    )
+
+
+def individual_stats(events: pl.LazyFrame) -> pl.LazyFrame:
+    return count_credits(credits(events))
+
+
+def games_played(root: str, seasons: list[int] = None, game_types: list[int] = None) -> pl.LazyFrame:
+    return (
+        dataset.scan(root, 'rosters', ['gameId', 'playerId', 'teamId', 'season', 'gameType'], seasons, game_types)
+        .group_by(KEYS)
+        .agg(gp=pl.col('gameId').n_unique().cast(pl.UInt32), teamId=pl.col('teamId').last())
+    )
+
+
+def on_ice_attempts(events: pl.DataFrame, shifts: pl.DataFrame, rosters: pl.DataFrame) -> pl.DataFrame:
+    """
+    one row per (shot attempt, skater on the ice) with the team of the shooter
+    """
+    attempts = (
+        events.filter(pl.col('typeDescKey').is_in(CF_EVENTS))
+        .join(rosters.select('gameId', shooterId='playerId', shooterTeamId='teamId'), on=['gameId', 'shooterId'], how='left')
+    )
+    attributed = onice.on_ice(onice.event_times(attempts), onice.shift_intervals(shifts), rosters, skaters_only=True)
+    return attributed.join(
+        attempts.select('gameId', 'eventId', 'typeDescKey', 'shooterTeamId', 'season', 'gameType'),
+        on=['gameId', 'eventId'],
+    )
+
+
+def count_on_ice(attributed: pl.DataFrame, keys: list[str] = KEYS) -> pl.DataFrame:
+    forward = pl.col('teamId') == pl.col('shooterTeamId')
+    fenwick = pl.col('typeDescKey').is_in(FF_EVENTS)
+    return attributed.group_by(keys).agg(
+        cf=forward.sum().cast(pl.UInt32),
+        ca=(~forward).sum().cast(pl.UInt32),
+        ff=(forward & fenwick).sum().cast(pl.UInt32),
+        fa=(~forward & fenwick).sum().cast(pl.UInt32),
+    )
+
+
+def on_ice_stats(events: pl.DataFrame, shifts: pl.DataFrame, rosters: pl.DataFrame) -> pl.DataFrame:
+    """
+    CF/CA/FF/FA for every skater from shot attempts of one partition
+    """
+    return count_on_ice(on_ice_attempts(events, shifts, rosters))
+
+
+def sequence_stats(root: str, season: int, game_type: int) -> pl.DataFrame:
+    """
+    attempts of every shooter flagged by the sequences rules in one partition
+    """
+    return (
+        sequences.shot_flags(root, season, game_type)
+        .filter(pl.col('shooterId').is_not_null())
+        .group_by(playerId='shooterId')
+        .agg(pl.col(rule).sum().alias(stat) for stat, rule in SEQUENCE_STATS.items())
+        .select(pl.col('playerId').cast(pl.Int64), season=pl.lit(season, pl.Int64), gameType=pl.lit(game_type, pl.Int64),
+                *SEQUENCE_STATS)
+    )
+
+
+def partitions(root: str, seasons: list[int] = None, game_types: list[int] = None) -> list[tuple[int, int]]:
+    return (
+        dataset.scan(root, 'plays', ['season', 'gameType'], seasons, game_types)
+        .unique().sort('season', 'gameType').collect().rows()
+    )
+
+
+def player_stats(root: str, seasons: list[int] = None, game_types: list[int] = None) -> pl.DataFrame:
+    counts = individual_stats(scan_events(root, seasons, game_types))
+    gp = games_played(root, seasons, game_types)
+    on_ice, sequenced = [], []
+    for season, game_type in partitions(root, seasons, game_types):
+        events = scan_events(root, [season], [game_type]).collect()
+        shifts = dataset.scan(root, 'shifts', ['gameId', 'teamId', 'playerId', 'period', 'startTime', 'endTime'],
+                              [season], [game_type]).collect()
+        rosters = dataset.scan(root, 'rosters', ['gameId', 'playerId', 'teamId', 'positionCode'],
+                               [season], [game_type]).collect()
+        on_ice.append(on_ice_stats(events, shifts, rosters))
+        sequenced.append(sequence_stats(root, season, game_type))
+    on_ice = pl.concat(on_ice) if on_ice else pl.DataFrame(schema={**{k: pl.Int64 for k in KEYS}, **{s: pl.UInt32 for s in ON_ICE_STATS}})
+    sequenced = pl.concat(sequenced) if sequenced else pl.DataFrame(schema={**{k: pl.Int64 for k in KEYS}, **{s: pl.UInt32 for s in SEQUENCE_STATS}})
+    stats = (
+        gp.join(counts, on=KEYS, how='full', coalesce=True)
+        .join(sequenced.lazy(), on=KEYS, how='full', coalesce=True)
+        .join(on_ice.lazy().cast({k: pl.Int64 for k in KEYS}), on=KEYS, how='full', coalesce=True)
+        .with_columns(pl.col([*INDIVIDUAL_STATS, *SEQUENCE_STATS, *ON_ICE_STATS]).fill_null(0))
+        .sort(KEYS)
+    )
+    return stats.collect(engine='streaming')
+
+
+def main():
+    parser = argparse.ArgumentParser("player stats")
+    parser.add_argument('-d', '--dir', help='parquet dataset root', required=True)
+    parser.add_argument('-o', '--out', help='output file (.csv or .parquet)')
+    parser.add_argument('-S', '--seasons', help='seasons, e.g. 20232024,20242025 (comma separated)')
+    parser.add_argument('-g', '--game_types', help='game types, e.g. 2,3 (comma separated)')
+    parser.add_argument('-s', '--sort', help='leaderboard column', default='cf')
+    parser.add_argument('-n', '--top', help='leaderboard rows to print', type=int, default=20)
+    args = parser.parse_args()
+    seasons = [int(s) for s in args.seasons.split(',')] if args.seasons else None
+    game_types = [int(s) for s in args.game_types.split(',')] if args.game_types else None
+
+    stats = player_stats(args.dir, seasons, game_types)
+    if args.out:
+        if args.out.endswith('.parquet'):
+            stats.write_parquet(args.out)
+        else:
+            stats.write_csv(args.out)
+    with pl.Config(tbl_rows=args.top, tbl_cols=-1, tbl_width_chars=240):
+        print(stats.sort(args.sort, descending=True).head(args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Strength state timeline: per game segments of constant manpower, stored next to
+the plays so any event can be labeled with one sorted lookup.
+
+<root>/strength/season=.../gameType=.../strength.parquet
+    gameId, t0, t1, homeSkaters, awaySkaters, homeGoalie, awayGoalie
+
+t0 and t1 are absolute game seconds (gametime.py). Goalie in/out comes from the
+goalie shifts. Skaters come from the penalties rather than from counting skater
+shifts, which flicker between 4 and 6 on every line change:
+
+- 5 skaters a side, 3 in regular season overtime
+- a MIN/BEN/MAJ/MAT penalty takes one skater off the penalized team for its
+  duration (in 3v3 overtime it adds one to the other team instead), down to 3;
+  a 2 minute minor ends on the first goal of the other team
+- coincidental penalties of the same length at the same time cancel out
+- a team with its goalie pulled has one extra skater
+
+Stacked penalties beyond the 3 skater floor are not delayed, so they end early.
+"""
+import argparse
+import numpy as np
+import polars as pl
+from pathlib import Path
+import dataset
+import gametime
+import onice
+from onice import KEY_SCALE
+
+# penalty typeCode -> ends on a goal of the other team (2 minute minors only)
+MANPOWER_PENALTIES = {'MIN': True, 'BEN': True, 'MAJ': False, 'MAT': False}
+SKATERS = 5
+OT_SKATERS = 3
+MIN_SKATERS = 3
+SCHEMA = pl.Schema({
+    'gameId': pl.Int64, 't0': pl.Int32, 't1': pl.Int32,
+    'homeSkaters': pl.Int8, 'awaySkaters': pl.Int8, 'homeGoalie': pl.Boolean, 'awayGoalie': pl.Boolean,
+})
+STATE = ['homeSkaters', 'awaySkaters', 'homeGoalie', 'awayGoalie']
+
+
+def penalties(plays: pl.DataFrame, details: pl.DataFrame, home: pl.DataFrame) -> pl.DataFrame:
+    """
+    manpower penalties -> gameId, home (penalized team is the home team), t0, t1 in absolute game seconds
+    """
+    events = (
+        plays.join(details, on=['gameId', 'eventId'], how='left')
+        .join(home, on='gameId', how='left')
+        .with_columns(t=onice.game_seconds('timeInPeriod'))
+    )
+    goals = (
+        events.filter(pl.col('typeDescKey') == 'goal')
+        .select('gameId', scorer=pl.col('eventOwnerTeamId') == pl.col('homeTeamId'), goal=pl.col('t'))
+        .sort('goal')
+    )
+    called = (
+        events.filter(
+            (pl.col('typeDescKey') == 'penalty') & pl.col('typeCode').is_in(list(MANPOWER_PENALTIES))
+            & (pl.col('duration') > 0)
+        )
+        .select(
+            'gameId', 't', 'duration',
+            home=pl.col('eventOwnerTeamId') == pl.col('homeTeamId'),
+            minor=(pl.col('typeCode').replace_strict(MANPOWER_PENALTIES, return_dtype=pl.Boolean)
+                   & (pl.col('duration') == 2)),
+        )
+    )
+    # coincidental: the same number of equal penalties on both sides at the same time
+    called = (
+        called.with_columns(n=pl.int_range(pl.len()).over('gameId', 't', 'duration', 'home'))
+        .with_columns(pair=pl.col('home').n_unique().over('gameId', 't', 'duration', 'n'))
+        .filter(pl.col('pair') == 1)
+    )
+    return (
+        called.with_columns(scorer=~pl.col('home'), t1=pl.col('t') + pl.col('duration') * 60)
+        .sort('t')
+        # first goal of the other team after the call, sorted by t within each (gameId, scorer)
+        .join_asof(goals, left_on='t', right_on='goal', by=['gameId', 'scorer'], strategy='forward',
+                   allow_exact_matches=False, check_sortedness=False)
+        .select(
+            'gameId', 'home', t0=pl.col('t'),
+            t1=pl.when(pl.col('minor') & (pl.col('goal') < pl.col('t1'))).then('goal').otherwise('t1'),
+        )
+    )
+
+
+def goalie_intervals(shifts: pl.DataFrame, rosters: pl.DataFrame, home: pl.DataFrame) -> pl.DataFrame:
+    # gameId, home, t0, t1 of every goalie shift
+    goalies = rosters.filter(pl.col('positionCode') == 'G').select('gameId', 'playerId')
+    return (
+        onice.shift_intervals(shifts.join(goalies, on=['gameId', 'playerId'], how='semi'))
+        .join(home, on='gameId', how='left')
+        .select('gameId', 't0', 't1', home=pl.col('teamId') == pl.col('homeTeamId'))
+    )
+
+
+def segments(plays: pl.DataFrame, details: pl.DataFrame, shifts: pl.DataFrame, rosters: pl.DataFrame,
+             home: pl.DataFrame) -> pl.DataFrame:
+    """
+    plays (gameId, eventId, period, timeInPeriod, typeDescKey), details (gameId, eventId, typeCode,
+    duration, eventOwnerTeamId), shifts (gameId, teamId, playerId, period, startTime, endTime),
+    rosters (gameId, playerId, positionCode), home (gameId, homeTeamId) -> SCHEMA, sorted by gameId, t0
+    """
+    # +1 / -1 of each counter at the start / end of each interval; periods start a segment too
+    deltas = []
+    for name, intervals in [('Penalized', penalties(plays, details, home)),
+                            ('Goalie', goalie_intervals(shifts, rosters, home))]:
+        for side, is_home in [('home', True), ('away', False)]:
+            part = intervals.filter(pl.col('home') == is_home)
+            deltas += [
+                part.select('gameId', t='t0', counter=pl.lit(f"{side}{name}"), d=pl.lit(1)),
+                part.select('gameId', t='t1', counter=pl.lit(f"{side}{name}"), d=pl.lit(-1)),
+            ]
+    periods = (
+        shifts.select('gameId', 'period').unique()
+        .select('gameId', t=gametime.period_start(pl.col('period'), dataset.game_type_of(pl.col('gameId'))),
+                counter=pl.lit('homeGoalie'), d=pl.lit(0))
+    )
+    end = onice.shift_intervals(shifts).group_by('gameId').agg(end=pl.col('t1').max())
+    counters = ['homePenalized', 'awayPenalized', 'homeGoalie', 'awayGoalie']
+    changes = (
+        pl.concat([d.cast({'t': pl.Int32, 'd': pl.Int32}) for d in [*deltas, periods]])
+        .group_by('gameId', 't').agg(pl.col('d').filter(pl.col('counter') == c).sum().alias(c) for c in counters)
+        .sort('gameId', 't')
+        .with_columns(pl.col(c).cum_sum().over('gameId') for c in counters)
+        .join(end, on='gameId', how='inner')
+        .with_columns(t1=pl.col('t').shift(-1).over('gameId').fill_null(pl.col('end')))
+        .filter(pl.col('t') < pl.min_horizontal('t1', 'end'))
+    )
+
+    overtime = (
+        (dataset.game_type_of(pl.col('gameId')) == 2)
+        & (pl.col('t') >= gametime.REG_PERIODS * gametime.REG_DURATION)
+    )
+
+    def skaters(own: str, other: str) -> pl.Expr:
+        own_pen, other_pen = pl.col(f"{own}Penalized"), pl.col(f"{other}Penalized")
+        regulation = (SKATERS - own_pen).clip(lower_bound=MIN_SKATERS)
+        three = (OT_SKATERS + (other_pen - own_pen).clip(lower_bound=0)).clip(upper_bound=SKATERS)
+        pulled = (pl.col(f"{own}Goalie") <= 0).cast(pl.Int32)
+        return pl.when(overtime).then(three).otherwise(regulation) + pulled
+
+    labeled = changes.select(
+        'gameId', t0='t', t1=pl.min_horizontal('t1', 'end'),
+        homeSkaters=skaters('home', 'away'), awaySkaters=skaters('away', 'home'),
+        homeGoalie=pl.col('homeGoalie') > 0, awayGoalie=pl.col('awayGoalie') > 0,
+    )
+    # neighbouring segments of the same state are merged
+    changed = pl.any_horizontal(pl.col(c) != pl.col(c).shift(1).over('gameId') for c in STATE).fill_null(True)
+    return (
+        labeled.with_columns(run=changed.cum_sum())
+        .group_by('run', maintain_order=True)
+        .agg(pl.col('gameId').first(), pl.col('t0').min(), pl.col('t1').max(), *[pl.col(c).first() for c in STATE])
+        .drop('run')
+        .cast(SCHEMA)
+        .select(SCHEMA.names())
+    )
+
+
+def lookup(events: pl.DataFrame, timeline: pl.DataFrame) -> pl.DataFrame:
+    """
+    events (gameId, eventId, typeDescKey, t in absolute game seconds, see onice.event_times)
+    -> events with the STATE columns of the segment they fall in.
+
+    Like on-ice attribution, an event at a change belongs to the segment ending there
+    (a goal is scored at the strength before it), a faceoff to the one starting there.
+    """
+    if timeline.is_empty():
+        return events.with_columns(pl.lit(None, SCHEMA[c]).alias(c) for c in STATE)
+    keys = timeline['gameId'].to_numpy() * KEY_SCALE + timeline['t0'].to_numpy()
+    ek = events['gameId'].to_numpy() * KEY_SCALE + events['t'].to_numpy()
+    faceoff = events['typeDescKey'].is_in(list(onice.FACEOFF_EVENTS)).to_numpy()
+    starting = np.searchsorted(keys, ek, side='right') - 1
+    ending = np.clip(np.searchsorted(keys, ek, side='left') - 1, 0, None)
+    # nothing ends at the start of a game, so those events take the segment starting there
+    first = timeline['gameId'].to_numpy()[ending] != events['gameId'].to_numpy()
+    idx = np.where(faceoff | first, starting, ending)
+    # games without a timeline are left unlabeled
+    found = timeline[np.clip(idx, 0, None)]
+    inside = (found['gameId'] == events['gameId']) & (found['t1'] >= events['t'])
+    return events.with_columns(
+        pl.when(inside).then(found[c]).otherwise(None).alias(c) for c in STATE
+    )
+
+
+def label(team: pl.Expr) -> pl.Expr:
+    # STATE columns -> skaters of `team` v the other team, e.g. 5v4; homeTeamId must be a column
+    is_home = team == pl.col('homeTeamId')
+    return pl.format(
+        '{}v{}',
+        pl.when(is_home).then('homeSkaters').otherwise('awaySkaters'),
+        pl.when(is_home).then('awaySkaters').otherwise('homeSkaters'),
+    ).fill_null('unknown')
+
+
+def build_partition(root: str, season: int, game_type: int) -> pl.DataFrame:
+    scan = lambda datatype, columns: dataset.scan(root, datatype, columns, [season], [game_type]).collect()
+    return segments(
+        scan('plays', ['gameId', 'eventId', 'period', 'timeInPeriod', 'typeDescKey']),
+        scan('play_details', ['gameId', 'eventId', 'typeCode', 'duration', 'eventOwnerTeamId']),
+        scan('shifts', ['gameId', 'teamId', 'playerId', 'period', 'startTime', 'endTime']),
+        scan('rosters', ['gameId', 'playerId', 'positionCode']),
+        scan('games', ['id', 'homeTeamId']).rename({'id': 'gameId'}),
+    )
+
+
+def build(root: str, seasons: list[int] = None, game_types: list[int] = None) -> list[Path]:
+    """
+    (re)writes the timeline of every selected partition of the dataset
+    """
+    written = []
+    partitions = dataset.scan(root, 'plays', ['season', 'gameType'], seasons, game_types).unique()
+    for season, game_type in partitions.sort('season', 'gameType').collect().rows():
+        writer = dataset.DatasetWriter(root, 'strength', 'strength', SCHEMA, [])
+        writer.write(build_partition(root, season, game_type))
+        written += writer.close()
+    return written
+
+
+def scan(root: str, seasons: list[int] = None, game_types: list[int] = None) -> pl.LazyFrame:
+    return dataset.scan(root, 'strength', SCHEMA.names(), seasons, game_types)
+
+
+def label_events(root: str, events: pl.DataFrame, seasons: list[int] = None,
+                 game_types: list[int] = None) -> pl.DataFrame:
+    """
+    events (gameId, eventId, typeDescKey, t) labeled from the stored timeline
+    """
+    timeline = scan(root, seasons, game_types).filter(pl.col('gameId').is_in(events['gameId'].unique().implode()))
+    return lookup(events, timeline.sort('gameId', 't0').collect())
+
+
+def main():
+    parser = argparse.ArgumentParser("strength state timeline")
+    parser.add_argument('-d', '--dir', help='parquet dataset root', required=True)
+    parser.add_argument('-S', '--seasons', help='seasons, e.g. 20242025 (comma separated)')
+    parser.add_argument('-g', '--game', help='print the timeline of one game', type=int)
+    args = parser.parse_args()
+    seasons = [int(s) for s in args.seasons.split(',')] if args.seasons else None
+    if args.game:
+        with pl.Config(tbl_rows=-1):
+            print(scan(args.dir, seasons).filter(pl.col('gameId') == args.game).sort('t0').collect())
+        return
+    for fp in build(args.dir, seasons):
+        print(fp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+SHIFTS_GAME_RE = re.compile(r"gameId\s*=\s*(\d+)")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves recorded api responses from `root` so nhl_api can run offline
+    (NHL_ENV=LOCAL NHL_LOCAL_URL=http://localhost:8000/).
+
+    GET /schedule/2024-10-08            -> root/schedule/2024-10-08.json
+    GET /gamecenter/<id>/play-by-play   -> root/gamecenter/<id>/play-by-play.json
+    GET /shiftcharts?cayenneExp=...     -> root/shiftcharts/<gameId>.json
+
+    Responses carry an ETag and a matching If-None-Match gets a 304.
+    """
+    root: Path = Path('.')
+    protocol_version = 'HTTP/1.1'
+
+    def resolve(self) -> Path:
+        url = urlparse(self.path)
+        path = url.path.strip('/')
+        if path == 'shiftcharts':
+            query = parse_qs(url.query).get('cayenneExp', [''])[0]
+            match = SHIFTS_GAME_RE.search(query)
+            path = f"shiftcharts/{match.group(1) if match else 'all'}"
+        return Path(self.root, f"{path}.json")
+
+    def send_json(self, status: int, body: bytes):
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self, fp: Path) -> bytes:
+        return fp.read_bytes()
+
+    def do_GET(self):
+        fp = self.resolve()
+        if not fp.is_file():
+            self.send_json(404, json.dumps({'error': f"no fixture {fp}"}).encode())
+            return
+        self.send_json(200, self.body(fp))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def mmss(clock: str) -> int:
+    minutes, seconds = clock.split(':')
+    return int(minutes) * 60 + int(seconds)
+
+
+class ReplayHandler(StubHandler):
+    """
+    Replays recorded finished games as if they were live, in `stages` steps.
+    At stage k of n a game shows the first k/n of its plays (by sortOrder), the
+    shifts that started by the last of those plays, and gameState LIVE until the
+    last stage, where the recording is served as is.
+
+    GET /score/now      -> every recorded game with its current gameState
+    GET /_replay/next   -> advance one stage (or automatically every `step` seconds)
+    """
+    stages: int = 10
+    step: float = 0
+    stage: int = 1
+    lock = threading.Lock()
+    started: float = 0
+
+    @classmethod
+    def current(cls) -> int:
+        if cls.step > 0:
+            return min(cls.stages, 1 + int((time.monotonic() - cls.started) / cls.step))
+        return cls.stage
+
+    @classmethod
+    def clock(cls, pbp: dict) -> tuple[list[dict], int]:
+        """
+        plays shown at the current stage and the game time in seconds of the last one
+        """
+        plays = sorted(pbp.get('plays', []), key=lambda p: p.get('sortOrder', p['eventId']))
+        shown = plays[:len(plays) * cls.current() // cls.stages]
+        if not shown:
+            return shown, -1
+        last = shown[-1]
+        return shown, (last['periodDescriptor']['number'] - 1) * 20 * 60 + mmss(last['timeInPeriod'])
+
+    def replay_pbp(self, pbp: dict) -> dict:
+        if self.current() >= self.stages:
+            return pbp
+        shown, _ = self.clock(pbp)
+        return {**pbp, 'plays': shown, 'gameState': 'LIVE'}
+
+    def replay_shifts(self, shifts: dict, game_id: str) -> dict:
+        if self.current() >= self.stages:
+            return shifts
+        _, now = self.clock(json.loads(Path(self.root, 'gamecenter', game_id, 'play-by-play.json').read_bytes()))
+        shown = [s for s in shifts['data'] if (s['period'] - 1) * 20 * 60 + mmss(s['startTime']) <= now]
+        return {**shifts, 'data': shown, 'total': len(shown)}
+
+    def scores(self) -> dict:
+        games = []
+        for fp in sorted(Path(self.root, 'gamecenter').glob('*/play-by-play.json')):
+            pbp = self.replay_pbp(json.loads(fp.read_bytes()))
+            games.append({
+                key: pbp.get(key) for key in
+                ['id', 'season', 'gameType', 'startTimeUTC', 'venueTimezone', 'awayTeam', 'homeTeam', 'gameState']
+            })
+        return {'games': games}
+
+    def body(self, fp: Path) -> bytes:
+        data = json.loads(fp.read_bytes())
+        if fp.parent.parent.name == 'gamecenter' and fp.name == 'play-by-play.json':
+            data = self.replay_pbp(data)
+        elif fp.parent.name == 'shiftcharts':
+            data = self.replay_shifts(data, fp.stem)
+        return json.dumps(data).encode()
+
+    def do_GET(self):
+        path = urlparse(self.path).path.strip('/')
+        if path == '_replay/next':
+            with self.lock:
+                type(self).stage = min(self.stages, self.stage + 1)
+            self.send_json(200, json.dumps({'stage': self.current(), 'stages': self.stages}).encode())
+        elif path == 'score/now':
+            self.send_json(200, json.dumps(self.scores()).encode())
+        else:
+            super().do_GET()
+
+
+def serve(root: str, host: str = 'localhost', port: int = 8000, handler: type = StubHandler,
+          **attrs) -> ThreadingHTTPServer:
+    # attrs: class attributes of the handler, e.g. stages and step of ReplayHandler
+    handler = type(handler.__name__, (handler,), {'root': Path(root), 'started': time.monotonic(), **attrs})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser("nhl api stub server")
+    parser.add_argument('-r', '--root', help='fixture directory', required=True)
+    parser.add_argument('-H', '--host', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('-replay', help='serve the recorded games as live, in stages', type=int, metavar='STAGES')
+    parser.add_argument('-step', help='seconds per replay stage (0: advance with GET /_replay/next)',
+                        type=float, default=0)
+    args = parser.parse_args()
+    if args.replay:
+        server = serve(args.root, args.host, args.port, ReplayHandler, stages=args.replay, step=args.step)
+    else:
+        server = serve(args.root, args.host, args.port)
+    print(f"serving {args.root} on http://{args.host}:{args.port}/")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
 import polars as pl
+import pyarrow as pa
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from dataclasses import dataclass
 from fnmatch import fnmatch
 from typing import Optional, Callable
@@ -8,26 +12,51 @@ import json
 import argparse
 import datetime as dt
 from pathlib import Path
+from typing import IO, Iterable, Iterator
 from logger import Logger
+from schema import load_schema, arrow_schema, seconds_fields
+from dataset import DatasetWriter
+from archive import Archive, SOURCES, SUFFIX
 
 class MappingAction:
     mapping: dict[str, Callable] = {}
+    expressions: dict[str, Callable[..., pl.Expr]] = {}
 
     @classmethod
     def register(cls, func: Callable):
         cls.mapping[func.__name__] = func
 
+    @classmethod
+    def register_expr(cls, name: str, func: Callable[..., pl.Expr]):
+        cls.expressions[name] = func
+
     @classmethod
     def take(cls, key):
         return cls.mapping[key]
 
+    @classmethod
+    def take_expr(cls, key):
+        if key not in cls.expressions:
+            raise Exception(f'no expression registered for action {key}')
+        return cls.expressions[key]
+
 def regact(func):
     MappingAction.register(func)
 
+def regexpr(name: str):
+    # columnar counterpart of a @regact action, takes and returns pl.Expr
+    def wrap(func):
+        MappingAction.register_expr(name, func)
+    return wrap
+
 @regact
 def concat_string(a: str, b: str, delim: str = " "):
     return f"{a}{delim}{b}"
 
+@regexpr('concat_string')
+def concat_string_expr(a: pl.Expr, b: pl.Expr, delim: str = " "):
+    return pl.concat_str([a, b], separator=delim)
+
 def fmt_date(val: dt.date, fmt: str = '%Y-%m-%d') -> str:
     return val.strftime(fmt)
 
@@ -47,10 +76,10 @@ class Mapping:
     
     def map(self, inputv: dict) -> tuple[str, any]:
         if self.action:
-            return self.keyto, self.action([
+            return self.keyto, MappingAction.take(self.action)(*[
                 inputv.get(arg)
                 for arg in self.args
-            ], **self.kwargs)
+            ], **(self.kwargs or {}))
         if self.keyfrom:
             val = inputv
             for key in self.keyfrom:
@@ -59,6 +88,23 @@ class Mapping:
             return self.keyto, val if val != {} else None
         return self.keyto, inputv.get(self.keyto)
 
+    def paths(self) -> list[list[str]]:
+        if self.action:
+            return [[arg] for arg in self.args]
+        if self.keyfrom:
+            return [[self.keyto if key == '+' else key for key in self.keyfrom]]
+        return [[self.keyto]]
+
+    def expr(self) -> pl.Expr:
+        if self.action:
+            action = MappingAction.take_expr(self.action)
+            return action(*[pl.col(arg) for arg in self.args], **(self.kwargs or {})).alias(self.keyto)
+        path = self.paths()[0]
+        expr = pl.col(path[0])
+        for key in path[1:]:
+            expr = expr.struct.field(key)
+        return expr.alias(self.keyto)
+
 
 class Flatten:
     def __init__(self, fromdef: dict):
@@ -76,6 +122,59 @@ class Flatten:
         return [ {**item, **const_mappings} for item in returnlist ]
 
 
+class ColumnarPlan:
+    """
+    A ruleset compiled into the nested schema of the input records it needs
+    and the expressions producing its output, so a whole file is read by
+    pl.read_json and mapped in one select instead of record by record.
+    """
+    def __init__(self, ruleset: list[Mapping] | Flatten, schema: pl.Schema):
+        self.schema = schema
+        tree = {}
+        if isinstance(ruleset, Flatten):
+            mappings = ruleset.mappings
+            consts = {m.keyto for m in mappings}
+            item = pl.Struct({k: v for k, v in schema.items() if k not in consts})
+            self.nest(tree, [ruleset.key], pl.List(item))
+            self.explode = ruleset.key
+            self.exprs = [pl.col(ruleset.key).struct.unnest()]
+        else:
+            mappings = ruleset
+            self.explode = None
+            self.exprs = []
+        for mapping in mappings:
+            for path in mapping.paths():
+                # action arguments are read as strings
+                self.nest(tree, path, schema.get(path[-1], pl.String) if not mapping.action else pl.String)
+            self.exprs.append(mapping.expr().cast(schema.get(mapping.keyto, pl.String)))
+        self.input_schema = self.to_schema(tree)
+
+    @staticmethod
+    def nest(tree: dict, path: list[str], dtype: pl.DataType):
+        for key in path[:-1]:
+            tree = tree.setdefault(key, {})
+            if not isinstance(tree, dict):
+                raise Exception(f"conflicting paths at {'.'.join(path)}")
+        tree.setdefault(path[-1], dtype)
+
+    @classmethod
+    def to_schema(cls, tree: dict) -> pl.Schema:
+        return pl.Schema({
+            key: pl.Struct(cls.to_schema(value)) if isinstance(value, dict) else value
+            for key, value in tree.items()
+        })
+
+    def apply(self, df: pl.DataFrame) -> pl.DataFrame:
+        if self.explode:
+            df = df.explode(self.explode).filter(pl.col(self.explode).is_not_null())
+        return df.select(self.exprs).select(list(self.schema.names()))
+
+    def read(self, source) -> pl.DataFrame:
+        if is_file(source):
+            return self.apply(pl.read_json(source, schema=self.input_schema))
+        return self.apply(pl.from_dicts(list(source), schema=self.input_schema, strict=False))
+
+
 class RuleMap:
     def __init__(self, config_fp: str):
         self.rulesets = {}
@@ -89,6 +188,17 @@ class RuleMap:
                     Mapping(keyto, fromdef)
                     for keyto, fromdef in ruleset.items()
                 ]
+        self.plans: dict[str, ColumnarPlan] = {}
+
+    def compile(self, schemas: dict[str, pl.Schema]):
+        for rulename, ruleset in self.rulesets.items():
+            if rulename in schemas:
+                self.plans[rulename] = ColumnarPlan(ruleset, schemas[rulename])
+
+    def transform(self, rulename: str, source) -> pl.DataFrame:
+        if rulename not in self.plans:
+            raise Exception(f'no compiled rulename {rulename} found')
+        return self.plans[rulename].read(source)
 
     def parse(self, rulename: str, inputv: dict) -> dict | list:
         if rulename not in self.rulesets:
@@ -111,6 +221,99 @@ def handle_any(data_in: any, games_list: list, rulemap: RuleMap, datatype: str):
         games_list.append(rulemap.parse(datatype, record))
 
 
+def is_file(source) -> bool:
+    # a json file, as opposed to records already in memory (Archive.records)
+    return isinstance(source, (str, Path))
+
+
+def iter_records(source: Path | Iterable[dict]) -> Iterator[dict]:
+    if not is_file(source):
+        yield from source
+        return
+    with open(source, 'r') as f:
+        yield from iter_json_array(f)
+
+
+def iter_json_array(fp: IO[str], chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """
+    yields the items of a top level json array without loading the whole file
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+    opened = False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                raise ValueError("unterminated json array")
+            chunk = fp.read(chunk_size)
+            buf, pos, eof = chunk, 0, not chunk
+            continue
+        if not opened:
+            if buf[pos] != '[':
+                raise ValueError(f"expected json array, found {buf[pos]!r}")
+            opened, pos = True, pos + 1
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            item, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # item runs past the buffer, read more and try again
+            if eof:
+                raise
+            chunk = fp.read(chunk_size)
+            buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+            continue
+        yield item
+
+
+def iter_batches(records: Iterator[dict], schema: pa.Schema, batch_size: int) -> Iterator[pa.RecordBatch]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield pa.RecordBatch.from_pylist(batch, schema=schema)
+            batch = []
+    if batch:
+        yield pa.RecordBatch.from_pylist(batch, schema=schema)
+
+
+def stream_frames(infile: Path | Iterable[dict], rulemap: RuleMap, datatype: str, schema: pl.Schema, batch_size: int) -> Iterator[pl.DataFrame]:
+    """
+    json array -> RuleMap -> fixed schema record batches, holding at most one batch in memory
+    """
+    def records():
+        for record in iter_records(infile):
+            parsed = rulemap.parse(datatype, record)
+            if isinstance(parsed, list):
+                yield from parsed
+            else:
+                yield parsed
+
+    for batch in iter_batches(records(), arrow_schema(schema), batch_size):
+        yield pl.from_arrow(batch)
+
+
+def check_parity(rulemap: RuleMap, rulename: str, infile: Path, schema: pl.Schema) -> bool:
+    """
+    compares the columnar output of a file against the per-record output
+    """
+    with open(infile, 'r') as f:
+        data_in = json.load(f)
+    per_record = []
+    handle_any(data_in, per_record, rulemap, rulename)
+    if per_record and isinstance(per_record[0], list):
+        per_record = [row for rows in per_record for row in rows]
+    expected = pl.DataFrame(per_record, schema=schema, strict=False)
+    columnar = rulemap.transform(rulename, infile)
+    if expected.equals(columnar, null_equal=True):
+        return True
+    Logger.warning(f"{rulename} mismatch in {infile}: {expected.height} per-record rows, {columnar.height} columnar rows")
+    return False
+
+
 def grab_all_json_files(indir: str, type: str):
     filepaths = []
     for path, _, files in os.walk(indir):
@@ -119,55 +322,200 @@ def grab_all_json_files(indir: str, type: str):
                 filepaths.append(Path(path, name))
     return filepaths
 
+def transform_records(infile: Path | Iterable[dict], rulemap: RuleMap, datatype: str) -> dict[str, pl.DataFrame]:
+    if is_file(infile):
+        with open(infile, 'r') as f:
+            data_in = json.load(f)
+    else:
+        data_in = list(infile)
+    try:
+        data_out = {}
+        match datatype:
+            case 'games':
+                data_out['games'] = []
+                handle_any(data_in, data_out['games'], rulemap, 'games')
+            case 'plays':
+                data_out['plays'] = []
+                handle_any(data_in, data_out['plays'], rulemap, 'plays')
+            case 'play_details':
+                data_out['play_details'] = []
+                handle_any(data_in, data_out['play_details'], rulemap, 'play_details')
+            case 'rosters':
+                data_out['rosters'] = []
+                handle_any(data_in, data_out['rosters'], rulemap, 'rosters')
+            case 'shifts':
+                data_out['shifts'] = []
+                handle_any(data_in, data_out['shifts'], rulemap, 'shifts')
+            case _:
+                Logger.warning("nothing handled")
+    except Exception as e:
+        Logger.error(e)
+    return {
+        file: pl.DataFrame(data, infer_schema_length=None)
+        for file, data in data_out.items()
+    }
+
+
+def write_csv_atomic(frames: Iterator[pl.DataFrame], outfile: Path, schema: pl.Schema):
+    tmp = outfile.with_suffix('.tmp')
+    with open(tmp, 'wb') as f:
+        header = True
+        for df in frames:
+            df.write_csv(f, include_header=header)
+            header = False
+        if header:
+            pl.DataFrame(schema=schema).write_csv(f)
+    os.replace(tmp, outfile)
+
+
+_RULEMAP: Optional[RuleMap] = None
+
+def worker_rulemap(config_fp: str, schema_fp: str) -> RuleMap:
+    # built once per worker process
+    global _RULEMAP
+    if _RULEMAP is None:
+        _RULEMAP = RuleMap(config_fp)
+        _RULEMAP.compile(load_schema(schema_fp))
+    return _RULEMAP
+
+
+def read_frames(source: Path | Iterable[dict], rulemap: RuleMap, datatype: str, mode: str, batch_size: int) -> Iterator[pl.DataFrame]:
+    match mode:
+        case 'stream':
+            yield from stream_frames(source, rulemap, datatype, rulemap.plans[datatype].schema, batch_size)
+        case 'columnar':
+            yield rulemap.transform(datatype, source)
+        case _:
+            data_out = transform_records(source, rulemap, datatype)
+            if datatype in data_out:
+                yield data_out[datatype]
+
+
+def write_frames(frames: Iterator[pl.DataFrame], outdir: str, datatype: str, name: str, rulemap: RuleMap,
+                 schema_fp: str, fmt: str) -> list[Path]:
+    schema = rulemap.plans[datatype].schema
+    if fmt == 'parquet':
+        writer = DatasetWriter(outdir, datatype, name, schema, seconds_fields(schema_fp)[datatype])
+        for df in frames:
+            writer.write(df)
+        return writer.close()
+    poutfile = Path(outdir, f"{datatype}_{name}.csv")
+    write_csv_atomic(frames, poutfile, schema)
+    return [poutfile]
+
+
+def transform_file(infile: Path, outdir: str, datatype: str, config_fp: str, schema_fp: str,
+                   mode: str = 'records', batch_size: int = 50_000, fmt: str = 'csv') -> list[Path]:
+    rulemap = worker_rulemap(config_fp, schema_fp)
+    Logger.info(f"{mode}: {infile} to {outdir}")
+    frames = read_frames(infile, rulemap, datatype, mode, batch_size)
+    return write_frames(frames, outdir, datatype, infile.stem, rulemap, schema_fp, fmt)
+
+
+def archive_parts(indir: str, games_per_part: int) -> list[tuple[Path, list[int], str]]:
+    """
+    (archive, game ids, output name) slices of every archive under indir
+    """
+    root = Path(indir)
+    archives = [root] if root.is_file() else sorted(root.glob(f"**/*{SUFFIX}"))
+    parts = []
+    for fp in archives:
+        with Archive(fp) as archive:
+            ids = archive.game_ids()
+        for i in range(0, len(ids), games_per_part):
+            parts.append((fp, ids[i:i + games_per_part], f"{fp.stem}_{i // games_per_part:04d}"))
+    return parts
+
+
+def transform_archive(part: tuple[Path, list[int], str], outdir: str, datatype: str, config_fp: str, schema_fp: str,
+                      mode: str = 'records', batch_size: int = 50_000, fmt: str = 'csv') -> list[Path]:
+    """
+    transforms the games of one archive slice, decompressing only those records
+    """
+    archive_fp, game_ids, name = part
+    rulemap = worker_rulemap(config_fp, schema_fp)
+    Logger.info(f"{mode}: {len(game_ids)} games of {archive_fp} to {outdir}")
+    with Archive(archive_fp) as archive:
+        # records straight from the decompressed games, without a json round trip
+        frames = read_frames(archive.records(SOURCES[datatype], game_ids), rulemap, datatype, mode, batch_size)
+        return write_frames(frames, outdir, datatype, name, rulemap, schema_fp, fmt)
+
+
+def combine_csv(parts: list[Path], outfile: Path):
+    """
+    concatenates csv files that share a header into `outfile`
+    """
+    tmp = outfile.with_suffix('.tmp')
+    header = None
+    with open(tmp, 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as f:
+                line = f.readline()
+                if header is None:
+                    header = line
+                    out.write(header)
+                elif line != header:
+                    raise Exception(f"difference between headers found: {parts[0]}, {part}")
+                shutil.copyfileobj(f, out)
+    os.replace(tmp, outfile)
+
+
 def main():
     parser = argparse.ArgumentParser("data transformer")
     parser.add_argument('-c', '--config', help='config file with mapping', required=True)
     parser.add_argument('-i', '--indir', help='json file input dir', required=True)
     parser.add_argument('-o', '--outdir', help='csv file output dir', required=True)
     parser.add_argument('-t', '--type', help='input value type', required=True)
+    parser.add_argument('-s', '--schema', help='column types of each ruleset', default=Path(Path(__file__).parent, 'schema.yml'))
     parser.add_argument('-interactive', help='do not save, break', default=False, action="store_true")
+    parser.add_argument('-stream', help='parse incrementally and write fixed schema batches', default=False, action="store_true")
+    parser.add_argument('-b', '--batch-size', help='rows per batch in -stream mode', type=int, default=50_000)
+    parser.add_argument('-columnar', help='map whole files with compiled polars expressions', default=False, action="store_true")
+    parser.add_argument('-check', help='compare columnar output against per-record output, no writes', default=False, action="store_true")
+    parser.add_argument('-j', '--jobs', help='files transformed in parallel', type=int, default=os.cpu_count())
+    parser.add_argument('-combine', help='also write all files combined into <outdir>/<type>.csv', default=False, action="store_true")
+    parser.add_argument('-keep', help='keep per-file outputs after -combine', default=False, action="store_true")
+    parser.add_argument('-archive', help=f"read games from the *{SUFFIX} archives in indir instead of json files",
+                        default=False, action="store_true")
+    parser.add_argument('--archive-games', help='games per output file in -archive mode', type=int, default=256)
+    parser.add_argument('-f', '--format', help='csv files, or a parquet dataset partitioned by season and game type',
+                        choices=['csv', 'parquet'], default='csv')
 
     args = parser.parse_args()
-    rulemap = RuleMap(args.config)
-    filepaths = grab_all_json_files(args.indir, 'playbyplays' if 'play' in args.type else args.type)
-    for infile in filepaths:
-        with open(infile, 'r') as f: 
-            data_in = json.load(f)
-        try:
-            data_out = {}
-            match args.type:
-                case 'games':
-                    data_out['games'] = []
-                    handle_any(data_in, data_out['games'], rulemap, 'games')
-                case 'plays':
-                    data_out['plays'] = []
-                    handle_any(data_in, data_out['plays'], rulemap, 'plays')
-                case 'play_details':
-                    data_out['play_details'] = []
-                    handle_any(data_in, data_out['play_details'], rulemap, 'play_details')
-                case 'rosters':
-                    data_out['rosters'] = []
-                    handle_any(data_in, data_out['rosters'], rulemap, 'rosters')
-                case 'shifts':
-                    data_out['shifts'] = []
-                    handle_any(data_in, data_out['shifts'], rulemap, 'shifts')
-                case _:
-                    Logger.warning("nothing handled")
-        except Exception as e:
-            Logger.error(e)
-        finally:
-            for file, data in data_out.items():
-                # data: to df
-                data_out[file] = pl.DataFrame(data, infer_schema_length=None)
-            if args.interactive:
-                # file by file breakpoint
-                breakpoint()
-            else:
-                for file, data in data_out.items():
-                    # data: write out
-                    poutfile = Path(args.outdir, f"{file}_{infile.with_suffix('.csv').name}")
-                    data.write_csv(poutfile)
-                    
+    filepaths = sorted(grab_all_json_files(args.indir, 'playbyplays' if 'play' in args.type else args.type))
+    if args.archive:
+        filepaths = archive_parts(args.indir, args.archive_games)
+    if (args.interactive or args.check) and args.archive:
+        parser.error("-interactive and -check read json files, not -archive")
+    if args.interactive or args.check:
+        rulemap = worker_rulemap(args.config, args.schema)
+        for infile in filepaths:
+            if args.check:
+                ok = check_parity(rulemap, args.type, infile, rulemap.plans[args.type].schema)
+                Logger.info(f"parity {'ok' if ok else 'FAILED'}: {infile}")
+                continue
+            data_out = transform_records(infile, rulemap, args.type)
+            # file by file breakpoint
+            breakpoint()
+        return
+
+    mode = 'stream' if args.stream else 'columnar' if args.columnar else 'records'
+    task = partial(transform_archive if args.archive else transform_file, outdir=args.outdir, datatype=args.type, config_fp=args.config,
+                   schema_fp=args.schema, mode=mode, batch_size=args.batch_size, fmt=args.format)
+    if args.jobs > 1 and len(filepaths) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            parts = [p for ps in pool.map(task, filepaths) for p in ps]
+    else:
+        parts = [p for infile in filepaths for p in task(infile)]
+
+    if args.combine and parts and args.format == 'csv':
+        poutfile = Path(args.outdir, f"{args.type}.csv")
+        Logger.info(f"combining {len(parts)} files into {poutfile}")
+        combine_csv(parts, poutfile)
+        if not args.keep:
+            for part in parts:
+                part.unlink()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
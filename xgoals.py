@@ -0,0 +1,223 @@
+"""
+xGoals: shot features for whole seasons as columns, one logistic regression and
+batch scoring.
+
+<cache>/features/season=.../gameType=.../features.parquet   one row per unblocked shot attempt
+<cache>/features/season=.../gameType=.../features.version   VERSION the features were built with
+<cache>/model.pkl                                          scaler + LogisticRegression, its VERSION and seasons
+<cache>/scores/season=.../gameType=.../scores.parquet       gameId, eventId, teamId, shooterId, goal, xg
+
+Features of a season/game type partition are built in one pass over its plays
+and cached until a dataset file of the partition changes or VERSION (a hash of
+FEATURES, SHOT_TYPES and the sequence rules) does: distance and angle to
+the attacked net, shot type, rebound and rush flags (tools/sequences.py), and the strength state of
+the shooting team from the stored timeline (tools/strength.py, built on the fly
+if missing). The model is fitted once on the training seasons and reused until
+--refit; scoring runs over the cached features in batches. By default the latest
+season is held out of the fit, and every summary says whether its season was
+held out or in-sample.
+"""
+import sys
+from pathlib import Path
+sys.path.append(str(Path(Path(__file__).parent, 'tools')))
+
+import argparse
+import hashlib
+import pickle
+import time
+import numpy as np
+import polars as pl
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import log_loss, roc_auc_score
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.preprocessing import StandardScaler
+import draw
+import dataset
+import sequences
+import strength
+from render import orient
+
+SHOT_EVENTS = ['missed-shot', 'shot-on-goal', 'goal']
+SHOT_TYPES = ['wrist', 'snap', 'slap', 'backhand', 'tip-in', 'deflected', 'wrap-around']
+# attacked net with the shooting team attacking to the right
+NET_X = draw.RINK[0][1] - draw.GOAL_OFFSET
+FEATURES = [
+    'distance', 'angle', 'rebound', 'rush', 'ownSkaters', 'oppSkaters', 'emptyNet',
+    *[f"shot_{t}" for t in SHOT_TYPES], 'shot_other',
+]
+
+
+# changes whenever the features would be built differently from the same dataset
+VERSION = hashlib.sha1(repr((FEATURES, SHOT_TYPES, sorted(sequences.RULES.items()))).encode()).hexdigest()[:16]
+
+
+def partition_dir(cache: str, kind: str, season: int, game_type: int) -> Path:
+    return Path(cache, kind, f"season={season}", f"gameType={game_type}")
+
+
+def timeline(root: str, season: int, game_type: int) -> pl.DataFrame:
+    if Path(root, 'strength', f"season={season}", f"gameType={game_type}").exists():
+        return strength.scan(root, [season], [game_type]).sort('gameId', 't0').collect()
+    return strength.build_partition(root, season, game_type)
+
+
+def build_features(root: str, season: int, game_type: int) -> pl.DataFrame:
+    events = sequences.scan_events(
+        root, [season], [game_type], plays=['homeTeamDefendingSide'], details=['xCoord', 'yCoord', 'shotType'],
+    ).collect()
+    shots = (
+        sequences.flags(events)
+        .filter(pl.col('typeDescKey').is_in(SHOT_EVENTS))
+        .drop_nulls(['xCoord', 'yCoord'])
+    )
+    shots = strength.lookup(shots, timeline(root, season, game_type))
+    is_home = pl.col('teamId') == pl.col('homeTeamId')
+    side = lambda own, other: pl.when(is_home).then(pl.col(own)).otherwise(pl.col(other))
+    shot_type = pl.when(pl.col('shotType').is_in(SHOT_TYPES)).then(pl.col('shotType')).otherwise(pl.lit('other'))
+    return (
+        orient(shots.lazy())
+        .with_columns(dx=NET_X - pl.col('x'), dy=pl.col('y').abs())
+        .select(
+            'gameId', 'eventId', 'teamId',
+            shooterId=pl.coalesce('scoringPlayerId', 'shootingPlayerId'),
+            goal=(pl.col('typeDescKey') == 'goal').cast(pl.Int8),
+            distance=(pl.col('dx') ** 2 + pl.col('dy') ** 2).sqrt(),
+            angle=pl.arctan2(pl.col('dy'), pl.col('dx')).degrees(),
+            rebound=pl.col('rebound').cast(pl.Int8),
+            rush=pl.col('rush').cast(pl.Int8),
+            # events without a timeline count as 5v5 with both goalies in
+            ownSkaters=side('homeSkaters', 'awaySkaters').fill_null(5).cast(pl.Int8),
+            oppSkaters=side('awaySkaters', 'homeSkaters').fill_null(5).cast(pl.Int8),
+            emptyNet=(~side('awayGoalie', 'homeGoalie')).fill_null(False).cast(pl.Int8),
+            **{f"shot_{t}": (shot_type == t).cast(pl.Int8) for t in [*SHOT_TYPES, 'other']},
+        )
+        # coordinates outside the rink are recording errors
+        .filter(pl.col('distance') <= draw.MAX_RINK_DIST)
+        .collect()
+    )
+
+
+def features(root: str, cache: str, season: int, game_type: int) -> pl.DataFrame:
+    """
+    cached features of one partition, rebuilt when a dataset file of the partition is newer
+    or they were built with another VERSION
+    """
+    fp = Path(partition_dir(cache, 'features', season, game_type), 'features.parquet')
+    version_fp = fp.with_suffix('.version')
+    sources = [
+        src for datatype in ['games', 'plays', 'play_details', 'rosters', 'shifts', 'strength']
+        for src in Path(root, datatype, f"season={season}", f"gameType={game_type}").glob('*.parquet')
+    ]
+    current = version_fp.exists() and version_fp.read_text() == VERSION
+    if current and fp.exists() and all(src.stat().st_mtime <= fp.stat().st_mtime for src in sources):
+        return pl.read_parquet(fp)
+    df = build_features(root, season, game_type)
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fp.with_suffix('.tmp')
+    df.write_parquet(tmp)
+    tmp.replace(fp)
+    # written last: a run that dies in between leaves the old version, so the features are rebuilt
+    version_fp.write_text(VERSION)
+    return df
+
+
+def matrix(df: pl.DataFrame) -> np.ndarray:
+    return df.select(FEATURES).to_numpy().astype(np.float64)
+
+
+def fit(train: pl.DataFrame, c: float = 1.0) -> Pipeline:
+    model = make_pipeline(StandardScaler(), LogisticRegression(C=c, max_iter=1000))
+    model.fit(matrix(train), train['goal'].to_numpy())
+    return model
+
+
+def save_model(fp: Path, model: Pipeline, seasons: list[int]):
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    with open(fp, 'wb') as f:
+        pickle.dump({'features': FEATURES, 'version': VERSION, 'seasons': seasons, 'model': model}, f)
+
+
+def load_model(fp: Path) -> tuple[Pipeline, list[int]]:
+    """
+    model and the seasons it was fitted on
+    """
+    with open(fp, 'rb') as f:
+        saved = pickle.load(f)
+    if saved['features'] != FEATURES or saved.get('version') != VERSION:
+        raise Exception(f"{fp} was fitted on other features, run with --refit")
+    return saved['model'], saved['seasons']
+
+
+def score(model: Pipeline, df: pl.DataFrame, batch_size: int = 100_000) -> pl.DataFrame:
+    xg = np.concatenate([
+        model.predict_proba(matrix(batch))[:, 1] for batch in df.iter_slices(batch_size)
+    ]) if df.height else np.empty(0)
+    return df.select('gameId', 'eventId', 'teamId', 'shooterId', 'goal').with_columns(xg=pl.Series(xg, dtype=pl.Float32))
+
+
+def summary(scores: pl.DataFrame, in_sample: bool) -> dict:
+    """
+    in_sample: the scored shots were part of the fit, so log_loss and auc are optimistic
+    """
+    goals, xg = scores['goal'].to_numpy(), scores['xg'].to_numpy()
+    both = 0 < goals.sum() < len(goals)
+    return {
+        'sample': 'in-sample' if in_sample else 'held-out',
+        'shots': scores.height,
+        'goals': int(goals.sum()),
+        'xg': round(float(xg.sum()), 1),
+        'log_loss': round(log_loss(goals, xg, labels=[0, 1]), 4) if both else None,
+        'auc': round(roc_auc_score(goals, xg), 4) if both else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser("xgoals")
+    parser.add_argument('-d', '--dir', help='parquet dataset root', required=True)
+    parser.add_argument('-c', '--cache', help='features, model and scores', default='./data/xgoals')
+    parser.add_argument('-T', '--train', help='seasons to fit on, e.g. 20222023,20232024 '
+                        '(default: all but the latest, held out for the summary; all if there is only one)')
+    parser.add_argument('-S', '--seasons', help='seasons to score (default: all)')
+    parser.add_argument('-g', '--game_types', help='game types (comma separated)', default='2')
+    parser.add_argument('--refit', help='fit the model again', default=False, action='store_true')
+    parser.add_argument('-C', help='inverse regularization strength', type=float, default=1.0)
+    parser.add_argument('-b', '--batch_size', help='rows scored per batch', type=int, default=100_000)
+    args = parser.parse_args()
+    split = lambda s: [int(x) for x in s.split(',')] if s else None
+    train_seasons, score_seasons, game_types = split(args.train), split(args.seasons), split(args.game_types)
+
+    partitions = dataset.scan(args.dir, 'plays', ['season', 'gameType'], game_types=game_types).unique()
+    partitions = partitions.sort('season', 'gameType').collect().rows()
+    start = time.perf_counter()
+    feats = {(season, gt): features(args.dir, args.cache, season, gt) for season, gt in partitions}
+    print(f"features of {len(feats)} partitions in {time.perf_counter() - start:.1f}s")
+
+    model_fp = Path(args.cache, 'model.pkl')
+    if args.refit or not model_fp.exists():
+        start = time.perf_counter()
+        seasons = sorted({season for season, _ in feats})
+        if not train_seasons:
+            train_seasons = seasons[:-1] or seasons
+        train = {key: df for key, df in feats.items() if key[0] in train_seasons}
+        if not train:
+            parser.error("no features to fit on")
+        model = fit(pl.concat(train.values()), args.C)
+        fitted = sorted({season for season, _ in train})
+        save_model(model_fp, model, fitted)
+        print(f"fitted on {sum(df.height for df in train.values())} shots of {fitted} in {time.perf_counter() - start:.1f}s")
+    else:
+        model, fitted = load_model(model_fp)
+
+    for (season, gt), df in feats.items():
+        if score_seasons and season not in score_seasons:
+            continue
+        start = time.perf_counter()
+        scores = score(model, df, args.batch_size)
+        fp = Path(partition_dir(args.cache, 'scores', season, gt), 'scores.parquet')
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        scores.write_parquet(fp)
+        print(f"{season}/{gt}: {summary(scores, season in fitted)} in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()